@@ -22,6 +22,14 @@ from redbot.core.bot import Red
 from .enums import Rank, EmergencyModules
 from .core.warden.enums import Event as WardenEvent
 from .core.warden.rule import WardenRule
+from .core.warden.sandbox import RegexSandbox
+from .core.warden.executor import ActionExecutor
+from .core.warden.scheduler import FairScheduler
+from .core.warden.stats import WardenStats
+from .core.warden.rule_cache import RuleCache
+from .core.warden.periodic import PeriodicScheduler
+from .core.warden.incremental import DirtyMembers
+from .core.warden.ruleset import GuildRulesets
 from .core.utils import QuickAction
 from typing import List, Dict
 import datetime
@@ -48,9 +56,17 @@ class MixinMeta(ABC):
         self.config: Config
         self.bot: Red
         self.emergency_mode: dict
-        self.active_warden_rules: dict
+        self.active_warden_rules: GuildRulesets
         self.invalid_warden_rules: dict
         self.warden_checks: dict
+        self.wd_regex: RegexSandbox
+        self.wd_executor: ActionExecutor
+        self.wd_scheduler: FairScheduler
+        self.wd_stats: WardenStats
+        self.wd_rule_cache: RuleCache
+        self.wd_periodic: PeriodicScheduler
+        self.wd_dirty: DirtyMembers
+        self.wd_eval_semaphores: Dict[int, asyncio.Semaphore]
         self.joined_users: dict
         self.monitor: dict
         self.loop: asyncio.AbstractEventLoop
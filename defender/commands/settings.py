@@ -17,7 +17,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from defender.core.warden.rule import WardenRule
 from defender.core.warden.enums import ChecksKeys as WDChecksKeys
-from defender.core.warden import api as WardenAPI
+from defender.core.warden import api as WardenAPI, utils as wd_utils, stats as rule_stats
 from ..abc import MixinMeta, CompositeMetaClass
 from ..enums import Action, Rank, PerspectiveAttributes as PAttr, EmergencyModules as EModules
 from redbot.core import commands
@@ -660,11 +660,37 @@ class Settings(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
         else:
             await ctx.send("Warden auto-module disabled. Existing rules will have no effect.")
 
+    @wardenset.command(name="concurrent")
+    async def wardensetconcurrent(self, ctx: commands.Context, on_or_off: bool):
+        """Toggles the concurrent evaluation of rules
+
+        When enabled, the conditions of all the rules triggered by an event are evaluated
+        at the same time, so that a slow rule doesn't hold back the others. Actions are
+        still run in order of priority, but conditions will not see the effects of the
+        actions of other rules triggered by the same event (for example, heat)."""
+        await self.config.guild(ctx.guild).warden_concurrent_eval.set(on_or_off)
+        if on_or_off:
+            await ctx.send("Warden rules will now have their conditions evaluated concurrently.")
+        else:
+            await ctx.send("Warden rules will now be evaluated one after another.")
+
+    @wardenset.command(name="rescan")
+    async def wardensetrescan(self, ctx: commands.Context, hours: int):
+        """Sets how often incremental periodic rules are run against every member
+
+        In between, incremental periodic rules only evaluate the members that have
+        changed since their previous run."""
+        if hours < 1 or hours > 168:
+            return await ctx.send("The value must be between 1 and 168 hours.")
+        await self.config.guild(ctx.guild).wd_periodic_rescan_hours.set(hours)
+        await ctx.send(f"Incremental periodic rules will be run against every member every {hours} hours.")
+
     @wardenset.command(name="regexallowed")
     @commands.is_owner()
     async def wardensetregex(self, ctx: commands.Context, on_or_off: bool):
         """Toggles the ability to globally create rules with user defined regex"""
         await self.config.wd_regex_allowed.set(on_or_off)
+        wd_utils.REGEX_ALLOWED = on_or_off
         if on_or_off:
             await ctx.send(
                 "All servers will now be able to create Warden rules with user defined regex. "
@@ -683,9 +709,10 @@ class Settings(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
     async def wardenregexsafetychecks(self, ctx: commands.Context, on_or_off: bool):
         """Globally toggles the safety checks for user defined regex
 
-        These checks disable Warden rules with regex that takes too long to be evaluated. It is
+        These checks suspend Warden rules with regex that takes too long to be evaluated. It is
         recommended to keep this feature enabled."""
         await self.config.wd_regex_safety_checks.set(on_or_off)
+        wd_utils.REGEX_SAFETY_CHECKS = on_or_off
         if on_or_off:
             await ctx.send("Global safety checks for user defined regex are now enabled.")
         else:
@@ -695,6 +722,39 @@ class Settings(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
                 "at any point you experience high resource usage on the host."
             )
 
+    @wardenset.command(name="throttle")
+    @commands.is_owner()
+    async def wardensetthrottle(self, ctx: commands.Context, milliseconds: int):
+        """Sets the average evaluation time above which a rule is throttled
+
+        Only the time the conditions spend running counts, not the time spent waiting.
+        Throttled rules are either sampled or suspended, see `[p]dset warden throttlemode`.
+        0 disables throttling, which is the default. Periodic rules are never throttled."""
+        if milliseconds < 0 or milliseconds > 1000:
+            return await ctx.send("The threshold must be between 0 and 1000 milliseconds.")
+        await self.config.wd_throttle_threshold.set(milliseconds)
+        rule_stats.THROTTLE_THRESHOLD = milliseconds
+        if milliseconds:
+            await ctx.send(
+                f"Warden rules taking more than {milliseconds}ms on average to be evaluated will be throttled."
+            )
+        else:
+            await ctx.send("Warden rules will not be throttled anymore. Rules already throttled will stay so.")
+
+    @wardenset.command(name="throttlemode")
+    @commands.is_owner()
+    async def wardensetthrottlemode(self, ctx: commands.Context, mode: str):
+        """Sets what happens to the rules that exceed the throttle threshold
+
+        `sampled`: the rule is only evaluated on 1 event out of 10
+        `suspended`: the rule is not evaluated anymore until the staff resumes it"""
+        mode = mode.lower()
+        if mode not in (rule_stats.SAMPLED, rule_stats.SUSPENDED):
+            return await ctx.send_help()
+        await self.config.wd_throttle_mode.set(mode)
+        rule_stats.THROTTLE_MODE = mode
+        await ctx.send(f"Rules exceeding the throttle threshold will now be {mode}.")
+
     @wardenset.command(name="periodicallowed")
     @commands.is_owner()
     async def wardensetperiodic(self, ctx: commands.Context, on_or_off: bool):
@@ -19,13 +19,17 @@ from defender.enums import EmergencyMode
 from ..abc import MixinMeta, CompositeMetaClass
 from ..enums import Rank
 from ..core.warden.enums import Event as WardenEvent
-from ..core.warden.rule import WardenRule
+from ..core.warden.rule import WardenRule, ConditionMemo
 from ..core.warden.enums import Event as WardenEvent, ChecksKeys
 from ..core.warden.utils import rule_add_periodic_prompt, rule_add_overwrite_prompt, strip_yaml_codeblock
-from ..core.warden import heat, api as WardenAPI
+from ..core.warden.prefilter import MemberSnapshot, prefilter_members
+from ..core.warden.estimate import estimate_affected, find_affected, rule_predicate
+from ..core.warden.trace import RuleProfile, DEFAULT_PROFILE_RATE
+from ..core.warden import heat, api as WardenAPI, utils as wd_utils, stats as rule_stats
+from ..core.warden.validation import IsRegex
 from ..core.status import make_status
 from ..core.cache import UserCacheConverter
-from ..core.utils import utcnow
+from ..core.utils import utcnow, timestamp
 from ..exceptions import ExecutionError, InvalidRule
 from ..core.announcements import get_announcements_embed
 from redbot.core.utils import AsyncIter
@@ -397,7 +401,9 @@ class StaffTools(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
              Alert: {await conf.alert_enabled()}
              Vaporize: {await conf.vaporize_enabled()}
              Silence: {await conf.silence_enabled()}
-             Voteout: {await conf.voteout_enabled()}"""
+             Voteout: {await conf.voteout_enabled()}
+            -- Warden --
+             Condition memo: {ConditionMemo.hits} hits / {ConditionMemo.misses} misses"""
                 ),
                 lang="py",
             )
@@ -451,6 +457,7 @@ class StaffTools(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
             warden_rules[new_rule.name] = rule
         self.active_warden_rules[ctx.guild.id][new_rule.name] = new_rule
         self.invalid_warden_rules[ctx.guild.id].pop(new_rule.name, None)
+        self.wd_stats.get(ctx.guild.id, new_rule.name).resume()
 
         if not prompts_sent:
             await ctx.tick()
@@ -464,6 +471,7 @@ class StaffTools(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
         try:
             self.active_warden_rules[ctx.guild.id].pop(name, None)
             self.invalid_warden_rules[ctx.guild.id].pop(name, None)
+            self.wd_stats.discard(ctx.guild.id, name)
             async with self.config.guild(ctx.guild).wd_rules() as warden_rules:
                 del warden_rules[name]
             await ctx.tick()
@@ -489,8 +497,9 @@ class StaffTools(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
             return await ctx.send("Not proceeding with deletion.")
 
         await self.config.guild(ctx.guild).wd_rules.clear()
-        self.active_warden_rules[ctx.guild.id] = {}
+        self.active_warden_rules[ctx.guild.id].clear()
         self.invalid_warden_rules[ctx.guild.id] = {}
+        self.wd_stats.discard(ctx.guild.id)
         await ctx.send("All rules have been deleted.")
 
     @wardengroup.command(name="list")
@@ -557,6 +566,87 @@ class StaffTools(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
             else:
                 await ctx.send(box(p, lang="yaml"))
 
+        regex_paths = []
+        for statement, model in rule.iter_statements():
+            if isinstance(model, IsRegex):
+                if not wd_utils.REGEX_SAFETY_CHECKS:
+                    path = "inline (safety checks disabled)"
+                else:
+                    path = "inline (linear time)" if model._inline else "sandbox"
+                regex_paths.append(f"`{statement.enum.value}`: {path}")
+        if regex_paths:
+            await ctx.send("Regex evaluation:\n" + "\n".join(regex_paths))
+
+    @wardengroup.command(name="stats")
+    async def wardengroupstats(self, ctx: commands.Context, *, name: str = None):
+        """Shows the execution stats of the rules, or of a single rule
+
+        Rules are sorted by the total time spent evaluating them"""
+        guild_stats = self.wd_stats.guilds.get(ctx.guild.id, {})
+        active_rules = self.active_warden_rules[ctx.guild.id]
+
+        if name is not None:
+            name = name.lower()
+            if name not in active_rules:
+                return await ctx.send("There is no rule with that name.")
+            stats = guild_stats.get(name)
+            if stats is None or not stats.evaluations:
+                return await ctx.send("This rule hasn't been evaluated yet.")
+            last_fired = "Never"
+            if stats.last_fired is not None:
+                last_fired = timestamp(datetime.datetime.utcfromtimestamp(stats.last_fired), relative=True)
+            text = (
+                f"**{name}**\n"
+                f"Evaluations: {stats.evaluations}\n"
+                f"Conditions passed: {stats.passes} ({stats.passes / stats.evaluations:.1%})\n"
+                f"Actions run: {stats.actions}\n"
+                f"Failures: {stats.failures}\n"
+                f"Evaluation time: {stats.total_time:.2f}s total, {stats.average_time * 1000:.2f}ms average, "
+                f"{stats.p95_time * 1000:.2f}ms p95 (recent), {stats.max_time * 1000:.2f}ms max\n"
+                f"Last fired: {last_fired}"
+            )
+            if stats.throttle == rule_stats.SAMPLED:
+                text += f"\nThrottled: only evaluated on 1 event out of {rule_stats.SAMPLE_RATE}"
+            elif stats.throttle == rule_stats.SUSPENDED:
+                text += "\nThrottled: suspended"
+            return await ctx.send(text)
+
+        stats = [(n, s) for n, s in guild_stats.items() if n in active_rules and s.evaluations]
+        if not stats:
+            return await ctx.send("No rule has been evaluated yet.")
+        stats.sort(key=lambda k: k[1].total_time, reverse=True)
+
+        text = f"{'Rule':<20} {'Evals':>8} {'Pass':>6} {'Acts':>6} {'Fails':>6} {'Avg ms':>8} {'p95 ms':>8}\n"
+        for rule_name, s in stats:
+            if len(rule_name) > 20:
+                rule_name = rule_name[:19] + "…"
+            text += (
+                f"{rule_name:<20} {s.evaluations:>8} {s.passes / s.evaluations:>6.0%} {s.actions:>6} "
+                f"{s.failures:>6} {s.average_time * 1000:>8.2f} {s.p95_time * 1000:>8.2f}\n"
+            )
+
+        for p in pagify(text, delims=["\n"], page_length=1900):
+            await ctx.send(box(p))
+
+        throttled = [f"{inline(n)} ({s.throttle})" for n, s in stats if s.throttle is not None]
+        if throttled:
+            await ctx.send(f"Throttled rules: {', '.join(throttled)}")
+
+    @wardengroup.command(name="resume")
+    async def wardengroupresume(self, ctx: commands.Context, *, name: str):
+        """Resumes a rule that has been throttled for poor performances"""
+        name = name.lower()
+        if name not in self.active_warden_rules[ctx.guild.id]:
+            return await ctx.send("There is no rule with that name.")
+        stats = self.wd_stats.get(ctx.guild.id, name)
+        if stats.throttle is None:
+            return await ctx.send("This rule is not throttled.")
+        stats.resume()
+        await rule_stats.save_rule_stats(self, ctx.guild, name, stats)
+        await ctx.send(
+            "The rule has been resumed. If it keeps exceeding the evaluation time limit it will be throttled again."
+        )
+
     @commands.cooldown(1, 3600 * 24, commands.BucketType.guild)  # only one session per guild
     @wardengroup.command(name="upload")
     async def wardengroupupload(self, ctx: commands.Context):
@@ -649,6 +739,7 @@ class StaffTools(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
                     warden_rules[new_rule.name] = raw_rule
                 self.active_warden_rules[ctx.guild.id][new_rule.name] = new_rule
                 self.invalid_warden_rules[ctx.guild.id].pop(new_rule.name, None)
+                self.wd_stats.get(ctx.guild.id, new_rule.name).resume()
                 if not prompts_sent:
                     await message.add_reaction(confirm_emoji)
                 else:
@@ -696,7 +787,8 @@ class StaffTools(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
     async def wardengrouprun(self, ctx: commands.Context, *, name: str):
         """Runs a rule against the whole userbase
 
-        Confirmation is asked before execution."""
+        Confirmation is asked before execution. On large servers the number
+        of affected users is estimated from a sample, then counted exactly."""
         EMOJI = "✅"
         try:
             rule: WardenRule = self.active_warden_rules[ctx.guild.id][name]
@@ -707,23 +799,16 @@ class StaffTools(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
         except InvalidRule:
             return await ctx.send("That rule is not meant to be run in manual mode.")
 
-        targets = []
-
         async with ctx.typing():
-            async for m in AsyncIter(ctx.guild.members, steps=2):
-                if m.bot:
-                    continue
-                if m.joined_at is None:
-                    continue
-                rank = await self.rank_user(m)
-                if await rule.satisfies_conditions(rank=rank, user=m, cog=self, guild=m.guild):
-                    targets.append(m)
+            members = await prefilter_members(rule, MemberSnapshot(ctx.guild))
+            predicate = rule_predicate(self, rule, ctx.guild)
+            estimate = await estimate_affected(members, predicate)
 
-        if len(targets) == 0:
+        if estimate.exact and estimate.affected == 0:
             return await ctx.send("No user can be affected by this rule.")
 
         msg = await ctx.send(
-            f"**{len(targets)} users** will be affected by this rule. "
+            f"**{estimate.describe()}** will be affected by this rule. "
             "Are you sure you want to continue? React to confirm."
         )
 
@@ -736,6 +821,19 @@ class StaffTools(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
         except asyncio.TimeoutError:
             return await ctx.send("Not proceeding with execution.")
 
+        if estimate.exact:
+            targets = estimate.matches
+        else:
+            progress_msg = await ctx.send(f"Finding the affected users... 0/{len(members)}")
+
+            async def progress(evaluated, total):
+                await progress_msg.edit(content=f"Finding the affected users... {evaluated}/{total}")
+
+            targets = await find_affected(members, predicate, progress=progress)
+            await progress_msg.edit(content=f"Found **{len(targets)} users** affected by this rule.")
+            if not targets:
+                return
+
         errors = 0
         async with ctx.typing():
             async for m in AsyncIter(targets, steps=2):
@@ -828,7 +926,7 @@ class StaffTools(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
         have any effect outside this test.
         Remember that Warden evaluates each condition in order and stops at the first failed
         root condition: the last condition that is listed in a failed rule is where Warden
-        stopped evaluating them.
+        stopped evaluating them. Each statement is listed with the time it took.
         If a valid Rank is also passed it will be used in place of the target's real
         rank during the test.
         See the documentation for a full list of Warden events.
@@ -886,11 +984,11 @@ class StaffTools(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
             text += f"**{i}. {result.rule_name}** "
             if result.last_result is True:
                 text += "(Passed)\n"
-            elif not result.trace:
+            elif not result.tracer:
                 text += "(Failed rank check)\n"
             else:
                 text += "(Failed)\n"
-                trace = "\n".join(result.trace)
+                trace = "\n".join(result.tracer.render(timings=True))
                 text += f"{box(trace)}"
         text += "\nIf you want to empty Warden's sandbox memory, say `free` in the next 10 seconds."
 
@@ -908,6 +1006,49 @@ class StaffTools(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
             heat.empty_state(ctx.guild, debug=True)
             await message.add_reaction("✅")
 
+    @wardengroup.command(name="profile")
+    async def wardengroupprofile(self, ctx: commands.Context, name: str, percent: float = None):
+        """Profiles the statements of a rule
+
+        While a rule is being profiled, a fraction of its evaluations is timed statement
+        by statement. Start profiling a rule by passing the percentage of its evaluations to
+        time, then run the command with just the rule's name to see the timings collected so far.
+        A percentage of 0 stops profiling the rule. Profiling also stops when the rule is
+        edited or reloaded.
+
+        Example:
+        [p]def warden profile my-rule 5
+        [p]def warden profile my-rule"""
+        rule = self.active_warden_rules[ctx.guild.id].get(name.lower())
+        if rule is None:
+            return await ctx.send("There is no rule with that name.")
+
+        if percent is not None:
+            if percent == 0:
+                rule.profile = None
+                return await ctx.send("The rule is not being profiled anymore.")
+            if not 0 < percent <= 100:
+                return await ctx.send("The percentage must be between 0 and 100.")
+            rule.profile = RuleProfile(percent / 100)
+            return await ctx.send(
+                f"{percent:g}% of the evaluations of the rule will be profiled. "
+                f"Check the timings with `{ctx.prefix}def warden profile {rule.name}`."
+            )
+
+        profile = rule.profile
+        if profile is None:
+            return await ctx.send(
+                "This rule is not being profiled. Start profiling it with "
+                f"`{ctx.prefix}def warden profile {rule.name} {DEFAULT_PROFILE_RATE}`."
+            )
+        if not profile.samples:
+            return await ctx.send("None of the evaluations of this rule have been profiled yet.")
+
+        text = f"Timings from {profile.samples} profiled evaluations ({profile.rate * 100:g}% sampled)\n\n"
+        text += "\n".join(profile.render(rule))
+        for p in pagify(text, delims=["\n"], page_length=1900):
+            await ctx.send(box(p))
+
     @wardengroup.command(name="find", aliases=["search"])
     async def wardengroupfind(self, ctx: commands.Context, *, text: str):
         """Search for text in existing rules"""
@@ -19,13 +19,13 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from ..abc import MixinMeta, CompositeMetaClass
 from redbot.core.utils.chat_formatting import box, humanize_list
-from redbot.core.utils.common_filters import INVITE_URL_RE
 from ..abc import CompositeMetaClass
 from ..enums import Action
 from ..core.menus import QAView
 from ..core import cache as df_cache
 from ..core.utils import get_external_invite, ACTIONS_VERBS, utcnow, timestamp
 from ..core.warden import heat
+from ..core.features import get_features
 from .utils import timestamp
 from io import BytesIO
 from collections import namedtuple, OrderedDict, defaultdict, deque
@@ -53,7 +53,7 @@ class AutoModules(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
             {"name": "频道", "value": message.channel.mention},
         ]
 
-        result = INVITE_URL_RE.findall(message.content)
+        result = get_features(message).invites
 
         if not result:
             return
@@ -18,13 +18,15 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from ..abc import MixinMeta, CompositeMetaClass
 from ..enums import Action, Rank, QAAction
 from ..core.warden.enums import Event as WardenEvent, ChecksKeys as WDChecksKeys
-from ..core.warden.rule import WardenRule
-from ..core.warden import api as WardenAPI
+from ..core.warden.rule import WardenRule, ConditionMemo
+from ..core.warden.scheduler import running_time
+from ..core.warden import api as WardenAPI, stats as rule_stats, names as wd_names
 from ..core.utils import QUICK_ACTION_EMOJIS, utcnow
-from ..exceptions import ExecutionError, MisconfigurationError
+from ..exceptions import ExecutionError, MisconfigurationError, EventDropped
 from . import cache as df_cache
 from redbot.core import commands
 from discord import MessageType
+from typing import Optional
 import discord
 import logging
 import asyncio
@@ -35,6 +37,127 @@ log = logging.getLogger("red.x26cogs.defender")
 
 
 class Events(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
+    async def dispatch_warden_event(
+        self,
+        guild: discord.Guild,
+        event: WardenEvent,
+        *,
+        rank: Rank,
+        user: Optional[discord.Member] = None,
+        message: Optional[discord.Message] = None,
+        reaction: Optional[discord.Reaction] = None,
+        role: Optional[discord.Role] = None,
+    ) -> bool:
+        """Evaluates the Warden rules of an event, returns whether the user has been expelled"""
+        expelled = False
+        ruleset = self.active_warden_rules.get(guild.id)
+        if not ruleset:
+            return expelled
+
+        channel = message.channel if message else None
+        if isinstance(channel, discord.Thread):
+            channel = channel.parent
+        user_id = user.id if user else None
+        channel_id = message.channel.id if message else None
+        category_id = getattr(channel, "category_id", None)
+        rules = ruleset.candidates(event, rank=rank, user_id=user_id, channel_id=channel_id, category_id=category_id)
+
+        rules = [
+            r for r in rules if r.admits(event, rank, user_id=user_id, channel_id=channel_id, category_id=category_id)
+        ]
+        if not rules:
+            return expelled
+
+        memo = ConditionMemo()
+        ctx = {"guild": guild, "message": message, "user": user, "reaction": reaction, "role": role}
+        rule: WardenRule
+
+        concurrent = len(rules) > 1 and await self.config.guild(guild).warden_concurrent_eval()
+        # A message to the user queued by a rule would otherwise reach them after another rule has expelled them
+        defer = not any(r.expels for r in rules)
+        # The time rule evaluation spends running is subject to the guild's time budget, actions aren't
+        try:
+            async with self.wd_scheduler.turn(guild) as turn:
+                if concurrent:
+                    # Conditions of all the rules are evaluated at once, then the actions of the rules
+                    # that passed are run in priority order. Conditions won't observe the actions of
+                    # rules with a higher priority
+                    semaphore = self.wd_eval_semaphores[guild.id]
+
+                    async def evaluate(rule: WardenRule):
+                        async with semaphore:
+                            return await self.evaluate_warden_rule(rule, rank=rank, memo=memo, **ctx)
+
+                    results = await asyncio.gather(*(turn.run(evaluate(r)) for r in rules))
+                    turn.release()
+                    for rule, result in zip(rules, results):
+                        if result and await self.run_warden_actions(rule, defer=defer, **ctx):
+                            expelled = True
+                            break  # The rules with a lower priority don't act on an expelled user
+                else:
+                    for rule in rules:
+                        if turn.exceeded():
+                            await turn.pause()
+                        if await turn.run(self.evaluate_warden_rule(rule, rank=rank, memo=memo, **ctx)):
+                            memo.clear()  # Actions may change what the conditions of the next rules observe
+                            turn.release()
+                            if await self.run_warden_actions(rule, defer=defer, **ctx):
+                                expelled = True
+                                break
+                            await turn.acquire()
+        except EventDropped:
+            pass  # Too many events of the guild are waiting to be evaluated, the staff is told
+
+        return expelled
+
+    async def evaluate_warden_rule(
+        self,
+        rule: WardenRule,
+        *,
+        guild: discord.Guild,
+        rank: Rank,
+        memo: Optional[ConditionMemo] = None,
+        throttle=True,
+        **ctx,
+    ) -> bool:
+        """Evaluates the conditions of a rule, keeping track of its stats and throttling it if it's too expensive"""
+        stats = self.wd_stats.get(guild.id, rule.name)
+        if throttle:
+            event_source = ctx.get("message") or ctx.get("user") or ctx.get("role")
+            if not stats.should_evaluate(event_source.id if event_source else None):
+                return False
+        # Only the time spent running counts, not the time other tasks ran while conditions were waiting
+        passed, spent = await running_time(
+            rule.satisfies_conditions(cog=self, rank=rank, guild=guild, memo=memo, **ctx)
+        )
+        stats.record_evaluation(spent, passed)
+        if throttle and stats.check_throttle():
+            reason = (
+                f"has taken {stats.rolling_average_time * 1000:.1f}ms on average to be evaluated, over the "
+                f"limit of {rule_stats.THROTTLE_THRESHOLD}ms"
+            )
+            await rule_stats.save_rule_stats(self, guild, rule.name, stats)
+            await rule_stats.notify_throttled_rule(self, guild, rule.name, stats, reason=reason)
+        return passed
+
+    async def run_warden_actions(self, rule: WardenRule, *, guild: discord.Guild, defer=True, **ctx) -> bool:
+        """Runs the actions of a rule, returns whether the user has been expelled"""
+        stats = self.wd_stats.get(guild.id, rule.name)
+        try:
+            wd_expelled = await rule.do_actions(cog=self, guild=guild, defer=defer, **ctx)
+            stats.record_actions(utcnow().timestamp(), failed=False)
+            if wd_expelled:
+                await asyncio.sleep(0.1)
+                return True
+        except (discord.Forbidden, discord.HTTPException, ExecutionError) as e:
+            stats.record_actions(utcnow().timestamp(), failed=True)
+            self.send_to_monitor(guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}")
+        except Exception as e:
+            stats.record_actions(utcnow().timestamp(), failed=True)
+            self.send_to_monitor(guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}")
+            log.error("Warden - unexpected error during actions execution", exc_info=e)
+        return False
+
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
         author = message.author
@@ -62,7 +185,6 @@ class Events(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
 
         is_staff = False
         expelled = False
-        wd_expelled = False
         rank = await self.rank_user(author)
 
         if rank == Rank.Rank1:
@@ -70,29 +192,10 @@ class Events(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
                 is_staff = True
                 await self.refresh_staff_activity(guild)
 
-        rule: WardenRule
         if await self.config.guild(guild).warden_enabled():
-            rules = self.get_warden_rules_by_event(guild, WardenEvent.OnMessage)
-            for rule in rules:
-                if await rule.satisfies_conditions(
-                    cog=self, rank=rank, guild=message.guild, message=message, user=message.author
-                ):
-                    try:
-                        wd_expelled = await rule.do_actions(
-                            cog=self, guild=message.guild, message=message, user=message.author
-                        )
-                        if wd_expelled:
-                            expelled = True
-                            await asyncio.sleep(0.1)
-                    except (discord.Forbidden, discord.HTTPException, ExecutionError) as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                    except Exception as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                        log.error("Warden - unexpected error during actions execution", exc_info=e)
+            expelled = await self.dispatch_warden_event(
+                guild, WardenEvent.OnMessage, rank=rank, message=message, user=message.author
+            )
 
         if expelled:
             return
@@ -190,7 +293,6 @@ class Events(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
 
         is_staff = False
         expelled = False
-        wd_expelled = False
         rank = await self.rank_user(author)
 
         if rank == Rank.Rank1:
@@ -198,27 +300,10 @@ class Events(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
                 is_staff = True
                 await self.refresh_staff_activity(guild)
 
-        rule: WardenRule
         if await self.config.guild(guild).warden_enabled():
-            rules = self.get_warden_rules_by_event(guild, WardenEvent.OnMessageEdit)
-            for rule in rules:
-                if await rule.satisfies_conditions(
-                    cog=self, rank=rank, guild=guild, message=message, user=message.author
-                ):
-                    try:
-                        wd_expelled = await rule.do_actions(cog=self, guild=guild, message=message, user=message.author)
-                        if wd_expelled:
-                            expelled = True
-                            await asyncio.sleep(0.1)
-                    except (discord.Forbidden, discord.HTTPException, ExecutionError) as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                    except Exception as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                        log.error("Warden - unexpected error during actions execution", exc_info=e)
+            expelled = await self.dispatch_warden_event(
+                guild, WardenEvent.OnMessageEdit, rank=rank, message=message, user=message.author
+            )
 
         if expelled:
             return
@@ -273,24 +358,10 @@ class Events(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
 
         rank = await self.rank_user(author)
 
-        rule: WardenRule
         if await self.config.guild(guild).warden_enabled():
-            rules = self.get_warden_rules_by_event(guild, WardenEvent.OnMessageDelete)
-            for rule in rules:
-                if await rule.satisfies_conditions(
-                    cog=self, rank=rank, guild=guild, message=message, user=message.author
-                ):
-                    try:
-                        await rule.do_actions(cog=self, guild=guild, message=message, user=message.author)
-                    except (discord.Forbidden, discord.HTTPException, ExecutionError) as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                    except Exception as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                        log.error("Warden - unexpected error during actions execution", exc_info=e)
+            await self.dispatch_warden_event(
+                guild, WardenEvent.OnMessageDelete, rank=rank, message=message, user=message.author
+            )
 
     @commands.Cog.listener()
     async def on_reaction_add(self, reaction: discord.Reaction, user: discord.Member):
@@ -301,31 +372,19 @@ class Events(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
 
         message = reaction.message
         guild = user.guild
-        rule: WardenRule
         if await self.config.guild(guild).warden_enabled():
             rank = await self.rank_user(user)
-            rules = self.get_warden_rules_by_event(guild, WardenEvent.OnReactionAdd)
-            for rule in rules:
-                if await rule.satisfies_conditions(
-                    cog=self, rank=rank, guild=guild, message=message, user=user, reaction=reaction
-                ):
-                    try:
-                        await rule.do_actions(cog=self, guild=guild, message=message, user=user, reaction=reaction)
-                    except (discord.Forbidden, discord.HTTPException, ExecutionError) as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                    except Exception as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                        log.error("Warden - unexpected error during actions execution", exc_info=e)
+            await self.dispatch_warden_event(
+                guild, WardenEvent.OnReactionAdd, rank=rank, message=message, user=user, reaction=reaction
+            )
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
         if member.bot:
             return
 
+        self.wd_dirty.mark(member)
+
         guild = member.guild
         if await self.bot.cog_disabled_in_guild(self, guild):  # type: ignore
             return
@@ -333,22 +392,8 @@ class Events(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
             return
 
         if await self.config.guild(guild).warden_enabled():
-            rule: WardenRule
-            rules = self.get_warden_rules_by_event(guild, WardenEvent.OnUserJoin)
-            for rule in rules:
-                rank = await self.rank_user(member)
-                if await rule.satisfies_conditions(cog=self, rank=rank, guild=guild, user=member):
-                    try:
-                        await rule.do_actions(cog=self, guild=guild, user=member)
-                    except (discord.Forbidden, discord.HTTPException, ExecutionError) as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                    except Exception as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                        log.error("Warden - unexpected error during actions execution", exc_info=e)
+            rank = await self.rank_user(member)
+            await self.dispatch_warden_event(guild, WardenEvent.OnUserJoin, rank=rank, user=member)
 
         if await self.config.guild(guild).join_monitor_enabled():
             if await WardenAPI.eval_check(guild=guild, module=WDChecksKeys.JoinMonitor, user=member):
@@ -367,26 +412,15 @@ class Events(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
             return
 
         if await self.config.guild(guild).warden_enabled():
-            rule: WardenRule
-            rules = self.get_warden_rules_by_event(guild, WardenEvent.OnUserLeave)
-            for rule in rules:
-                rank = await self.rank_user(member)
-                if await rule.satisfies_conditions(cog=self, rank=rank, guild=guild, user=member):
-                    try:
-                        await rule.do_actions(cog=self, guild=guild, user=member)
-                    except (discord.Forbidden, discord.HTTPException, ExecutionError) as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                    except Exception as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                        log.error("Warden - unexpected error during actions execution", exc_info=e)
+            rank = await self.rank_user(member)
+            await self.dispatch_warden_event(guild, WardenEvent.OnUserLeave, rank=rank, user=member)
 
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member):
         guild = after.guild
+        if before.roles != after.roles or before.nick != after.nick:
+            self.wd_dirty.mark(after)
+
         if await self.bot.cog_disabled_in_guild(self, guild):  # type: ignore
             return
         if not await self.config.guild(guild).enabled():
@@ -403,19 +437,46 @@ class Events(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
         else:
             return
 
-        rule: WardenRule
         event = WardenEvent.OnRoleRemove if removed else WardenEvent.OnRoleAdd
-        rules = self.get_warden_rules_by_event(guild, event)
-        for rule in rules:
-            rank = await self.rank_user(after)
-            if await rule.satisfies_conditions(cog=self, rank=rank, guild=guild, user=after, role=role):
-                try:
-                    await rule.do_actions(cog=self, guild=guild, user=after, role=role)
-                except (discord.Forbidden, discord.HTTPException, ExecutionError) as e:
-                    self.send_to_monitor(guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}")
-                except Exception as e:
-                    self.send_to_monitor(guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}")
-                    log.error("Warden - unexpected error during actions execution", exc_info=e)
+        rank = await self.rank_user(after)
+        await self.dispatch_warden_event(guild, event, rank=rank, user=after, role=role)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: discord.User, after: discord.User):
+        if before.name != after.name or before.avatar != after.avatar:
+            self.wd_dirty.mark_user(after)
+
+    # Names of roles, channels and categories are indexed for Warden: any change that could
+    # affect which one a name stands for drops the index
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role: discord.Role):
+        wd_names.invalidate(role.guild, wd_names.ROLES)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        wd_names.invalidate(role.guild, wd_names.ROLES)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        if before.name != after.name or before.position != after.position:
+            wd_names.invalidate(after.guild, wd_names.ROLES)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel: discord.abc.GuildChannel):
+        wd_names.invalidate(channel.guild, *wd_names.CHANNELS)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        wd_names.invalidate(channel.guild, *wd_names.CHANNELS)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        if before.name != after.name or before.position != after.position:
+            wd_names.invalidate(after.guild, *wd_names.CHANNELS)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        wd_names.discard_names(guild.id)
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
@@ -527,25 +588,11 @@ class Events(MixinMeta, metaclass=CompositeMetaClass):  # type: ignore
 
         message = reaction.message
         guild = user.guild
-        rule: WardenRule
         if await self.config.guild(guild).warden_enabled():
             rank = await self.rank_user(user)
-            rules = self.get_warden_rules_by_event(guild, WardenEvent.OnReactionRemove)
-            for rule in rules:
-                if await rule.satisfies_conditions(
-                    cog=self, rank=rank, guild=guild, message=message, user=user, reaction=reaction
-                ):
-                    try:
-                        await rule.do_actions(cog=self, guild=guild, message=message, user=user, reaction=reaction)
-                    except (discord.Forbidden, discord.HTTPException, ExecutionError) as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                    except Exception as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-                        log.error("Warden - unexpected error during actions execution", exc_info=e)
+            await self.dispatch_warden_event(
+                guild, WardenEvent.OnReactionRemove, rank=rank, message=message, user=user, reaction=reaction
+            )
 
     @commands.Cog.listener()
     async def on_x26_defender_emergency(self, guild: discord.Guild):
@@ -0,0 +1,241 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from redbot.core.utils.common_filters import INVITE_URL_RE
+from collections import OrderedDict
+from functools import cached_property, lru_cache
+from typing import Dict, FrozenSet, List, Optional, Pattern, Tuple
+from urllib.parse import urlsplit
+import discord
+import emoji
+import regex as re
+import re as std_re
+
+try:
+    from emoji.tokenizer import EmojiMatch, tokenize
+except ImportError:  # emoji 1.x
+    LEGACY_EMOJI = True
+else:
+    LEGACY_EMOJI = False
+
+"""
+Several automodules and Warden conditions look for the same things in a message: invites,
+links, emojis, mentions, words. Rather than scanning the content again for each of them,
+and for each rule, every message gets a MessageFeatures object that is shared by all of them.
+Each feature is only computed the first time it's asked for: most messages never get their
+links looked at. The link features are computed together in a single scan, which is skipped
+altogether for messages that don't contain a slash, as none of those patterns can match then.
+
+Unicode emojis are counted the same way emoji.emoji_count does, without going through its
+pure Python tokenizer: a matcher is compiled for each character an emoji can start with,
+from the subtree of the emoji database that starts with it, and only the characters in the
+ranges emojis start in are looked at. Counting stops once the limit asked for is reached.
+Both the way emoji 1.x finds emojis and the way 2.x does are reproduced. Emojis joined by a
+ZWJ are the exception on 2.x: its tokenizer handles those in its own way, so messages that
+contain one still go through it.
+"""
+
+# Based on d.py's EmojiConverter
+# https://github.com/Rapptz/discord.py/blob/master/discord/ext/commands/converter.py
+EMOJI_RE = re.compile(r"<a?:[a-zA-Z0-9\_]+:([0-9]+)>")
+REMOVE_C_EMOJIS_RE = re.compile(r"<a?:[a-zA-Z0-9\_]+:[0-9]+>")
+MEDIA_URL_RE = re.compile(r"""(http)?s?:?(\/\/[^"']*\.(?:png|jpg|jpeg|gif|png|svg|mp4|gifv))""", re.I)
+URL_RE = re.compile(
+    r"""https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*)""", re.I
+)
+FEATURES_CACHE_SIZE = 256  # Messages whose features are kept around, for the events that follow
+ZWJ = "\u200d"
+CANDIDATE_RANGE_GAP = 16  # Emoji starting characters this close are merged into a single range
+
+
+def _subtree_pattern(node: dict) -> str:
+    alternatives = []
+    for char, child in sorted(node.items()):
+        if char == "":
+            continue
+        if len(child) == 1 and "" in child:
+            alternatives.append(std_re.escape(char))
+        elif LEGACY_EMOJI:
+            alternatives.append(f"{std_re.escape(char)}(?:{_subtree_pattern(child)})")
+        else:
+            # Longest match first, falling back to the shorter emoji if there is one
+            optional = "?" if "" in child else ""
+            alternatives.append(f"{std_re.escape(char)}(?:{_subtree_pattern(child)}){optional}")
+    if LEGACY_EMOJI and "" in node:
+        # emoji 1.x walks the tree as far as it goes: it only stops at an emoji if it can't go further
+        alternatives.append(f"(?![{''.join(std_re.escape(c) for c in node if c)}])")
+    return "|".join(alternatives)
+
+
+@lru_cache(maxsize=None)
+def _emoji_matchers() -> Tuple[Pattern, Dict[str, Pattern]]:
+    """Built on first use, it takes a fraction of a second"""
+    trie = {}
+    for e in emoji.EMOJI_DATA:
+        node = trie
+        for char in e:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    matchers = {char: std_re.compile(_subtree_pattern({char: child})) for char, child in trie.items()}
+
+    ranges = []
+    for code in sorted(ord(c) for c in trie):
+        if ranges and code - ranges[-1][1] <= CANDIDATE_RANGE_GAP:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    candidates = "".join(f"{std_re.escape(chr(a))}-{std_re.escape(chr(b))}" for a, b in ranges)
+    return std_re.compile(f"[{candidates}]"), matchers
+
+
+def count_unicode_emojis(text: str, limit: Optional[int] = None) -> int:
+    """The same as emoji.emoji_count, or limit if there are at least that many"""
+    if text.isascii():
+        return 0
+    count = 0
+    if ZWJ in text and not LEGACY_EMOJI:
+        for token in tokenize(text, keep_zwj=False):
+            if isinstance(token.value, EmojiMatch):
+                count += 1
+                if count == limit:
+                    break
+        return count
+
+    candidates, matchers = _emoji_matchers()
+    pos = 0
+    while True:
+        candidate = candidates.search(text, pos)
+        if candidate is None:
+            return count
+        i = candidate.start()
+        matcher = matchers.get(text[i])
+        match = matcher.match(text, i) if matcher is not None else None
+        if match is None:
+            pos = i + 1
+            continue
+        count += 1
+        if count == limit:
+            return count
+        pos = match.end()
+
+
+class MessageFeatures:
+    def __init__(self, message: discord.Message):
+        self.message = message
+        self.content: str = message.content
+
+    @cached_property
+    def _links(self) -> Tuple[List[tuple], List[str], bool]:
+        content = self.content
+        if "/" not in content:
+            return [], [], False
+        invites = INVITE_URL_RE.findall(content)
+        urls = [m.group(0) for m in URL_RE.finditer(content)]
+        has_media = MEDIA_URL_RE.search(content) is not None
+        return invites, urls, has_media
+
+    @property
+    def invites(self) -> List[tuple]:
+        """The same as INVITE_URL_RE.findall"""
+        return self._links[0]
+
+    @property
+    def urls(self) -> List[str]:
+        return self._links[1]
+
+    @property
+    def has_media(self) -> bool:
+        return self._links[2]
+
+    @cached_property
+    def domains(self) -> FrozenSet[str]:
+        domains = set()
+        for url in self.urls:
+            try:
+                domain = urlsplit(url).hostname
+            except ValueError:
+                continue
+            if domain:
+                domains.add(domain.lower())
+        return frozenset(domains)
+
+    @cached_property
+    def unicode_emoji_count(self) -> int:
+        return count_unicode_emojis(self.content)
+
+    @cached_property
+    def custom_emoji_count(self) -> int:
+        if "<" not in self.content:  # No need to run a regex if no custom emoji can be present
+            return 0
+        return len(EMOJI_RE.findall(self.content))
+
+    def has_x_or_more_emojis(self, limit: int) -> bool:
+        if "unicode_emoji_count" in self.__dict__:
+            unicode_count = self.unicode_emoji_count
+        else:  # No need to count them all
+            unicode_count = count_unicode_emojis(self.content, limit)
+        if unicode_count >= limit:
+            return True
+        return unicode_count + self.custom_emoji_count >= limit
+
+    # discord.py already parses the mentions once per message
+    @property
+    def mention_count(self) -> int:
+        return len(self.message.raw_mentions)
+
+    @property
+    def unique_mention_count(self) -> int:
+        return len(set(self.message.mentions))
+
+    @property
+    def role_mention_count(self) -> int:
+        return len(self.message.role_mentions)
+
+    @cached_property
+    def clean_content(self) -> str:
+        return self.message.clean_content
+
+    @cached_property
+    def char_count(self) -> int:
+        """Characters of the clean content, with each custom emoji counted as one"""
+        return len(REMOVE_C_EMOJIS_RE.sub("x", self.clean_content))
+
+    @cached_property
+    def lower(self) -> str:
+        return self.content.lower()
+
+    @cached_property
+    def tokens(self) -> FrozenSet[str]:
+        """The lowercase, whitespace separated words"""
+        return frozenset(self.lower.split())
+
+
+_features: "OrderedDict[int, MessageFeatures]" = OrderedDict()
+
+
+def get_features(message: discord.Message) -> MessageFeatures:
+    features = _features.get(message.id)
+    if features is not None and features.message is message and features.content == message.content:
+        _features.move_to_end(message.id)
+        return features
+    # Edited, or a different copy of the message: start over
+    features = _features[message.id] = MessageFeatures(message)
+    _features.move_to_end(message.id)
+    if len(_features) > FEATURES_CACHE_SIZE:
+        _features.popitem(last=False)
+    return features
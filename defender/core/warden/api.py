@@ -98,8 +98,12 @@ async def load_modules_checks():
                 if raw_check is None:
                     continue
                 n += 1
-                wd_check = WardenCheck()
-                await wd_check.parse(raw_check, cog=cog, module=key)
+                kind = f"check:{key.value}"
+                wd_check = cog.wd_rule_cache.get(kind, raw_check)
+                if wd_check is None:
+                    wd_check = WardenCheck()
+                    await wd_check.parse(raw_check, cog=cog, module=key)
+                    cog.wd_rule_cache.put(kind, wd_check)
                 cog.warden_checks[int(guid)][key] = wd_check
 
             await asyncio.sleep(0)
@@ -0,0 +1,167 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from ..utils import utcnow
+from typing import TYPE_CHECKING, Awaitable, Callable, List, Optional
+import discord
+import asyncio
+import heapq
+import random
+import math
+import time
+
+if TYPE_CHECKING:
+    from .rule import WardenRule
+
+"""
+Before a rule is run against a whole guild the staff is told how many members it would
+affect. The members ruled out by the prefilter are known not to be, but evaluating the rule
+on each of the others can take minutes on a large guild: within a time budget the rule is
+evaluated on a random sample instead, and the count is estimated from it with a 95%
+confidence interval. Small guilds are simply evaluated in full.
+The sample is stratified by how long ago members joined, as most rules that target
+members in bulk do so by their join date: each group is sampled in proportion to its size
+and the estimate is the sum of the estimates of each group.
+"""
+
+STRATA_BOUNDS = (60 * 60, 60 * 60 * 24, 60 * 60 * 24 * 7, 60 * 60 * 24 * 30, 60 * 60 * 24 * 365)  # Seconds
+ESTIMATE_BUDGET = 5  # Seconds of evaluation before settling for an estimate
+PROGRESS_INTERVAL = 5  # Seconds between progress updates of a full count
+Z_95 = 1.96
+
+Predicate = Callable[[discord.Member], Awaitable[bool]]
+
+
+class ImpactEstimate:
+    __slots__ = ("population", "evaluated", "matches", "estimate", "low", "high")
+
+    def __init__(
+        self, population: int, evaluated: int, matches: List[discord.Member], estimate: float, low: float, high: float
+    ):
+        self.population = population
+        self.evaluated = evaluated
+        self.matches = matches  # Every affected member when exact
+        self.estimate = round(estimate)
+        self.low = math.floor(low)
+        self.high = math.ceil(high)
+
+    @property
+    def affected(self) -> int:
+        return len(self.matches)
+
+    @property
+    def exact(self) -> bool:
+        return self.evaluated == self.population
+
+    def describe(self) -> str:
+        if self.exact:
+            return f"{self.affected} users"
+        return (
+            f"about {self.estimate} users (between {self.low} and {self.high} with 95% confidence, "
+            f"estimated from {self.evaluated} of {self.population} possible targets)"
+        )
+
+
+def rule_predicate(cog, rule: WardenRule, guild: discord.Guild) -> Predicate:
+    async def predicate(member: discord.Member) -> bool:
+        rank = await cog.rank_user(member)
+        return await rule.satisfies_conditions(rank=rank, user=member, guild=guild, cog=cog)
+
+    return predicate
+
+
+def stratify(members: List[discord.Member]) -> List[List[discord.Member]]:
+    now = utcnow().timestamp()
+    strata = [[] for _ in range(len(STRATA_BOUNDS) + 1)]
+    for m in members:
+        age = now - m.joined_at.timestamp()
+        strata[next((i for i, bound in enumerate(STRATA_BOUNDS) if age < bound), len(STRATA_BOUNDS))].append(m)
+    return [s for s in strata if s]
+
+
+async def estimate_affected(
+    members: List[discord.Member], predicate: Predicate, *, budget=ESTIMATE_BUDGET, clock=time.perf_counter
+) -> ImpactEstimate:
+    """Evaluates members until the budget runs out, or they have all been evaluated"""
+    strata = stratify(members)
+    for stratum in strata:
+        random.shuffle(stratum)
+    sampled = [0] * len(strata)
+    hits = [0] * len(strata)
+    matches = []
+    # Proportional allocation: the next member comes from the stratum that is the furthest behind
+    heap = [(0.5 / len(stratum), i) for i, stratum in enumerate(strata)]
+    heapq.heapify(heap)
+
+    started = clock()
+    while heap:
+        _, i = heapq.heappop(heap)
+        stratum = strata[i]
+        member = stratum[sampled[i]]
+        if await predicate(member):
+            hits[i] += 1
+            matches.append(member)
+        sampled[i] += 1
+        if sampled[i] < len(stratum):
+            heapq.heappush(heap, ((sampled[i] + 0.5) / len(stratum), i))
+        if sampled[i] % 2 == 0:
+            await asyncio.sleep(0)
+        if clock() - started >= budget:
+            break
+
+    population = len(members)
+    evaluated = sum(sampled)
+    overall = (len(matches) + 1) / (evaluated + 2)
+    estimate = low = high = 0.0
+    for stratum, n, x in zip(strata, sampled, hits):
+        size = len(stratum)
+        if n == 0:  # Nothing is known about this group
+            estimate += size * overall
+            high += size
+            continue
+        estimate += size * x / n
+        # Smoothed, so that a sample without hits doesn't claim there are none for certain
+        p = (x + 1) / (n + 2)
+        variance = size**2 * p * (1 - p) / n * (1 - n / size)
+        margin = Z_95 * math.sqrt(variance)
+        low += max(x, size * x / n - margin)
+        high += min(size - (n - x), size * x / n + margin)
+
+    return ImpactEstimate(population, evaluated, matches, estimate, low, high)
+
+
+async def find_affected(
+    members: List[discord.Member],
+    predicate: Predicate,
+    *,
+    progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+    interval=PROGRESS_INTERVAL,
+    clock=time.monotonic,
+) -> List[discord.Member]:
+    """Evaluates every member. Progress is reported every interval seconds as (evaluated, total)"""
+    affected = []
+    last_report = clock()
+    for i, m in enumerate(members, start=1):
+        if await predicate(m):
+            affected.append(m)
+        if i % 2 == 0:
+            await asyncio.sleep(0)
+        if progress is not None and clock() - last_report >= interval:
+            last_report = clock()
+            await progress(i, len(members))
+    return affected
@@ -0,0 +1,186 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from .enums import Action
+from ...exceptions import ExecutionError
+from collections import Counter
+from functools import partial
+from typing import TYPE_CHECKING, Awaitable, Callable, Collection, Dict, Set, Tuple
+import discord
+import asyncio
+import logging
+
+if TYPE_CHECKING:
+    from ...abc import MixinMeta
+
+"""
+Warden actions that are side effects nobody downstream waits on (staff notifications, messages,
+modlog cases, role changes) don't need to hold back the listener that triggered them.
+They are queued per route, mirroring Discord's rate limit buckets, and each route is drained by
+its own worker: a route being rate limited only delays the actions on that same route.
+Queues are bounded, when a route is flooded the newest actions are dropped and the staff is
+told how many were lost. Role changes have a route per guild, and those pending for the same
+member are merged into a single request. Until they're applied, role checks see the roles the
+member will have once they are.
+Rules that expel the user or check roles after changing them don't defer anything, see
+WardenRule.defers_actions.
+"""
+
+ROUTE_QUEUE_SIZE = 50
+
+log = logging.getLogger("red.x26cogs.defender")
+
+
+class RoleChanges:
+    __slots__ = ("member", "add", "remove", "rules")
+
+    def __init__(self, member: discord.Member):
+        self.member = member
+        self.add: Set[discord.Role] = set()
+        self.remove: Set[discord.Role] = set()
+        self.rules: Set[str] = set()
+
+
+class ActionExecutor:
+    def __init__(self, cog: MixinMeta, *, queue_size=ROUTE_QUEUE_SIZE):
+        self.cog = cog
+        self.queue_size = queue_size
+        self.queues: Dict[tuple, asyncio.Queue] = {}
+        self.workers: Dict[tuple, asyncio.Task] = {}
+        self.pending_roles: Dict[Tuple[int, int], RoleChanges] = {}
+        self.applying_roles: Dict[Tuple[int, int], RoleChanges] = {}
+        self.dropped = Counter()
+
+    def submit(
+        self, route: tuple, guild: discord.Guild, rule_name: str, action: Action, func: Callable[[], Awaitable]
+    ) -> bool:
+        """Queues an action to be run in the background. Returns False if it had to be dropped"""
+        queue = self.queues.get(route)
+        if queue is None:
+            queue = self.queues[route] = asyncio.Queue(maxsize=self.queue_size)
+        try:
+            queue.put_nowait((guild, rule_name, action, func))
+        except asyncio.QueueFull:
+            self.dropped[guild.id] += 1
+            return False
+        if route not in self.workers:
+            self.workers[route] = asyncio.create_task(self._worker(route, queue))
+        return True
+
+    def change_roles(
+        self, guild: discord.Guild, member: discord.Member, rule_name: str, action: Action, *, add=(), remove=()
+    ):
+        """Queues role changes, merged with those still pending for the member. Roles the member
+        would already have, or not have, once the pending changes are applied are skipped"""
+        key = (guild.id, member.id)
+        changes = self.pending_roles.get(key)
+        if changes is None:
+            changes = RoleChanges(member)
+        current = self._applied_role_ids(key, member)
+        changed = False
+        for role in add:
+            if role in changes.remove:
+                changes.remove.discard(role)
+                changed = True
+            elif role.id not in current and role not in changes.add:
+                changes.add.add(role)
+                changed = True
+        for role in remove:
+            if role in changes.add:
+                changes.add.discard(role)
+                changed = True
+            elif role.id in current and role not in changes.remove:
+                changes.remove.add(role)
+                changed = True
+        if not changed:
+            return
+        if key not in self.pending_roles:
+            if not self.submit(("roles", guild.id), guild, rule_name, action, partial(self._apply_roles, key)):
+                return
+            self.pending_roles[key] = changes
+        changes.rules.add(rule_name)
+
+    def role_ids(self, guild: discord.Guild, member: discord.Member) -> Collection[int]:
+        """The IDs of the roles the member will have once their pending role changes are applied"""
+        key = (guild.id, member.id)
+        ids = self._applied_role_ids(key, member)
+        changes = self.pending_roles.get(key)
+        if changes is not None:
+            ids = _apply_changes(ids, changes)
+        return ids
+
+    def _applied_role_ids(self, key: Tuple[int, int], member: discord.Member) -> Collection[int]:
+        changes = self.applying_roles.get(key)
+        if changes is None:
+            return member._roles
+        return _apply_changes(member._roles, changes)
+
+    async def _apply_roles(self, key: Tuple[int, int]):
+        changes = self.pending_roles.pop(key, None)
+        if changes is None or (not changes.add and not changes.remove):
+            return
+        rules = ", ".join(f"'{r}'" for r in sorted(changes.rules))
+        rules = f"rule {rules}" if len(changes.rules) == 1 else f"rules {rules}"
+        self.applying_roles[key] = changes
+        try:
+            if changes.remove:
+                await changes.member.remove_roles(*changes.remove, reason=f"Unassigned by Warden {rules}")
+            if changes.add:
+                await changes.member.add_roles(*changes.add, reason=f"Assigned by Warden {rules}")
+        finally:
+            self.applying_roles.pop(key, None)
+
+    async def _worker(self, route: tuple, queue: asyncio.Queue):
+        try:
+            while True:
+                try:
+                    guild, rule_name, action, func = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                try:
+                    await func()
+                except (discord.Forbidden, discord.HTTPException, ExecutionError) as e:
+                    self.cog.send_to_monitor(guild, f"[Warden] Rule {rule_name} ({action.value}) - {str(e)}")
+                except Exception as e:
+                    self.cog.send_to_monitor(guild, f"[Warden] Rule {rule_name} ({action.value}) - {str(e)}")
+                    log.error("Warden - unexpected error during deferred action execution", exc_info=e)
+
+                dropped = self.dropped.pop(guild.id, 0)
+                if dropped:
+                    self.cog.send_to_monitor(
+                        guild, f"[Warden] {dropped} action(s) have been dropped: too many were queued at once."
+                    )
+        finally:
+            self.workers.pop(route, None)
+            if queue.empty():
+                self.queues.pop(route, None)
+
+    def close(self):
+        for task in self.workers.values():
+            task.cancel()
+        self.workers.clear()
+        self.queues.clear()
+        self.pending_roles.clear()
+        self.applying_roles.clear()
+
+
+def _apply_changes(role_ids: Collection[int], changes: RoleChanges) -> Set[int]:
+    ids = set(role_ids)
+    ids.difference_update(r.id for r in changes.remove)
+    ids.update(r.id for r in changes.add)
+    return ids
@@ -0,0 +1,164 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from .enums import Condition
+from .rule import WDCondition
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Tuple
+from bisect import bisect_right
+import datetime
+import discord
+import time
+
+if TYPE_CHECKING:
+    from .rule import WardenRule
+    from .prefilter import MemberSnapshot
+
+"""
+Periodic rules marked as incremental don't go through every member of the guild each time
+they run. Once a guild has incremental rules, the members that join, change roles, nickname
+or username, or become rank 3 by sending messages are marked as changed, and each run only
+evaluates the members marked since the previous one, plus the members that went past one of
+the rule's time thresholds in the meantime (for example, joined more than 2 hours ago).
+Those are found by bisecting the members sorted by join and creation date.
+Anything else that could change the outcome of the rule, such as its heat, is not tracked:
+the rule is still run against everyone every so often, as configured by the staff.
+"""
+
+TIME_CONDITIONS = {
+    Condition.UserJoinedLessThan: "joined_at",
+    Condition.UserCreatedLessThan: "created_at",
+}
+
+
+class ScanState:
+    __slots__ = ("rule", "last_run", "last_full_scan")
+
+    def __init__(self, rule: WardenRule, last_run: float, last_full_scan: float):
+        self.rule = rule
+        self.last_run = last_run
+        self.last_full_scan = last_full_scan
+
+
+class DirtyMembers:
+    """Members whose state changed, and when, for the guilds that have incremental rules"""
+
+    def __init__(self):
+        self.guilds: Dict[int, Dict[int, float]] = {}
+        self.scans: Dict[Tuple[int, str], ScanState] = {}
+
+    def is_tracked(self, guild_id: int) -> bool:
+        return guild_id in self.guilds
+
+    def mark(self, member: discord.Member):
+        marks = self.guilds.get(member.guild.id)
+        if marks is not None:
+            marks[member.id] = time.time()
+
+    def mark_user(self, user: discord.abc.User):
+        """Users are shared between guilds: they're marked in all of them, members or not"""
+        now = time.time()
+        for marks in self.guilds.values():
+            marks[user.id] = now
+
+    def changed_since(self, guild_id: int, timestamp: float) -> List[int]:
+        return [m for m, ts in self.guilds.get(guild_id, {}).items() if ts >= timestamp]
+
+    def begin_scan(self, guild_id: int, rule: WardenRule, *, rescan_interval: float) -> Optional[float]:
+        """Returns when the previous run of the rule started, or None if it's due a full scan"""
+        self.guilds.setdefault(guild_id, {})
+        state = self.scans.get((guild_id, rule.name))
+        if state is None or state.rule is not rule:
+            return None
+        if time.time() - state.last_full_scan >= rescan_interval:
+            return None
+        return state.last_run
+
+    def finish_scan(self, guild_id: int, rule: WardenRule, *, started: float, full: bool):
+        key = (guild_id, rule.name)
+        state = self.scans.get(key)
+        if full or state is None or state.rule is not rule:
+            self.scans[key] = ScanState(rule, started, started)
+        else:
+            state.last_run = started
+
+    def prune(self, guild_id: int, is_active: Callable[[WardenRule], bool]):
+        """Forgets the rules that are gone and the changes every rule has seen"""
+        states = []
+        for key, state in list(self.scans.items()):
+            if key[0] != guild_id:
+                continue
+            if is_active(state.rule):
+                states.append(state)
+            else:
+                del self.scans[key]
+
+        if not states:
+            self.guilds.pop(guild_id, None)
+            return
+
+        oldest = min(s.last_run for s in states)
+        marks = self.guilds.get(guild_id, {})
+        for member_id in [m for m, ts in marks.items() if ts < oldest]:
+            del marks[member_id]
+
+
+def get_time_thresholds(rule: WardenRule) -> List[Tuple[str, datetime.timedelta]]:
+    """The time conditions of a rule, anywhere in its conditions, as (column, timedelta)"""
+    thresholds = []
+    for statement, model in rule.iter_statements(rule.cond_tree):
+        if not isinstance(statement, WDCondition) or statement.enum not in TIME_CONDITIONS:
+            continue
+        if isinstance(model.value, int):
+            if model.value == 0:  # Always true
+                continue
+            delta = datetime.timedelta(hours=model.value)
+        else:
+            delta = model.value
+        thresholds.append((TIME_CONDITIONS[statement.enum], delta))
+    return thresholds
+
+
+async def get_changed_members(
+    rule: WardenRule,
+    snapshot: MemberSnapshot,
+    dirty: DirtyMembers,
+    since: float,
+    *,
+    extra_thresholds: Iterable[Tuple[str, datetime.timedelta]] = (),
+) -> List[discord.Member]:
+    """The members the outcome of the rule may have changed for since the timestamp"""
+    guild = snapshot.guild
+    now = time.time()
+    members: Dict[int, discord.Member] = {}
+
+    for member_id in dirty.changed_since(guild.id, since):
+        member = guild.get_member(member_id)
+        if member is not None and not member.bot and member.joined_at is not None:
+            members[member.id] = member
+
+    for column, delta in (*get_time_thresholds(rule), *extra_thresholds):
+        seconds = delta.total_seconds()
+        values, indexes = await snapshot.sorted_column(column)
+        # Those for which value + delta went from after the previous run to before this one
+        start = bisect_right(values, since - seconds)
+        end = bisect_right(values, now - seconds)
+        for i in indexes[start:end]:
+            member = snapshot.members[i]
+            members[member.id] = member
+
+    return list(members.values())
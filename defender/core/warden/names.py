@@ -0,0 +1,124 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from typing import Dict, FrozenSet, Iterable, Iterator, Optional, Tuple, Union
+import discord
+
+"""
+Rules can refer to roles, channels and categories by name as well as by ID. Rather than
+going through the guild's roles or channels looking for each name every time a rule is
+evaluated, each guild has indexes of names to IDs, and the IDs a list of names and IDs
+stands for are only worked out once. Like discord.utils.get, a name that is shared by more
+than one role or channel stands for the first one, in the order the guild lists them.
+An index is built the first time it's needed and dropped as soon as a role or channel of
+the guild is created, deleted, renamed or moved, along with everything worked out from it.
+"""
+
+ROLES = "roles"
+TEXT_CHANNELS = "text_channels"
+CATEGORIES = "categories"
+CHANNELS = (TEXT_CHANNELS, CATEGORIES)
+
+IdOrName = Union[int, str]
+
+
+class GuildNames:
+    __slots__ = ("guild", "indexes", "resolved")
+
+    def __init__(self, guild: discord.Guild):
+        self.guild = guild
+        self.indexes: Dict[str, Dict[str, int]] = {}
+        self.resolved: Dict[Tuple[str, Tuple[IdOrName, ...]], FrozenSet[int]] = {}
+
+    def index(self, kind: str) -> Dict[str, int]:
+        index = self.indexes.get(kind)
+        if index is None:
+            index = {}
+            for obj in getattr(self.guild, kind):
+                index.setdefault(obj.name, obj.id)  # The first one wins
+            self.indexes[kind] = index
+        return index
+
+    def get_id(self, kind: str, name: str) -> Optional[int]:
+        return self.index(kind).get(name)
+
+    def resolve(self, kind: str, values: Iterable[IdOrName]) -> FrozenSet[int]:
+        """The IDs a list of IDs and names stands for. Roles are matched by name only
+        if given as a string, channels and categories are also matched by the name
+        an ID would have as a string"""
+        values = tuple(values)
+        key = (kind, values)
+        ids = self.resolved.get(key)
+        if ids is None:
+            index = self.index(kind)
+            found = set()
+            for value in values:
+                if isinstance(value, int):
+                    found.add(value)
+                    if kind == ROLES:
+                        continue
+                name_id = index.get(str(value))
+                if name_id is not None:
+                    found.add(name_id)
+            ids = self.resolved[key] = frozenset(found)
+        return ids
+
+    def invalidate(self, *kinds: str):
+        for kind in kinds:
+            self.indexes.pop(kind, None)
+        self.resolved = {k: v for k, v in self.resolved.items() if k[0] not in kinds}
+
+
+_guilds: Dict[int, GuildNames] = {}
+
+
+def get_names(guild: discord.Guild) -> GuildNames:
+    names = _guilds.get(guild.id)
+    # A guild object is replaced when it's received again in full, such as after a reconnection
+    if names is None or names.guild is not guild:
+        names = _guilds[guild.id] = GuildNames(guild)
+    return names
+
+
+def invalidate(guild: discord.Guild, *kinds: str):
+    names = _guilds.get(guild.id)
+    if names is not None:
+        names.invalidate(*kinds)
+
+
+def discard_names(guild_id: Optional[int] = None):
+    if guild_id is None:
+        _guilds.clear()
+    else:
+        _guilds.pop(guild_id, None)
+
+
+def find_role(guild: discord.Guild, role_id_or_name: IdOrName) -> Optional[discord.Role]:
+    role = guild.get_role(role_id_or_name)
+    if role is None and isinstance(role_id_or_name, str):
+        role_id = get_names(guild).get_id(ROLES, role_id_or_name)
+        if role_id is not None:
+            role = guild.get_role(role_id)
+    return role
+
+
+def find_roles(guild: discord.Guild, values: Iterable[IdOrName]) -> Iterator[discord.Role]:
+    """The roles that exist among those a list of IDs and names stands for"""
+    for role_id in get_names(guild).resolve(ROLES, values):
+        role = guild.get_role(role_id)
+        if role is not None:
+            yield role
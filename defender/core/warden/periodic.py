@@ -0,0 +1,131 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from .enums import Event
+from ..utils import utcnow
+from typing import TYPE_CHECKING, Dict, List, Set, Tuple
+from itertools import count
+import heapq
+import random
+import asyncio
+import logging
+import time
+
+if TYPE_CHECKING:
+    from ...abc import MixinMeta
+    from .rule import WardenRule
+    from .ruleset import GuildRuleset
+
+"""
+Periodic rules are kept in a min heap ordered by when they are due next, and the scheduler
+sleeps until the first one is. Rulesets report their changes: rules that are added or replaced
+are pushed into the heap, while entries for rules that are no longer active are simply discarded
+when they come up. A rule edited while its previous version is still running waits for that
+run to end, being retried every so often.
+Each run is delayed by a small random amount, so that rules with the same interval in different
+guilds don't all fire in the same second.
+"""
+
+MAX_JITTER = 60  # Seconds
+JITTER_RATIO = 0.05  # ...but never more than this fraction of the rule's interval
+BUSY_RETRY_DELAY = 30  # Seconds before retrying a rule whose previous version is still running
+
+log = logging.getLogger("red.x26cogs.defender")
+
+
+class PeriodicScheduler:
+    def __init__(self, cog: MixinMeta):
+        self.cog = cog
+        self.heap: List[Tuple[float, int, int, WardenRule]] = []
+        self.scheduled: Dict[Tuple[int, str], WardenRule] = {}
+        self.running: Dict[Tuple[int, str], WardenRule] = {}
+        self.wake = asyncio.Event()
+        self.tasks: Set[asyncio.Task] = set()
+        self._counter = count()
+
+    def ruleset_changed(self, ruleset: GuildRuleset):
+        if ruleset.guild_id is None:
+            return
+        for rule in ruleset.by_event(Event.Periodic):
+            key = (ruleset.guild_id, rule.name)
+            if self.scheduled.get(key) is rule:
+                continue
+            self.scheduled[key] = rule
+            self.push(ruleset.guild_id, rule)
+
+    def push(self, guild_id: int, rule: WardenRule):
+        if rule.next_run is None or rule.run_every is None:
+            return
+        jitter = random.uniform(0, min(MAX_JITTER, rule.run_every.total_seconds() * JITTER_RATIO))
+        due = rule.next_run.timestamp() + jitter
+        heapq.heappush(self.heap, (due, next(self._counter), guild_id, rule))
+        if self.heap[0][3] is rule:
+            self.wake.set()
+
+    def is_active(self, guild_id: int, rule: WardenRule) -> bool:
+        ruleset = self.cog.active_warden_rules.get(guild_id)
+        return ruleset is not None and ruleset.get(rule.name) is rule
+
+    async def run(self):
+        while True:
+            if not self.heap:
+                self.wake.clear()
+                await self.wake.wait()
+                continue
+
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                self.wake.clear()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, guild_id, rule = heapq.heappop(self.heap)
+            key = (guild_id, rule.name)
+            if not self.is_active(guild_id, rule):
+                if self.scheduled.get(key) is rule:
+                    del self.scheduled[key]
+                continue
+            running = self.running.get(key)
+            if running is rule:  # The previous run is taking longer than the interval, it reschedules itself
+                continue
+            if running is not None:  # The rule has been edited while its previous version was running
+                heapq.heappush(self.heap, (time.time() + BUSY_RETRY_DELAY, next(self._counter), guild_id, rule))
+                continue
+            self.running[key] = rule
+            task = asyncio.create_task(self._run_rule(guild_id, rule))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run_rule(self, guild_id: int, rule: WardenRule):
+        try:
+            await self.cog.run_wd_periodic_rule(guild_id, rule)
+        except Exception as e:
+            log.error(f"Defender's scheduler for Warden periodic rules errored: {e}")
+        finally:
+            self.running.pop((guild_id, rule.name), None)
+            rule.next_run = utcnow() + rule.run_every
+            if self.is_active(guild_id, rule):
+                self.push(guild_id, rule)
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks.clear()
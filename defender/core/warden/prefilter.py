@@ -0,0 +1,170 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from .enums import Condition
+from .rule import WDCondition
+from .names import get_names, ROLES
+from ..utils import utcnow
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+import datetime
+import discord
+import fnmatch
+import asyncio
+import time
+
+if TYPE_CHECKING:
+    from .rule import WardenRule
+
+"""
+Periodic rules are run against every member of a guild, and going through the whole rule
+for each of them gets expensive on large guilds. Most periodic rules start with conditions
+on plain member attributes, such as how old the account is or which roles it has: those are
+first applied in bulk to columns of member attributes, and only the members that survive go
+through rank calculation and the regular evaluation of the rule.
+The filters are only ever allowed to let through more members than the conditions would,
+never fewer: the full evaluation that follows has the final say. The one exception are
+changes made to a member in the few seconds a snapshot is shared between the periodic rules
+of a guild, which are picked up by the next run.
+"""
+
+PREFILTER_CONDITIONS = (
+    Condition.UserJoinedLessThan,
+    Condition.UserCreatedLessThan,
+    Condition.UserHasDefaultAvatar,
+    Condition.UserHasAnyRoleIn,
+    Condition.UsernameMatchesAny,
+)
+SNAPSHOT_TTL = 30  # Seconds a snapshot can be reused for, by the other periodic rules of the guild
+CHUNK_SIZE = 20_000  # Members processed between yields to the event loop
+
+DEFAULT_AVATAR_PATTERN = "*/embed/avatars/*.png"
+
+
+def _default_avatar(member: discord.Member) -> Optional[bool]:
+    try:
+        return fnmatch.fnmatch(member.avatar.url, DEFAULT_AVATAR_PATTERN)
+    except Exception:
+        return None  # Unknown, the member won't be filtered out
+
+
+COLUMNS: Dict[str, Callable[[discord.Member], object]] = {
+    "joined_at": lambda m: m.joined_at.timestamp(),
+    "created_at": lambda m: m.created_at.timestamp(),
+    "default_avatar": _default_avatar,
+    "name": lambda m: m.name,
+}
+
+
+class MemberSnapshot:
+    """The members of a guild the periodic rules are run against, and columns of their
+    attributes. Columns are only built when a filter needs them"""
+
+    def __init__(self, guild: discord.Guild):
+        self.guild = guild
+        self.created = time.monotonic()
+        self.timestamp = time.time()
+        self.members: List[discord.Member] = [m for m in guild.members if not m.bot and m.joined_at is not None]
+        self.columns: Dict[str, list] = {}
+        self.sorted_columns: Dict[str, Tuple[list, List[int]]] = {}
+
+    async def column(self, name: str) -> list:
+        column = self.columns.get(name)
+        if column is None:
+            getter = COLUMNS[name]
+            column = []
+            for i in range(0, len(self.members), CHUNK_SIZE):
+                column.extend([getter(m) for m in self.members[i : i + CHUNK_SIZE]])
+                await asyncio.sleep(0)
+            self.columns[name] = column
+        return column
+
+    async def sorted_column(self, name: str) -> Tuple[list, List[int]]:
+        """The values of a column in ascending order, and the index of the member each belongs to"""
+        sorted_column = self.sorted_columns.get(name)
+        if sorted_column is None:
+            column = await self.column(name)
+            indexes = sorted(range(len(column)), key=column.__getitem__)
+            await asyncio.sleep(0)
+            sorted_column = self.sorted_columns[name] = ([column[i] for i in indexes], indexes)
+        return sorted_column
+
+
+_snapshots: Dict[int, MemberSnapshot] = {}
+
+
+def get_snapshot(guild: discord.Guild) -> MemberSnapshot:
+    snapshot = _snapshots.get(guild.id)
+    if snapshot is None or time.monotonic() - snapshot.created > SNAPSHOT_TTL:
+        snapshot = _snapshots[guild.id] = MemberSnapshot(guild)
+    return snapshot
+
+
+def discard_snapshots():
+    _snapshots.clear()
+
+
+def get_prefilters(rule: WardenRule) -> List[Tuple[Condition, object]]:
+    """The top level conditions of a rule that can be applied in bulk"""
+    return [
+        (statement.enum, model)
+        for statement, model in rule.cond_tree.items()
+        if isinstance(statement, WDCondition) and statement.enum in PREFILTER_CONDITIONS
+    ]
+
+
+async def _select(indexes: List[int], column: list, predicate: Callable[[object], bool]) -> List[int]:
+    selected = []
+    for i in range(0, len(indexes), CHUNK_SIZE):
+        selected.extend([j for j in indexes[i : i + CHUNK_SIZE] if predicate(column[j])])
+        await asyncio.sleep(0)
+    return selected
+
+
+async def prefilter_members(rule: WardenRule, snapshot: MemberSnapshot) -> List[discord.Member]:
+    """Returns the members that can possibly satisfy the conditions of the rule"""
+    members = snapshot.members
+    indexes = list(range(len(members)))
+
+    for condition, model in get_prefilters(rule):
+        if not indexes:
+            break
+
+        if condition in (Condition.UserJoinedLessThan, Condition.UserCreatedLessThan):
+            if isinstance(model.value, int):
+                if model.value == 0:
+                    continue
+                delta = datetime.timedelta(hours=model.value)
+            else:
+                delta = model.value
+            # Computed before the conditions will be: the threshold can only be more permissive
+            threshold = (utcnow() - delta).timestamp()
+            name = "joined_at" if condition is Condition.UserJoinedLessThan else "created_at"
+            indexes = await _select(indexes, await snapshot.column(name), lambda ts: ts > threshold)
+        elif condition is Condition.UserHasDefaultAvatar:
+            expected = model.value
+            column = await snapshot.column("default_avatar")
+            indexes = await _select(indexes, column, lambda v: v is None or v is expected)
+        elif condition is Condition.UsernameMatchesAny:
+            indexes = await _select(indexes, await snapshot.column("name"), model._matcher.match)
+        elif condition is Condition.UserHasAnyRoleIn:
+            role_ids = get_names(snapshot.guild).resolve(ROLES, model.value)
+            if snapshot.guild.id in role_ids:
+                continue  # Everyone has @everyone
+            indexes = await _select(indexes, members, lambda m: not role_ids.isdisjoint(m._roles))
+
+    return [members[i] for i in indexes]
@@ -20,27 +20,30 @@ from ...core.warden.validation import ALLOWED_STATEMENTS, ALLOWED_DEBUG_ACTIONS,
 from ...core.warden import validation as models
 from ...enums import Rank, EmergencyMode, Action as ModAction
 from .enums import Action, Condition, Event, ConditionBlock, ConditionalActionBlock, ChecksKeys
-from .utils import has_x_or_more_emojis, REMOVE_C_EMOJIS_RE, run_user_regex, make_fuzzy_suggestion, delete_message_after
+from .executor import ActionExecutor
+from .names import get_names, find_roles, ROLES, TEXT_CHANNELS, CATEGORIES
+from .trace import Trace, RuleProfile
+from .utils import run_user_regex, make_fuzzy_suggestion, delete_message_after
+from .utils import compile_template, precompile_templates
 from ...exceptions import InvalidRule, ExecutionError, StopExecution, MisconfigurationError
 from ...core import cache as df_cache
 from ...core.utils import get_external_invite, QuickAction, utcnow
+from ...core.features import get_features
 from ...core.menus import QAView
-from redbot.core.utils.common_filters import INVITE_URL_RE
 from redbot.core.utils.chat_formatting import box
 from redbot.core.commands.converter import parse_timedelta
 from discord.ext.commands import BadArgument
-from string import Template
 from typing import Optional
 from pydantic import ValidationError
 from typing import TYPE_CHECKING, Union, List, Dict
 from . import heat
+from functools import partial
 import random
 import yaml
 import fnmatch
 import discord
 import datetime
 import logging
-import regex as re
 import math
 
 if TYPE_CHECKING:
@@ -50,14 +53,73 @@ log = logging.getLogger("red.x26cogs.defender")
 
 ALLOW_ALL_MENTIONS = discord.AllowedMentions(everyone=True, roles=True, users=True)
 RULE_REQUIRED_KEYS = ("name", "event", "rank", "if", "do")
-RULE_FACULTATIVE_KEYS = ("priority", "run-every")
+RULE_FACULTATIVE_KEYS = ("priority", "run-every", "incremental")
 
-MEDIA_URL_RE = re.compile(r"""(http)?s?:?(\/\/[^"']*\.(?:png|jpg|jpeg|gif|png|svg|mp4|gifv))""", re.I)
-URL_RE = re.compile(
-    r"""https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*)""", re.I
-)
 MAX_NESTED = 10
 
+# Rough relative cost of evaluating each condition, used to evaluate the cheap ones first
+# Attribute lookups are 1, simple pattern matching ~3, config / API calls 10+
+DEFAULT_CONDITION_COST = 5
+CONDITION_COSTS = {
+    Condition.UserIdMatchesAny: 1,
+    Condition.ChannelMatchesAny: 1,
+    Condition.CategoryMatchesAny: 1,
+    Condition.ChannelIsPublic: 1,
+    Condition.MessageHasAttachment: 1,
+    Condition.InEmergencyMode: 1,
+    Condition.UserCreatedLessThan: 1,
+    Condition.UserJoinedLessThan: 1,
+    Condition.UserHasDefaultAvatar: 1,
+    Condition.UserStatusMatchesAny: 1,
+    Condition.MessageContainsMTMentions: 1,
+    Condition.MessageContainsMTUniqueMentions: 1,
+    Condition.MessageContainsMTRolePings: 1,
+    Condition.UserHasAnyRoleIn: 2,
+    Condition.UserHeatIs: 2,
+    Condition.ChannelHeatIs: 2,
+    Condition.UserHeatMoreThan: 2,
+    Condition.ChannelHeatMoreThan: 2,
+    Condition.CustomHeatIs: 2,
+    Condition.CustomHeatMoreThan: 2,
+    Condition.UsernameMatchesAny: 3,
+    Condition.NicknameMatchesAny: 3,
+    Condition.DisplayNameMatchesAny: 3,
+    Condition.UserActivityMatchesAny: 3,
+    Condition.MessageMatchesAny: 3,
+    Condition.MessageContainsWord: 3,
+    Condition.MessageContainsMedia: 3,
+    Condition.MessageContainsUrl: 3,
+    Condition.MessageHasMTCharacters: 3,
+    Condition.MessageContainsMTEmojis: 5,
+    Condition.UserHasSentLessThanMessages: 10,
+    Condition.IsHelper: 10,
+    Condition.IsStaff: 10,
+    Condition.UserIsRank: 15,
+    Condition.UsernameMatchesRegex: 25,
+    Condition.NicknameMatchesRegex: 25,
+    Condition.DisplayNameMatchesRegex: 25,
+    Condition.MessageMatchesRegex: 25,
+    Condition.MessageContainsInvite: 50,
+}
+INLINE_REGEX_COST = 4
+EXPULSION_ACTIONS = (Action.BanAndDelete, Action.Kick, Action.Softban)
+ROLE_ACTIONS = (Action.AddRolesToUser, Action.RemoveRolesFromUser)
+# Conditions that can raise or otherwise make their evaluation observable. Reordering
+# never moves a condition across them
+ORDER_BARRIER_CONDITIONS = (Condition.Compare, Condition.MessageContainsInvite)
+# Conditions whose result can change while the rules for the same event are being evaluated
+# or that depend on the rule's own variables. These are never shared between rules
+NOT_MEMOIZABLE_CONDITIONS = (
+    Condition.Compare,
+    Condition.InEmergencyMode,
+    Condition.UserHeatIs,
+    Condition.ChannelHeatIs,
+    Condition.UserHeatMoreThan,
+    Condition.ChannelHeatMoreThan,
+    Condition.CustomHeatIs,
+    Condition.CustomHeatMoreThan,
+)
+
 CHECKS_MODULES_EVENTS = {
     ChecksKeys.CommentAnalysis: Event.OnMessage,
     ChecksKeys.InviteFilter: Event.OnMessage,
@@ -67,30 +129,67 @@ CHECKS_MODULES_EVENTS = {
 
 
 class WDStatement:
-    __slots__ = ("enum",)
+    __slots__ = ("enum", "cost")
 
     def __repr__(self):
         return f"<{self.__class__.__name__} '{self.enum.value}'>"
 
 
 class WDCondition(WDStatement):
-    def __init__(self, enum: Condition):
+    __slots__ = ("memo_key",)
+
+    def __init__(self, enum: Condition, model: Optional[BaseModel] = None):
         self.enum = enum
+        self.cost = CONDITION_COSTS.get(enum, DEFAULT_CONDITION_COST)
+        if getattr(model, "_inline", False):
+            self.cost = INLINE_REGEX_COST
+        self.memo_key = None
+        if model is not None and enum not in NOT_MEMOIZABLE_CONDITIONS:
+            self.memo_key = (enum, model.model_dump_json())
 
 
 class WDAction(WDStatement):
     def __init__(self, enum: Action):
         self.enum = enum
+        self.cost = 0
 
 
 class WDConditionBlock(WDStatement):
     def __init__(self, enum: ConditionBlock):
         self.enum = enum
+        self.cost = 0
 
 
 class WDConditionalActionBlock(WDStatement):
     def __init__(self, enum: ConditionalActionBlock):
         self.enum = enum
+        self.cost = 0
+
+
+class ConditionMemo:
+    """Results of the conditions evaluated during a single event dispatch.
+    Identical conditions in different rules are evaluated only once per event"""
+
+    __slots__ = ("results",)
+    hits = 0
+    misses = 0
+
+    def __init__(self):
+        self.results: Dict[tuple, bool] = {}
+
+    def get(self, key) -> Optional[bool]:
+        result = self.results.get(key)
+        if result is None:
+            ConditionMemo.misses += 1
+        else:
+            ConditionMemo.hits += 1
+        return result
+
+    def set(self, key, result: bool):
+        self.results[key] = result
+
+    def clear(self):
+        self.results.clear()
 
 
 class WDRuntime:
@@ -105,10 +204,12 @@ class WDRuntime:
         self.evaluations: List[List[bool]] = []
         self.last_result: Optional[bool] = None
         self.state = {}
-        self.trace = []
+        self.tracer: Optional[Trace] = None
         self.last_expel_action: Optional[Union[Action, ModAction]] = None
         self.last_sent_message: Optional[discord.Message] = None
         self.debug = True
+        self.memo: Optional[ConditionMemo] = None
+        self.executor: Optional[ActionExecutor] = None
 
     async def populate_ctx_vars(self, rule: WardenRule):
         cog = self.cog
@@ -120,9 +221,11 @@ class WDRuntime:
                 "guild_id": guild.id,
                 "guild_icon_url": guild.icon.url if guild.icon else "",
                 "guild_banner_url": guild.banner.url if guild.banner else "",
-                "notification_channel_id": await cog.config.guild(guild).notify_channel() if cog else 0,
             }
         )
+        # Context variables that take a config lookup are only populated if the rule has a use for them
+        if "notification_channel_id" in rule.template_identifiers:
+            self.state["notification_channel_id"] = await cog.config.guild(guild).notify_channel() if cog else 0
 
         if self.user:
             user = self.user
@@ -147,7 +250,7 @@ class WDRuntime:
             self.state.update(
                 {
                     "message": message.content.replace("@", "@\u200b"),
-                    "message_clean": message.clean_content,
+                    "message_clean": get_features(message).clean_content,
                     "message_id": message.id,
                     "message_created_at": message.created_at,
                     "message_link": message.jump_url,
@@ -195,35 +298,6 @@ class WDRuntime:
     def __repr__(self):
         return f"<WDRuntime '{self.rule_name}'>"
 
-    def add_trace_enter(self, stack, enum, ignore=None):
-        if enum == ignore:
-            return
-        stack += 1
-        stack = "".join([" " for i in range(stack)])
-
-        if isinstance(enum, Condition):
-            self.trace.append(f"{stack}[=] {enum.value}")
-        elif isinstance(enum, Action):
-            self.trace.append(f"{stack}[=] {enum.value}")
-        elif isinstance(enum, (ConditionBlock, ConditionalActionBlock)):
-            self.trace.append(f"{stack}[>] {enum.value} block")
-
-    def add_trace_exit(self, stack, enum):
-        stack += 1
-        stack = "".join([" " for i in range(stack)])
-        if isinstance(enum, Condition):
-            last_trace = self.trace.pop()
-            last_trace += f" ({self.last_result})"
-            self.trace.append(last_trace)
-        elif isinstance(enum, Action):
-            last_trace = self.trace.pop()
-            last_trace += f" (Done)"
-            self.trace.append(last_trace)
-        elif isinstance(enum, ConditionBlock):
-            self.trace.append(f"{stack}[<] {enum.value} block ({self.last_result})")
-        elif isinstance(enum, ConditionalActionBlock):
-            self.trace.append(f"{stack}[<] {enum.value} block")
-
     def __bool__(self):
         return bool(self.last_result)
 
@@ -243,14 +317,31 @@ class WardenRule:
         self.priority = 2666
         self.next_run = None
         self.run_every = None
-
-    async def parse(self, rule_str, cog: MixinMeta, author=None):
+        self.incremental = False
+        # IDs / ranks the rule is restricted to by its top level conditions, None if unrestricted
+        self.user_scope: Optional[frozenset] = None
+        self.channel_scope: Optional[frozenset] = None
+        self.category_scope: Optional[frozenset] = None
+        self.rank_scope: Optional[frozenset] = None
+        self.uses_last_sent_message = False
+        self.expels = False  # Whether any of its actions expels the user
+        self.defers_actions = True
+        self.template_identifiers = set()  # Context variables referenced by the rule's parameters
+        self.profile: Optional[RuleProfile] = None  # Set while the staff is profiling the rule
+
+    async def parse(self, rule_str, cog: MixinMeta, author=None, *, data: Optional[dict] = None):
+        """Data is the already loaded YAML of rule_str, if available"""
         self.raw_rule = rule_str
 
-        try:
-            rule = yaml.safe_load(rule_str)
-        except:
-            raise InvalidRule("Error parsing YAML. Please make sure the format " "is valid (a YAML validator may help)")
+        if data is not None:
+            rule = data
+        else:
+            try:
+                rule = yaml.safe_load(rule_str)
+            except:
+                raise InvalidRule(
+                    "Error parsing YAML. Please make sure the format " "is valid (a YAML validator may help)"
+                )
 
         if not isinstance(rule, dict):
             raise InvalidRule(f"This rule doesn't seem to follow the expected format.")
@@ -283,13 +374,7 @@ class WardenRule:
             raise InvalidRule("A least one event must be defined.")
 
         if Event.Periodic in self.events:
-            # cog is None when running tests
-            if cog and not await cog.config.wd_periodic_allowed():
-                raise InvalidRule(
-                    "The creation of periodic Warden rules is currently disabled. "
-                    "The bot owner must use '[p]dset warden periodicallowed' to "
-                    "enable them."
-                )
+            await self.check_periodic_allowed(cog)
             if "run-every" not in rule.keys():
                 raise InvalidRule("The 'run-every' parameter is mandatory with " "periodic rules.")
             try:
@@ -310,6 +395,13 @@ class WardenRule:
             if "run-every" in rule.keys():
                 raise InvalidRule("The 'periodic' event must be specified for rules with " "a 'run-every' parameter.")
 
+        if "incremental" in rule.keys():
+            if Event.Periodic not in self.events:
+                raise InvalidRule("The 'incremental' parameter is only allowed with periodic rules.")
+            if not isinstance(rule["incremental"], bool):
+                raise InvalidRule("The 'incremental' parameter must be either true or false.")
+            self.incremental = rule["incremental"]
+
         try:
             self.rank = Rank(rule["rank"])
         except:
@@ -343,6 +435,90 @@ class WardenRule:
             raise InvalidRule("Rule must have at least one action.")
 
         self.action_tree = await self.parse_tree(rule["do"], cog=cog, author=author, events=self.events)
+        self.compute_scopes()
+        self.uses_last_sent_message = any(
+            s.enum is Action.DeleteLastMessageSentAfter for s, _ in self.iter_statements(self.action_tree)
+        )
+        self.expels = any(s.enum in EXPULSION_ACTIONS for s, _ in self.iter_statements(self.action_tree))
+        self.defers_actions = self.can_defer_actions()
+
+    def can_defer_actions(self) -> bool:
+        """Side effects are run inline if the rule expels the user, as a message to them would race
+        the expulsion, or if it evaluates conditions after changing roles, so they see the change.
+        The same goes for the other rules of an event one of whose rules can expel the user"""
+        if self.expels:
+            return False
+        changed_roles = False
+        for statement, _ in self.iter_statements(self.action_tree):
+            if statement.enum in ROLE_ACTIONS:
+                changed_roles = True
+            elif changed_roles and isinstance(statement, (WDCondition, WDConditionBlock)):
+                return False
+        return True
+
+    async def check_periodic_allowed(self, cog: MixinMeta):
+        # cog is None when running tests
+        if cog and not await cog.config.wd_periodic_allowed():
+            raise InvalidRule(
+                "The creation of periodic Warden rules is currently disabled. "
+                "The bot owner must use '[p]dset warden periodicallowed' to "
+                "enable them."
+            )
+
+    async def restore(self, cog: MixinMeta):
+        """Brings a rule loaded from the rule cache up to date with what parsing it now would produce"""
+        self.last_action = Action.NoOp
+        if Event.Periodic in self.events:
+            await self.check_periodic_allowed(cog)
+            self.next_run = utcnow() + self.run_every
+
+    def compute_scopes(self):
+        """All the top level conditions must pass for a rule to pass: the ones matching IDs
+        restrict the rule to those IDs and can be checked without evaluating the rule"""
+
+        def narrow(scope, values):
+            return frozenset(values) if scope is None else scope & frozenset(values)
+
+        for statement, model in self.cond_tree.items():
+            if not isinstance(statement, WDCondition):
+                continue
+            if statement.enum is Condition.UserIsRank:
+                self.rank_scope = narrow(self.rank_scope, (int(model.value),))
+            elif statement.enum is Condition.UserIdMatchesAny:
+                self.user_scope = narrow(self.user_scope, model.value)
+            elif statement.enum in (Condition.ChannelMatchesAny, Condition.CategoryMatchesAny):
+                # Channels and categories can also be matched by name, these are not scoped
+                if not all(isinstance(v, int) for v in model.value):
+                    continue
+                if statement.enum is Condition.ChannelMatchesAny:
+                    self.channel_scope = narrow(self.channel_scope, model.value)
+                else:
+                    self.category_scope = narrow(self.category_scope, model.value)
+
+    def admits(
+        self,
+        event: Event,
+        rank: Rank,
+        *,
+        user_id: Optional[int] = None,
+        channel_id: Optional[int] = None,
+        category_id: Optional[int] = None,
+    ) -> bool:
+        """Synchronous checks a rule must pass before it's worth evaluating its conditions"""
+        if rank < self.rank:
+            return False
+        if event not in self.events:
+            return False
+        if self.rank_scope is not None and rank not in self.rank_scope:
+            return False
+        if user_id is not None and self.user_scope is not None and user_id not in self.user_scope:
+            return False
+        if channel_id is not None:
+            if self.channel_scope is not None and channel_id not in self.channel_scope:
+                return False
+            if self.category_scope is not None and category_id not in self.category_scope:
+                return False
+        return True
 
     async def parse_tree(
         self, raw_tree, *, events, author, cog: MixinMeta, conditions_only=False, stack=-1, outer_block=None
@@ -390,14 +566,15 @@ class WardenRule:
             try:
                 if isinstance(enum, Condition):
                     model = model_validator(enum, value)
-                    tree[WDCondition(enum=enum)] = model
+                    tree[WDCondition(enum=enum, model=model)] = model
                 elif isinstance(enum, Action):
                     if outer_block is ConditionBlock:
                         raise InvalidRule("Actions are not allowed inside condition blocks")
                     model = model_validator(enum, value)
                     tree[WDAction(enum=enum)] = model
                 elif isinstance(enum, ConditionBlock):
-                    tree[WDConditionBlock(enum=enum)] = await self.parse_tree(
+                    block = WDConditionBlock(enum=enum)
+                    tree[block] = await self.parse_tree(
                         value,
                         events=events,
                         author=author,
@@ -406,6 +583,7 @@ class WardenRule:
                         stack=stack,
                         outer_block=ConditionBlock,
                     )
+                    block.cost = sum(st.cost for st in tree[block])
                 elif isinstance(enum, ConditionalActionBlock):
                     if outer_block is ConditionBlock:
                         raise InvalidRule("Conditional action blocks are not allowed inside condition blocks")
@@ -428,6 +606,7 @@ class WardenRule:
                     pass
 
             if model:
+                self.template_identifiers |= precompile_templates(model)
                 for event in events:
                     if not enum in ALLOWED_STATEMENTS[event]:
                         raise InvalidRule(self.errors["NOT_ALLOWED_IN_EVENTS"].format(enum.value))
@@ -443,8 +622,49 @@ class WardenRule:
         if not tree:
             raise InvalidRule("Empty block.")
 
+        if conditions_only or outer_block is ConditionBlock:
+            tree = self.reorder_by_cost(tree)
+
         return tree
 
+    @staticmethod
+    def is_order_barrier(statement: WDStatement, value) -> bool:
+        if isinstance(statement, WDCondition):
+            return statement.enum in ORDER_BARRIER_CONDITIONS
+        return any(WardenRule.is_order_barrier(s, v) for s, v in value.items())
+
+    @staticmethod
+    def reorder_by_cost(tree: Dict[WDStatement, Union[BaseModel, Dict]]):
+        """Sorts a condition-only tree so that the cheapest conditions are evaluated first.
+        The result of a condition block does not depend on the order of its members,
+        as long as they're free of side effects: barriers stay where the author put them"""
+        ordered = {}
+        segment = []
+
+        def flush():
+            segment.sort(key=lambda item: item[0].cost)  # Stable, ties keep the authored order
+            ordered.update(segment)
+            segment.clear()
+
+        for statement, value in tree.items():
+            if WardenRule.is_order_barrier(statement, value):
+                flush()
+                ordered[statement] = value
+            else:
+                segment.append((statement, value))
+        flush()
+
+        return ordered
+
+    def iter_statements(self, tree=None):
+        """Yields every (statement, model) pair of the rule, blocks included"""
+        trees = (tree,) if tree is not None else (getattr(self, "cond_tree", {}), getattr(self, "action_tree", {}))
+        for _tree in trees:
+            for statement, value in _tree.items():
+                yield statement, value
+                if isinstance(statement, (WDConditionBlock, WDConditionalActionBlock)):
+                    yield from self.iter_statements(value)
+
     def build_pydantic_error(self, exception, statement):
         errors = exception.errors(include_url=False, include_input=False)
         message = f"{len(errors)} validation error(s) for {statement.value}\n"
@@ -469,15 +689,24 @@ class WardenRule:
         outer_block=None,
     ) -> WDRuntime:
         stack += 1
+        tracer = runtime.tracer
 
         for statement, value in tree.items():
-            if runtime.debug:
-                runtime.add_trace_enter(
-                    stack, statement.enum, ignore=WDConditionalActionBlock if runtime.last_result else None
-                )
+            # Conditional action blocks are only traced if they run
+            if tracer is not None and not isinstance(statement, WDConditionalActionBlock):
+                slot = tracer.enter(stack, statement)
 
             if isinstance(statement, WDCondition):
-                await self._evaluate_condition(condition=statement.enum, model=value, runtime=runtime)
+                memo = runtime.memo
+                if memo is not None and statement.memo_key is not None:
+                    result = memo.get(statement.memo_key)
+                    if result is None:
+                        await self._evaluate_condition(condition=statement.enum, model=value, runtime=runtime)
+                        memo.set(statement.memo_key, runtime.last_result)
+                    else:
+                        runtime.last_result = result
+                else:
+                    await self._evaluate_condition(condition=statement.enum, model=value, runtime=runtime)
             elif isinstance(statement, WDAction):
                 await self._do_action(action=statement.enum, model=value, runtime=runtime)
             elif isinstance(statement, WDConditionBlock):
@@ -489,8 +718,8 @@ class WardenRule:
                 can_run_true = statement.enum is ConditionalActionBlock.IfTrue and runtime.last_result is True
                 can_run_false = statement.enum is ConditionalActionBlock.IfFalse and runtime.last_result is False
                 if can_run_true or can_run_false:
-                    if runtime.debug:
-                        runtime.add_trace_enter(stack, statement.enum)
+                    if tracer is not None:
+                        slot = tracer.enter(stack, statement)
                     last_stack_result = (
                         runtime.last_result
                     )  # ConditionalActionBlocks leaking inner last_results leads to unintuitive behaviour
@@ -499,8 +728,8 @@ class WardenRule:
                 else:
                     continue  # We don't want a trace exit for non-executing CondActionBlocks
 
-            if runtime.debug:
-                runtime.add_trace_exit(stack, statement.enum)
+            if tracer is not None:
+                tracer.exit(slot, runtime.last_result)
 
             # Condition blocks stop evaluating at their first failed eval, depending on their type
             if bool_stop in (True, False) and runtime.last_result is bool_stop:
@@ -524,6 +753,7 @@ class WardenRule:
         reaction: Optional[discord.Reaction] = None,
         role: Optional[discord.Role] = None,
         debug=False,
+        memo: Optional[ConditionMemo] = None,
     ) -> WDRuntime:
         runtime = WDRuntime()
         runtime.rule_name = self.name
@@ -534,18 +764,29 @@ class WardenRule:
         runtime.reaction = reaction
         runtime.role = role
         runtime.debug = debug
-        await runtime.populate_ctx_vars(self)
+        runtime.memo = memo
+        if debug:
+            runtime.tracer = Trace()
 
         if rank < self.rank:
             return runtime
         if not self.cond_tree:
             return runtime
 
+        profile = self.profile if not debug else None
+        if profile is not None:
+            runtime.tracer = profile.sample()
+
+        await runtime.populate_ctx_vars(self)
+
         try:
             await self.eval_tree(self.cond_tree, runtime=runtime, bool_stop=False)
         except (StopExecution, ExecutionError):
             runtime.last_result = False
 
+        if profile is not None and runtime.tracer is not None:
+            profile.add(runtime.tracer)
+
         return runtime
 
     async def _evaluate_condition(self, condition: Condition, *, model: BaseModel, runtime: WDRuntime):
@@ -587,41 +828,28 @@ class WardenRule:
         def safe_sub(string):
             if string is None:
                 return string
-            return Template(string).safe_substitute(runtime.state)
+            return compile_template(string).substitute(runtime.state)
 
         @checker(Condition.MessageMatchesAny)
-        async def message_matches_any(params: models.NonEmptyListStr):
+        async def message_matches_any(params: models.GlobList):
             # One match = Passed
-            content = message.content.lower()
-            for pattern in params.value:
-                if fnmatch.fnmatch(content, pattern.lower()):
-                    return True
-            return False
+            return params._matcher.match_lowered(get_features(message).lower)
 
         @checker(Condition.MessageMatchesRegex)
         async def message_matches_regex(params: models.IsStr):
-            return await run_user_regex(rule_obj=self, cog=cog, guild=guild, regex=params.value, text=message.content)
+            return await run_user_regex(
+                rule_obj=self, cog=cog, guild=guild, regex=params._compiled, text=message.content, inline=params._inline
+            )
 
         @checker(Condition.MessageContainsWord)
-        async def message_contains_word(params: models.NonEmptyListStr):
-            message_words = message.content.lower().split()
-            for word in message_words:
-                for pattern in params.value:
-                    if fnmatch.fnmatch(word, pattern.lower()):
-                        return True
-            return False
+        async def message_contains_word(params: models.GlobList):
+            return params._matcher.match_any_word(get_features(message).tokens)
 
         @checker(Condition.UserActivityMatchesAny)
-        async def user_activity_matches_any(params: models.NonEmptyListStr):
-            to_check = []
+        async def user_activity_matches_any(params: models.GlobList):
             for activity in user.activities:
                 if isinstance(activity, discord.BaseActivity):
-                    if activity.name is not None:
-                        to_check.append(activity.name)
-
-            for activity in to_check:
-                for pattern in params.value:
-                    if fnmatch.fnmatch(activity.lower(), pattern.lower()):
+                    if activity.name is not None and params._matcher.match(activity.name):
                         return True
 
             return False
@@ -642,58 +870,53 @@ class WardenRule:
             return False
 
         @checker(Condition.UsernameMatchesAny)
-        async def username_matches_any(params: models.NonEmptyListStr):
+        async def username_matches_any(params: models.GlobList):
             # One match = Passed
-            name = user.name.lower()
-            for pattern in params.value:
-                if fnmatch.fnmatch(name, pattern.lower()):
-                    return True
-            return False
+            return params._matcher.match(user.name)
 
         @checker(Condition.UsernameMatchesRegex)
         async def username_matches_regex(params: models.IsStr):
-            return await run_user_regex(rule_obj=self, cog=cog, guild=guild, regex=params.value, text=user.name)
+            return await run_user_regex(
+                rule_obj=self, cog=cog, guild=guild, regex=params._compiled, text=user.name, inline=params._inline
+            )
 
         @checker(Condition.NicknameMatchesAny)
-        async def nickname_matches_any(params: models.NonEmptyListStr):
+        async def nickname_matches_any(params: models.GlobList):
             # One match = Passed
             if not user.nick:
                 return False
-            nick = user.nick.lower()
-            for pattern in params.value:
-                if fnmatch.fnmatch(nick, pattern.lower()):
-                    return True
-            return False
+            return params._matcher.match(user.nick)
 
         @checker(Condition.NicknameMatchesRegex)
         async def nickname_matches_regex(params: models.IsStr):
             if not user.nick:
                 return False
-            return await run_user_regex(rule_obj=self, cog=cog, guild=guild, regex=params.value, text=user.nick)
+            return await run_user_regex(
+                rule_obj=self, cog=cog, guild=guild, regex=params._compiled, text=user.nick, inline=params._inline
+            )
 
         @checker(Condition.DisplayNameMatchesAny)
-        async def display_name_matches_any(params: models.NonEmptyListStr):
+        async def display_name_matches_any(params: models.GlobList):
             # One match = Passed
-            display_name = user.display_name.lower()
-            for pattern in params.value:
-                if fnmatch.fnmatch(display_name, pattern.lower()):
-                    return True
-            return False
+            return params._matcher.match(user.display_name)
 
         @checker(Condition.DisplayNameMatchesRegex)
         async def display_name_matches_regex(params: models.IsStr):
-            return await run_user_regex(rule_obj=self, cog=cog, guild=guild, regex=params.value, text=user.display_name)
+            return await run_user_regex(
+                rule_obj=self,
+                cog=cog,
+                guild=guild,
+                regex=params._compiled,
+                text=user.display_name,
+                inline=params._inline,
+            )
 
         @checker(Condition.ChannelMatchesAny)
         async def channel_matches_any(params: models.NonEmptyList):
             if channel.id in params.value:
                 return True
             if parent is None:  # Name matching for channels only
-                for channel_str in params.value:
-                    channel_str = str(channel_str)
-                    channel_obj = discord.utils.get(guild.text_channels, name=channel_str)
-                    if channel_obj is not None and channel_obj == channel:
-                        return True
+                return channel.id in get_names(guild).resolve(TEXT_CHANNELS, params.value)
             return False
 
         @checker(Condition.CategoryMatchesAny)
@@ -703,12 +926,7 @@ class WardenRule:
                 return False
             if chan.category.id in params.value:
                 return True
-            for category_str in params.value:
-                category_str = str(category_str)
-                category_obj = discord.utils.get(guild.categories, name=category_str)
-                if category_obj is not None and category_obj == chan.category:
-                    return True
-            return False
+            return chan.category.id in get_names(guild).resolve(CATEGORIES, params.value)
 
         @checker(Condition.ChannelIsPublic)
         async def channel_is_public(params: models.IsBool):
@@ -766,14 +984,12 @@ class WardenRule:
 
         @checker(Condition.UserHasAnyRoleIn)
         async def user_has_any_role_in(params: models.NonEmptyList):
-            for role_id_or_name in params.value:
-                role = guild.get_role(role_id_or_name)
-                if role is None:
-                    role = discord.utils.get(guild.roles, name=role_id_or_name)
-                if role:
-                    if role in user.roles:
-                        return True
-            return False
+            role_ids = get_names(guild).resolve(ROLES, params.value)
+            if guild.id in role_ids:  # Everyone has @everyone
+                return True
+            executor = getattr(cog, "wd_executor", None)
+            user_role_ids = executor.role_ids(guild, user) if executor is not None else user._roles
+            return not role_ids.isdisjoint(user_role_ids)
 
         @checker(Condition.UserHasSentLessThanMessages)
         async def user_has_sent_less_than_messages(params: models.IsInt):
@@ -782,7 +998,7 @@ class WardenRule:
 
         @checker(Condition.MessageContainsInvite)
         async def message_contains_invite(params: models.IsBool):
-            results = INVITE_URL_RE.findall(message.content)
+            results = get_features(message).invites
             if results:
                 has_invite = True
                 try:
@@ -800,37 +1016,33 @@ class WardenRule:
 
         @checker(Condition.MessageContainsMedia)
         async def message_contains_media(params: models.IsBool):
-            has_media = MEDIA_URL_RE.search(message.content)
-            return bool(has_media) is params.value
+            return get_features(message).has_media is params.value
 
         @checker(Condition.MessageContainsUrl)
         async def message_contains_url(params: models.IsBool):
-            has_url = URL_RE.search(message.content)
-            return bool(has_url) is params.value
+            return bool(get_features(message).urls) is params.value
 
         @checker(Condition.MessageContainsMTMentions)
         async def message_contains_mt_mentions(params: models.IsInt):
-            return len(message.raw_mentions) > params.value
+            return get_features(message).mention_count > params.value
 
         @checker(Condition.MessageContainsMTUniqueMentions)
         async def message_contains_mt_unique_mentions(params: models.IsInt):
-            return len(set(message.mentions)) > params.value
+            return get_features(message).unique_mention_count > params.value
 
         @checker(Condition.MessageContainsMTRolePings)
         async def message_contains_mt_role_pings(params: models.IsInt):
-            return len(message.role_mentions) > params.value
+            return get_features(message).role_mention_count > params.value
 
         @checker(Condition.MessageContainsMTEmojis)
         async def message_contains_mt_emojis(params: models.IsInt):
-            over_limit = has_x_or_more_emojis(cog.bot, guild, message.content, params.value + 1)
-            return over_limit
+            return get_features(message).has_x_or_more_emojis(params.value + 1)
 
         @checker(Condition.MessageHasMTCharacters)
         async def message_has_mt_characters(params: models.IsInt):
-            # We're turning one custom emoji code into a single character to avoid
+            # One custom emoji code counts as a single character to avoid
             # unexpected (from a user's POV) behaviour
-            clean_content = REMOVE_C_EMOJIS_RE.sub("x", message.clean_content)
-            return len(clean_content) > params.value
+            return get_features(message).char_count > params.value
 
         @checker(Condition.IsStaff)
         async def is_staff(params: models.IsBool):
@@ -852,7 +1064,7 @@ class WardenRule:
 
         @checker(Condition.CustomHeatIs)
         async def custom_heat_is(params: models.CheckCustomHeatpoint):
-            heat_key = Template(params.label).safe_substitute(runtime.state)
+            heat_key = compile_template(params.label).substitute(runtime.state)
             return heat.get_custom_heat(guild, heat_key, debug=debug) == params.points
 
         @checker(Condition.UserHeatMoreThan)
@@ -865,7 +1077,7 @@ class WardenRule:
 
         @checker(Condition.CustomHeatMoreThan)
         async def custom_heat_more_than(params: models.CheckCustomHeatpoint):
-            heat_key = Template(params.label).safe_substitute(runtime.state)
+            heat_key = compile_template(params.label).substitute(runtime.state)
             return heat.get_custom_heat(guild, heat_key, debug=debug) > params.points
 
         @checker(Condition.Compare)
@@ -930,7 +1142,10 @@ class WardenRule:
         guild: discord.Guild,
         role: Optional[discord.Role] = None,
         debug=False,
-    ):
+        defer=True,
+    ) -> bool:
+        """Returns whether the user has been expelled. Defer is False when side effects
+        can't be deferred because of the other rules of the event"""
         runtime = WDRuntime()
         runtime.rule_name = self.name
         runtime.cog = cog
@@ -940,12 +1155,22 @@ class WardenRule:
         runtime.reaction = reaction
         runtime.role = role
         runtime.debug = debug
+        if not debug and defer and self.defers_actions:
+            runtime.executor = getattr(cog, "wd_executor", None)
+        profile = self.profile if not debug else None
+        if profile is not None:
+            runtime.tracer = profile.sample()
         await runtime.populate_ctx_vars(self)
 
         try:
             await self.eval_tree(self.action_tree, runtime=runtime)
         except StopExecution:
-            return
+            pass
+
+        if profile is not None and runtime.tracer is not None:
+            profile.add(runtime.tracer)
+
+        return runtime.last_expel_action is not None
 
     async def _do_action(self, action: Action, *, model: BaseModel, runtime: WDRuntime):
         cog = runtime.cog
@@ -967,7 +1192,11 @@ class WardenRule:
         def safe_sub(string):
             if string is None:
                 return string
-            return Template(string).safe_substitute(runtime.state)
+            return compile_template(string).substitute(runtime.state)
+
+        executor = runtime.executor
+        # Sent messages can't be deferred if a later action needs them
+        defer_messages = executor is not None and not self.uses_last_sent_message
 
         # for heat_key in heat.get_custom_heat_keys(guild):
         #    runtime.state[f"custom_heat_{heat_key}"] = heat.get_custom_heat(guild, heat_key)
@@ -1063,7 +1292,8 @@ class WardenRule:
                 else:
                     footer = safe_sub(params.footer_text)
 
-            runtime.last_sent_message = await cog.send_notification(
+            notification = partial(
+                cog.send_notification,
                 guild,
                 safe_sub(params.content),
                 title=title,
@@ -1078,6 +1308,10 @@ class WardenRule:
                 force_text_only=text_only,
                 allow_everyone_ping=params.allow_everyone_ping,
             )
+            if defer_messages:
+                executor.submit(("notify", guild.id), guild, self.name, Action.NotifyStaff, notification)
+            else:
+                runtime.last_sent_message = await notification()
 
         @processor(Action.SetChannelSlowmode)
         async def set_channel_slowmode(params: models.IsTimedelta):
@@ -1086,29 +1320,21 @@ class WardenRule:
 
         @processor(Action.AddRolesToUser)
         async def add_roles_to_user(params: models.NonEmptyList):
-            to_assign = []
-            for role_id_or_name in params.value:
-                role = guild.get_role(role_id_or_name)
-                if role is None:
-                    role = discord.utils.get(guild.roles, name=role_id_or_name)
-                if role:
-                    to_assign.append(role)
-            to_assign = list(set(to_assign))
-            to_assign = [r for r in to_assign if r not in user.roles]
+            to_assign = [r for r in find_roles(guild, params.value) if not r.is_default()]
+            if executor is not None:  # Checked against the changes still pending
+                executor.change_roles(guild, user, self.name, Action.AddRolesToUser, add=to_assign)
+                return
+            to_assign = [r for r in to_assign if user.get_role(r.id) is None]
             if to_assign:
                 await user.add_roles(*to_assign, reason=f"Assigned by Warden rule '{self.name}'")
 
         @processor(Action.RemoveRolesFromUser)
         async def remove_roles_from_user(params: models.NonEmptyList):
-            to_unassign = []
-            for role_id_or_name in params.value:
-                role = guild.get_role(role_id_or_name)
-                if role is None:
-                    role = discord.utils.get(guild.roles, name=role_id_or_name)
-                if role:
-                    to_unassign.append(role)
-            to_unassign = list(set(to_unassign))
-            to_unassign = [r for r in to_unassign if r in user.roles]
+            if executor is not None:
+                to_unassign = list(find_roles(guild, params.value))
+                executor.change_roles(guild, user, self.name, Action.RemoveRolesFromUser, remove=to_unassign)
+                return
+            to_unassign = [r for r in find_roles(guild, params.value) if user.get_role(r.id) is not None]
             if to_unassign:
                 await user.remove_roles(*to_unassign, reason=f"Unassigned by Warden rule '{self.name}'")
 
@@ -1117,7 +1343,7 @@ class WardenRule:
             if params.value == "":
                 value = None
             else:
-                value = Template(params.value).safe_substitute(runtime.state)
+                value = compile_template(params.value).substitute(runtime.state)
             await user.edit(nick=value, reason=f"Changed nickname by Warden rule '{self.name}'")
 
         @processor(Action.BanAndDelete)
@@ -1186,8 +1412,9 @@ class WardenRule:
         async def send_mod_log(params: models.IsStr):
             if runtime.last_expel_action is None:
                 return
-            reason = Template(params.value).safe_substitute(runtime.state)
-            await cog.create_modlog_case(
+            reason = compile_template(params.value).substitute(runtime.state)
+            modlog_case = partial(
+                cog.create_modlog_case,
                 cog.bot,
                 guild,
                 utcnow(),
@@ -1198,6 +1425,10 @@ class WardenRule:
                 until=None,
                 channel=None,
             )
+            if executor is not None:
+                executor.submit(("modlog", guild.id), guild, self.name, Action.Modlog, modlog_case)
+            else:
+                await modlog_case()
 
         @processor(Action.EnableEmergencyMode)
         async def enable_emergency_mode(params: models.IsBool):
@@ -1211,7 +1442,7 @@ class WardenRule:
 
         @processor(Action.SendToMonitor)
         async def send_to_monitor(params: models.IsStr):
-            value = Template(params.value).safe_substitute(runtime.state)
+            value = compile_template(params.value).substitute(runtime.state)
             cog.send_to_monitor(guild, f"[Warden] ({self.name}): {value}")
 
         @processor(Action.AddUserHeatpoint)
@@ -1238,12 +1469,12 @@ class WardenRule:
 
         @processor(Action.AddCustomHeatpoint)
         async def add_custom_heatpoint(params: models.AddCustomHeatpoint):
-            heat_key = Template(params.label).safe_substitute(runtime.state)
+            heat_key = compile_template(params.label).substitute(runtime.state)
             heat.increase_custom_heat(guild, heat_key, params.delta, debug=debug)  # type: ignore
 
         @processor(Action.AddCustomHeatpoints)
         async def add_custom_heatpoints(params: models.AddCustomHeatpoints):
-            heat_key = Template(params.label).safe_substitute(runtime.state)
+            heat_key = compile_template(params.label).substitute(runtime.state)
             for _ in range(params.points):
                 heat.increase_custom_heat(guild, heat_key, params.delta, debug=debug)  # type: ignore
 
@@ -1257,7 +1488,7 @@ class WardenRule:
 
         @processor(Action.EmptyCustomHeat)
         async def empty_custom_heat(params: models.IsStr):
-            heat_key = Template(params.value).safe_substitute(runtime.state)
+            heat_key = compile_template(params.value).substitute(runtime.state)
             heat.empty_custom_heat(guild, heat_key, debug=debug)
 
         @processor(Action.IssueCommand)
@@ -1314,12 +1545,12 @@ class WardenRule:
                     send_embed = True
                     break
 
-            for key in params.model_dump():
+            for key in type(params).model_fields:
                 attr = getattr(params, key)
-                if attr is None and key not in params._text_only_attrs:
-                    setattr(params, key, None)
-                elif isinstance(attr, str):
-                    setattr(params, key, safe_sub(attr))
+                if isinstance(attr, str):
+                    template = compile_template(attr)
+                    if not template.constant:
+                        setattr(params, key, template.substitute(runtime.state))
 
             is_user = False
             pool = guild.text_channels if parent is None else guild.threads
@@ -1373,44 +1604,51 @@ class WardenRule:
                 everyone=params.allow_mass_mentions, roles=True, users=True, replied_user=params.ping_on_reply
             )
 
-            if params.edit_message_id:
-                params.edit_message_id = safe_sub(params.edit_message_id)
+            # Everything the delivery needs is worked out now, it may happen after later actions have run
+            content = params.content
+            edit_message_id = safe_sub(params.edit_message_id) if params.edit_message_id else None
+            reply_message_id = safe_sub(params.reply_message_id) if params.reply_message_id else None
+            rule_name = self.name
 
-            if isinstance(destination, discord.Member):
-                destination = destination.dm_channel if destination.dm_channel else await destination.create_dm()
+            async def deliver(destination) -> Optional[discord.Message]:
+                if isinstance(destination, discord.Member):
+                    destination = destination.dm_channel if destination.dm_channel else await destination.create_dm()
 
-            reference = None
-            if params.reply_message_id:
-                params.reply_message_id = safe_sub(params.reply_message_id)
-                if params.reply_message_id.isdigit():
-                    reference = destination.get_partial_message(int(params.reply_message_id))
+                reference = None
+                if reply_message_id and reply_message_id.isdigit():
+                    reference = destination.get_partial_message(int(reply_message_id))
 
-            if not params.edit_message_id:
-                try:
-                    runtime.last_sent_message = await destination.send(
-                        params.content, embed=em, allowed_mentions=mentions, reference=reference
-                    )
-                except (discord.HTTPException, discord.Forbidden) as e:
-                    # A user could just have DMs disabled
-                    if is_user is False:
+                if not edit_message_id:
+                    try:
+                        return await destination.send(content, embed=em, allowed_mentions=mentions, reference=reference)
+                    except (discord.HTTPException, discord.Forbidden) as e:
+                        # A user could just have DMs disabled
+                        if is_user is False:
+                            raise ExecutionError(
+                                f"[Warden] ({rule_name}): Failed to deliver message " f"to channel #{destination}. {e}"
+                            )
+                else:
+                    try:
+                        partial_msg = destination.get_partial_message(int(edit_message_id))
+                        await partial_msg.edit(
+                            content=content if content else None, embed=em, allowed_mentions=mentions
+                        )
+                    except (discord.HTTPException, discord.Forbidden) as e:
                         raise ExecutionError(
-                            f"[Warden] ({self.name}): Failed to deliver message " f"to channel #{destination}. {e}"
+                            f"[Warden] ({rule_name}): Failed to edit message " f"in channel #{destination}. {e}"
                         )
+                    except ValueError:
+                        raise ExecutionError(
+                            f"[Warden] ({rule_name}): Failed to edit message. " f"{edit_message_id} is not a valid ID"
+                        )
+
+            if defer_messages:
+                route = ("messages", destination.id)
+                executor.submit(route, guild, self.name, Action.SendMessage, partial(deliver, destination))
             else:
-                try:
-                    partial_msg = destination.get_partial_message(int(params.edit_message_id))
-                    await partial_msg.edit(
-                        content=params.content if params.content else None, embed=em, allowed_mentions=mentions
-                    )
-                except (discord.HTTPException, discord.Forbidden) as e:
-                    raise ExecutionError(
-                        f"[Warden] ({self.name}): Failed to edit message " f"in channel #{destination}. {e}"
-                    )
-                except ValueError:
-                    raise ExecutionError(
-                        f"[Warden] ({self.name}): Failed to edit message. "
-                        f"{params.edit_message_id} is not a valid ID"
-                    )
+                sent = await deliver(destination)
+                if sent is not None:
+                    runtime.last_sent_message = sent
 
         @processor(Action.ArchiveThread)
         async def archive_thread(params: models.IsNone):
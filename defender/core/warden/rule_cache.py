@@ -0,0 +1,112 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Optional, Union
+import hashlib
+import logging
+import pickle
+import os
+
+if TYPE_CHECKING:
+    from .rule import WardenRule, WardenCheck
+
+"""
+Parsing a rule means YAML, pydantic validation and building its trees, and at cog load
+that is done for every rule of every guild. The parsed rules are kept on disk instead,
+keyed by a hash of their source and of the Defender version that parsed them: a rule that
+hasn't changed since the last load is unpickled rather than parsed again.
+Anything that doesn't match, or fails to load, simply goes through the full parse.
+The file lives in the cog's data folder and is only ever written by the cog itself.
+"""
+
+RULE_CACHE_FORMAT = 6  # Bump whenever the structure of the parsed rules changes
+RULE_CACHE_FILENAME = "warden_rules.cache"
+
+log = logging.getLogger("red.x26cogs.defender")
+
+
+class RuleCache:
+    def __init__(self, path: Optional[Path], version: str):
+        self.path = path
+        self.version = version
+        self.entries: Dict[str, bytes] = {}
+        self.used: Dict[str, bytes] = {}
+        self.changed = False
+
+    def make_key(self, kind: str, raw_rule: str) -> str:
+        """Kind tells apart rules and the checks of each module, which parse the same source differently"""
+        key = f"{RULE_CACHE_FORMAT}\n{self.version}\n{kind}\n{raw_rule}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+            if data.get("format") == RULE_CACHE_FORMAT and data.get("version") == self.version:
+                self.entries = data["entries"]
+        except Exception as e:
+            log.warning("Warden - Failed to read the rule cache, rules will be parsed from scratch", exc_info=e)
+            self.entries = {}
+
+    def has(self, kind: str, raw_rule: str) -> bool:
+        return self.make_key(kind, raw_rule) in self.entries
+
+    def get(self, kind: str, raw_rule: str) -> Optional[Union[WardenRule, WardenCheck]]:
+        key = self.make_key(kind, raw_rule)
+        blob = self.entries.get(key)
+        if blob is None:
+            return None
+        try:
+            rule = pickle.loads(blob)
+        except Exception as e:
+            log.debug("Warden - Failed to unpickle a cached rule", exc_info=e)
+            return None
+        if rule.raw_rule != raw_rule:
+            return None
+        self.used[key] = blob
+        return rule
+
+    def put(self, kind: str, rule: Union[WardenRule, WardenCheck]):
+        key = self.make_key(kind, rule.raw_rule)
+        try:
+            self.used[key] = pickle.dumps(rule, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            log.debug("Warden - Failed to pickle a rule", exc_info=e)
+            return
+        self.changed = True
+
+    def save(self):
+        """Writes the entries used since the last load, dropping the stale ones. Blocking"""
+        if self.path is None:
+            return
+        if not self.changed and len(self.used) == len(self.entries):
+            return
+        data = {"format": RULE_CACHE_FORMAT, "version": self.version, "entries": self.used}
+        tmp_path = self.path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log.warning("Warden - Failed to write the rule cache", exc_info=e)
+            return
+        self.entries = dict(self.used)
+        self.changed = False
@@ -0,0 +1,204 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from .enums import Condition, Event
+from ...enums import Rank
+from collections import defaultdict
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from .rule import WardenRule
+
+"""
+The active rules of a guild, with the lookups needed by the listeners kept precomputed.
+Every top level condition of a rule must pass for the rule to pass, so a rule that starts
+with, for example, a `user-id-matches-any` can only ever match the users it lists. Those
+rules are indexed by their discriminating condition and the listeners only evaluate the
+rules that can possibly match the event, plus the ones that couldn't be indexed.
+Caches are rebuilt lazily after the ruleset changes.
+"""
+
+# Most selective first: a rule is indexed by the first of these it has at its top level
+INDEXABLE_CONDITIONS = (
+    Condition.UserIdMatchesAny,
+    Condition.ChannelMatchesAny,
+    Condition.CategoryMatchesAny,
+    Condition.UserIsRank,
+)
+
+
+class EventIndex:
+    __slots__ = ("rules", "unindexed", "indexes")
+
+    def __init__(self, rules: List[WardenRule]):
+        self.rules = rules
+        self.unindexed: List[WardenRule] = []
+        self.indexes: Dict[Condition, Dict[int, List[WardenRule]]] = {
+            c: defaultdict(list) for c in INDEXABLE_CONDITIONS
+        }
+
+        for rule in rules:
+            keys = get_index_keys(rule)
+            if keys is None:
+                self.unindexed.append(rule)
+                continue
+            condition, values = keys
+            for value in values:
+                self.indexes[condition][value].append(rule)
+
+    def candidates(
+        self,
+        *,
+        rank: Optional[Rank] = None,
+        user_id: Optional[int] = None,
+        channel_id: Optional[int] = None,
+        category_id: Optional[int] = None,
+    ) -> List[WardenRule]:
+        lookups = (
+            (Condition.UserIdMatchesAny, user_id),
+            (Condition.ChannelMatchesAny, channel_id),
+            (Condition.CategoryMatchesAny, category_id),
+            (Condition.UserIsRank, int(rank) if rank is not None else None),
+        )
+        candidates = set(self.unindexed)
+        for condition, key in lookups:
+            if key is not None:
+                candidates.update(self.indexes[condition].get(key, ()))
+
+        if len(candidates) == len(self.rules):
+            return self.rules
+        return [r for r in self.rules if r in candidates]
+
+
+def get_index_keys(rule: WardenRule):
+    """Returns the most selective (condition, values) pair the rule can be indexed by, if any"""
+    scopes = (
+        (Condition.UserIdMatchesAny, rule.user_scope),
+        (Condition.ChannelMatchesAny, rule.channel_scope),
+        (Condition.CategoryMatchesAny, rule.category_scope),
+        (Condition.UserIsRank, rule.rank_scope),
+    )
+    for condition, scope in scopes:
+        if scope is not None:
+            return condition, scope
+
+    return None
+
+
+class GuildRuleset(dict):
+    """Maps rule names to the active rules of a guild"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+        self.changes: Dict[str, int] = {}  # Rule name -> version it was last added, replaced or removed at
+        self.cleared = 0  # Version the ruleset was last emptied at
+        self.guild_id: Optional[int] = None
+        self.on_change: Optional[Callable[[GuildRuleset], None]] = None
+        self._events: Dict[Event, EventIndex] = {}
+
+    def _changed(self, *names: str):
+        self.version += 1
+        for name in names:
+            self.changes[name] = self.version
+        self._events.clear()
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed(key)
+
+    def pop(self, *args):
+        result = super().pop(*args)
+        self._changed(args[0])
+        return result
+
+    def popitem(self):
+        result = super().popitem()
+        self._changed(result[0])
+        return result
+
+    def setdefault(self, key, default=None):
+        result = super().setdefault(key, default)
+        self._changed(key)
+        return result
+
+    def update(self, *args, **kwargs):
+        changes = dict(*args, **kwargs)
+        super().update(changes)
+        self._changed(*changes)
+
+    def clear(self):
+        super().clear()
+        self._changed()
+        self.cleared = self.version
+
+    def merge_changes(self, other: GuildRuleset, since: int):
+        """Applies what has been added, replaced or removed in another ruleset after its version since"""
+        if other.cleared > since:
+            super().clear()
+        for name, version in other.changes.items():
+            if version <= since:
+                continue
+            if name in other:
+                super().__setitem__(name, other[name])
+            else:
+                super().pop(name, None)
+        self._changed(*(name for name, version in other.changes.items() if version > since))
+
+    def _get_event_index(self, event: Event) -> EventIndex:
+        index = self._events.get(event)
+        if index is None:
+            rules = sorted((r for r in self.values() if event in r.events), key=lambda k: k.priority)
+            index = self._events[event] = EventIndex(rules)
+        return index
+
+    def by_event(self, event: Event) -> List[WardenRule]:
+        """The rules of an event, sorted by priority"""
+        return self._get_event_index(event).rules
+
+    def candidates(self, event: Event, **kwargs) -> List[WardenRule]:
+        """The rules of an event, sorted by priority, that can possibly match the
+        given rank / user ID / channel ID / category ID"""
+        return self._get_event_index(event).candidates(**kwargs)
+
+
+class GuildRulesets(dict):
+    """Maps guild IDs to their rulesets, creating them on first access like a defaultdict.
+    on_change is called whenever a ruleset is replaced or modified"""
+
+    def __init__(self, on_change: Optional[Callable[[GuildRuleset], None]] = None):
+        super().__init__()
+        self.on_change = on_change
+
+    def __missing__(self, guild_id: int) -> GuildRuleset:
+        ruleset = GuildRuleset()
+        self[guild_id] = ruleset
+        return ruleset
+
+    def __setitem__(self, guild_id: int, ruleset: GuildRuleset):
+        ruleset.guild_id = guild_id
+        ruleset.on_change = self.on_change
+        super().__setitem__(guild_id, ruleset)
+        if self.on_change is not None:
+            self.on_change(ruleset)
@@ -0,0 +1,140 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from multiprocessing.pool import Pool
+from typing import List, Optional, Tuple
+import regex as re
+import asyncio
+import logging
+
+"""
+User defined regex can be written, willingly or not, to take an unreasonable amount of time
+to complete. To keep the bot responsive they run in long lived worker processes.
+Jobs submitted during the same loop iteration are sent to the workers as a single batch, so
+that multiple regex conditions being evaluated together cost one round trip.
+The worker enforces each job's timeout through the regex module itself. If the workers
+fail to answer within a hard deadline anyway, the pool is torn down and a new one is spun up.
+"""
+
+REGEX_TIMEOUT = 3  # Seconds a single regex is allowed to run for
+HARD_DEADLINE = 5  # Seconds before a batch is considered lost and the workers recycled
+MAX_TASKS_PER_CHILD = 1000
+
+log = logging.getLogger("red.x26cogs.defender")
+
+
+class RegexTimeout(Exception):
+    pass
+
+
+class RegexSandbox:
+    def __init__(self, loop: asyncio.AbstractEventLoop, *, timeout=REGEX_TIMEOUT, deadline=HARD_DEADLINE):
+        self.loop = loop
+        self.timeout = timeout
+        self.deadline = deadline
+        self.pool = self._new_pool()
+        self._pending: List[Tuple[str, str, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+
+    def _new_pool(self):
+        return Pool(maxtasksperchild=MAX_TASKS_PER_CHILD)
+
+    async def findall(self, pattern: str, text: str) -> list:
+        """Runs regex.findall in the workers. Raises RegexTimeout if the regex
+        takes too long"""
+        fut = self.loop.create_future()
+        self._pending.append((pattern, text, fut))
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_soon(self._flush)
+        return await fut
+
+    def _flush(self):
+        self._flush_handle = None
+        jobs, self._pending = self._pending, []
+        if jobs:
+            self.loop.create_task(self._run_batch(jobs))
+
+    async def _run_batch(self, jobs: List[Tuple[str, str, asyncio.Future]]):
+        try:
+            results = await self._submit([(pattern, text) for pattern, text, _ in jobs])
+        except RegexTimeout:
+            if len(jobs) == 1:
+                self._resolve(jobs[0][2], exception=RegexTimeout())
+                return
+            # One or more regex timed out and took the whole batch down with them
+            # Let's find out which by running them one by one
+            for job in jobs:
+                self.loop.create_task(self._run_batch([job]))
+            return
+        except Exception as e:
+            for _, _, fut in jobs:
+                self._resolve(fut, exception=e)
+            return
+
+        for (_, _, fut), result in zip(jobs, results):
+            self._resolve(fut, result=result)
+
+    async def _submit(self, jobs: List[Tuple[str, str]]):
+        fut = self.loop.create_future()
+        # Arguments for regex.findall: pattern, string, flags, pos, endpos, overlapped, concurrent, timeout
+        # Patterns travel as strings and the regex module's own cache keeps them compiled in the workers
+        args = [(pattern, text, 0, None, None, False, None, self.timeout) for pattern, text in jobs]
+
+        def callback(result):
+            self.loop.call_soon_threadsafe(self._resolve, fut, result)
+
+        def error_callback(exc):
+            if isinstance(exc, TimeoutError):  # Raised by the regex module
+                exc = RegexTimeout()
+            self.loop.call_soon_threadsafe(self._resolve, fut, None, exc)
+
+        pool = self.pool
+        pool.starmap_async(re.findall, args, chunksize=len(args), callback=callback, error_callback=error_callback)
+
+        done, _ = await asyncio.wait((fut,), timeout=self.deadline)
+        if fut in done:
+            return fut.result()
+        else:
+            fut.cancel()
+            log.warning("Warden - The regex workers failed to answer in time. Recycling them.")
+            self._recycle(pool)
+            raise RegexTimeout()
+
+    def _recycle(self, pool: Pool):
+        if pool is not self.pool:  # Already recycled by another batch
+            return
+        self.pool = self._new_pool()
+        self.loop.run_in_executor(None, pool.terminate)
+
+    @staticmethod
+    def _resolve(fut: asyncio.Future, result=None, exception=None):
+        if fut.done():
+            return
+        if exception is not None:
+            fut.set_exception(exception)
+        else:
+            fut.set_result(result)
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for _, _, fut in self._pending:
+            fut.cancel()
+        self._pending = []
+        self.pool.close()
+        self.loop.run_in_executor(None, self.pool.join)
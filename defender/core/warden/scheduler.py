@@ -0,0 +1,331 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from collections import Counter, deque
+from typing import TYPE_CHECKING, Any, Callable, Coroutine, Deque, Dict, Optional, Tuple
+from ...exceptions import EventDropped
+import discord
+import asyncio
+import time
+
+if TYPE_CHECKING:
+    from ...abc import MixinMeta
+
+"""
+Rule evaluation runs on the same event loop for every guild, and a guild with a lot of
+expensive rules could hold it long enough to slow down everyone else, raids included.
+Each guild gets a time budget per event and per second. Only the time evaluation spends
+running counts against it: while it's waiting on I/O other tasks are running, not the guild.
+As long as a guild is within its budget its events are evaluated right away, as they always
+have been, whatever other guilds are doing. Once it goes over budget its events are queued,
+and a single dispatcher lets the queued events through one at a time, taking turns across
+guilds in weighted round robin. Guilds whose budget for the second has run out are skipped
+until it's renewed.
+Queues are bounded, when a guild is flooded its newest events are dropped without being
+evaluated and the staff is told how many were lost.
+Guilds that keep exceeding their budget are demoted for a while: their events are always
+queued, they get fewer turns and a fraction of the budget. The staff is told through the monitor.
+"""
+
+EVENT_BUDGET = 0.05  # Seconds of evaluation an event can use before yielding its turn
+SECOND_BUDGET = 0.25  # Seconds of evaluation a guild can use every second
+WINDOW = 1
+DEMOTION_STRIKES = 5  # Windows over budget in a row before a guild is demoted
+DEMOTION_TIME = 60 * 10
+DEMOTED_BUDGET_SHARE = 0.25  # Fraction of the budget a demoted guild gets
+NORMAL_WEIGHT = 4  # Queued events a guild can let through every round
+DEMOTED_WEIGHT = 1
+GUILD_QUEUE_SIZE = 100
+
+
+class GuildUsage:
+    __slots__ = ("guild", "window_start", "spent", "overrun", "strikes", "demoted_until")
+
+    def __init__(self, guild: discord.Guild, now: float):
+        self.guild = guild
+        self.window_start = now
+        self.spent = 0.0
+        self.overrun = False
+        self.strikes = 0
+        self.demoted_until: Optional[float] = None
+
+
+class GuildQueue:
+    """Events of a throttled guild waiting for their turn"""
+
+    __slots__ = ("guild", "waiting")
+
+    def __init__(self, guild: discord.Guild):
+        self.guild = guild
+        self.waiting: Deque[asyncio.Future] = deque()
+
+
+class Turn:
+    """The right for an event to evaluate rules. It can be released while the event is doing
+    something that doesn't need it, such as running actions, to let the next queued event in"""
+
+    __slots__ = ("scheduler", "guild", "held", "queued", "admitted", "spent")
+
+    def __init__(self, scheduler: FairScheduler, guild: discord.Guild):
+        self.scheduler = scheduler
+        self.guild = guild
+        self.held = False
+        self.queued = False
+        self.admitted = False  # Events are only dropped before they start being evaluated
+        self.spent = 0.0
+
+    async def acquire(self):
+        """Raises EventDropped if the event can't be queued"""
+        if not self.held:
+            await self.scheduler._acquire(self)
+
+    def release(self):
+        if self.held:
+            self.scheduler._release(self)
+
+    async def run(self, coro: Coroutine):
+        """Awaits an evaluation, charging the guild for the time it spends running"""
+        return await Metered(coro, self.charge, self.scheduler.clock)
+
+    def charge(self, elapsed: float):
+        self.spent += elapsed
+        self.scheduler.get_usage(self.guild).spent += elapsed
+
+    def exceeded(self) -> bool:
+        return self.spent >= self.scheduler.event_budget
+
+    async def pause(self):
+        """Gives other tasks a chance to run"""
+        self.release()
+        await asyncio.sleep(0)
+        await self.acquire()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args):
+        self.release()
+
+
+class Metered:
+    """Drives a coroutine, timing each of the steps it runs for until it's suspended"""
+
+    __slots__ = ("coro", "charge", "clock")
+
+    def __init__(self, coro: Coroutine, charge: Callable[[float], Any], clock: Callable[[], float]):
+        self.coro = coro
+        self.charge = charge
+        self.clock = clock
+
+    def __await__(self):
+        coro = self.coro
+        clock = self.clock
+        value: Any = None
+        error: Optional[BaseException] = None
+        while True:
+            start = clock()
+            try:
+                if error is None:
+                    yielded = coro.send(value)
+                else:
+                    yielded = coro.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.charge(clock() - start)
+            try:
+                value, error = (yield yielded), None
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                value, error = None, e
+
+
+async def running_time(coro: Coroutine) -> Tuple[Any, float]:
+    """Awaits a coroutine, returns its result and the time it spent running, leaving out
+    the time it spent waiting while other tasks ran"""
+    spent = 0.0
+
+    def charge(elapsed: float):
+        nonlocal spent
+        spent += elapsed
+
+    result = await Metered(coro, charge, time.perf_counter)
+    return result, spent
+
+
+class FairScheduler:
+    def __init__(
+        self,
+        cog: MixinMeta,
+        *,
+        event_budget=EVENT_BUDGET,
+        second_budget=SECOND_BUDGET,
+        queue_size=GUILD_QUEUE_SIZE,
+        clock=time.perf_counter,
+    ):
+        self.cog = cog
+        self.event_budget = event_budget
+        self.second_budget = second_budget
+        self.queue_size = queue_size
+        self.clock = clock
+        self.usage: Dict[int, GuildUsage] = {}
+        self.queues: Dict[int, GuildQueue] = {}
+        self.rotation: Deque[int] = deque()
+        self.dropped = Counter()
+        self._slice_done = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def turn(self, guild: discord.Guild) -> Turn:
+        return Turn(self, guild)
+
+    def get_usage(self, guild: discord.Guild) -> GuildUsage:
+        now = self.clock()
+        usage = self.usage.get(guild.id)
+        if usage is None:
+            usage = self.usage[guild.id] = GuildUsage(guild, now)
+            return usage
+
+        elapsed = now - usage.window_start
+        if elapsed >= WINDOW:
+            if usage.overrun or usage.spent >= self.get_budget(usage):
+                usage.strikes = usage.strikes + 1 if elapsed < WINDOW * 2 else 1
+            else:
+                usage.strikes = 0
+            usage.window_start = now
+            usage.spent = 0.0
+            usage.overrun = False
+
+            if usage.demoted_until is not None and now >= usage.demoted_until:
+                usage.demoted_until = None
+                self.cog.send_to_monitor(guild, "[Warden] Rule evaluation is no longer deprioritized.")
+            elif usage.demoted_until is None and usage.strikes >= DEMOTION_STRIKES:
+                usage.demoted_until = now + DEMOTION_TIME
+                usage.strikes = 0
+                self.cog.send_to_monitor(
+                    guild,
+                    f"[Warden] The rules of this server have exceeded their evaluation time budget "
+                    f"{DEMOTION_STRIKES} seconds in a row. Their evaluation will be deprioritized for "
+                    f"{DEMOTION_TIME // 60} minutes. Consider simplifying or disabling your most expensive rules.",
+                )
+        return usage
+
+    def get_budget(self, usage: GuildUsage) -> float:
+        if usage.demoted_until is not None:
+            return self.second_budget * DEMOTED_BUDGET_SHARE
+        return self.second_budget
+
+    def get_weight(self, usage: GuildUsage) -> int:
+        if usage.demoted_until is not None:
+            return DEMOTED_WEIGHT
+        return NORMAL_WEIGHT
+
+    def is_over_budget(self, usage: GuildUsage) -> bool:
+        return usage.spent >= self.get_budget(usage)
+
+    def is_throttled(self, usage: GuildUsage) -> bool:
+        return usage.demoted_until is not None or self.is_over_budget(usage)
+
+    async def _acquire(self, turn: Turn):
+        guild_id = turn.guild.id
+        queue = self.queues.get(guild_id)
+        # Events of a guild that's already queueing wait behind the others
+        if queue is None and not self.is_throttled(self.get_usage(turn.guild)):
+            turn.held = True
+            turn.admitted = True
+            turn.queued = False
+            turn.spent = 0.0
+            return
+
+        if queue is None:
+            queue = self.queues[guild_id] = GuildQueue(turn.guild)
+            self.rotation.append(guild_id)
+        elif not turn.admitted and len(queue.waiting) >= self.queue_size:
+            self.dropped[guild_id] += 1
+            raise EventDropped()
+        fut = asyncio.get_running_loop().create_future()
+        queue.waiting.append(fut)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():  # We were let through but won't go
+                self._slice_done.set()
+            raise
+        turn.held = True
+        turn.admitted = True
+        turn.queued = True
+        turn.spent = 0.0
+
+    def _release(self, turn: Turn):
+        turn.held = False
+        usage = self.get_usage(turn.guild)
+        if turn.spent >= self.event_budget:
+            usage.overrun = True
+        if turn.queued:
+            turn.queued = False
+            self._slice_done.set()
+
+    async def _dispatch(self):
+        while self.rotation:
+            guild_id = self.rotation[0]
+            queue = self.queues[guild_id]
+            usage = self.get_usage(queue.guild)
+            if self.is_over_budget(usage):
+                if not all(self.is_over_budget(self.get_usage(self.queues[g].guild)) for g in self.rotation):
+                    self.rotation.rotate(-1)
+                    continue
+                # Everyone waiting is over budget, wait for the earliest window to end
+                earliest = min(self.usage[g].window_start for g in self.rotation)
+                await asyncio.sleep(max(0, earliest + WINDOW - self.clock()))
+                continue
+
+            let_through = 0
+            while queue.waiting and let_through < self.get_weight(usage) and not self.is_over_budget(usage):
+                fut = queue.waiting.popleft()
+                if fut.done():  # Cancelled while waiting
+                    continue
+                let_through += 1
+                self._slice_done.clear()
+                fut.set_result(None)
+                await self._slice_done.wait()
+
+            dropped = self.dropped.pop(guild_id, 0)
+            if dropped:
+                self.cog.send_to_monitor(
+                    queue.guild,
+                    f"[Warden] {dropped} event(s) have not been evaluated: too many were queued at once.",
+                )
+            if queue.waiting:
+                self.rotation.rotate(-1)
+            else:
+                self.rotation.popleft()
+                del self.queues[guild_id]
+
+    def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        for queue in self.queues.values():
+            for fut in queue.waiting:
+                fut.cancel()
+        self.queues.clear()
+        self.rotation.clear()
@@ -0,0 +1,206 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import defaultdict, deque
+from typing import Dict, Optional, Set
+import discord
+import math
+
+"""
+Execution counters of the Warden rules, kept per guild and per rule name so that they
+outlive the rule objects, which are replaced every time a rule is edited or reloaded.
+Recording is a handful of additions, the percentiles are only computed when asked for.
+Only the counters, the total and the longest evaluation time are saved: the recent evaluation
+times the percentiles and throttling are based on are kept in memory and start over on a reload.
+If the owner sets a threshold, rules whose recent average evaluation time goes over it are
+throttled: they are either evaluated on a fraction of their events or suspended until the staff
+resumes them. Their YAML is left untouched. Periodic runs are never throttled.
+"""
+
+STATS_SAMPLES = 200  # Most recent evaluation times kept in memory for the percentiles
+THROTTLE_MIN_SAMPLES = 50  # Evaluations needed before judging a rule's performance
+SAMPLE_RATE = 10  # Sampled rules are evaluated on 1 event in N
+DISCORD_EPOCH_SHIFT = 22  # Bits below the creation timestamp in a Discord ID
+
+SAMPLED = "sampled"
+SUSPENDED = "suspended"
+
+# These are mirrored from the owner's settings
+THROTTLE_THRESHOLD = 0  # Milliseconds. 0 disables throttling
+THROTTLE_MODE = SAMPLED
+
+
+class RuleStats:
+    __slots__ = (
+        "evaluations",
+        "passes",
+        "actions",
+        "failures",
+        "total_time",
+        "max_time",
+        "samples",
+        "samples_total",
+        "last_fired",
+        "throttle",
+    )
+
+    def __init__(self):
+        self.evaluations = 0
+        self.passes = 0
+        self.actions = 0
+        self.failures = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.samples = deque(maxlen=STATS_SAMPLES)
+        self.samples_total = 0.0
+        self.last_fired: Optional[float] = None  # Timestamp
+        self.throttle: Optional[str] = None
+
+    def record_evaluation(self, duration: float, passed: bool):
+        self.evaluations += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+        if len(self.samples) == self.samples.maxlen:
+            self.samples_total -= self.samples[0]
+        self.samples.append(duration)
+        self.samples_total += duration
+        if passed:
+            self.passes += 1
+
+    def record_actions(self, timestamp: float, *, failed: bool):
+        self.actions += 1
+        self.last_fired = timestamp
+        if failed:
+            self.failures += 1
+
+    @property
+    def average_time(self) -> float:
+        return self.total_time / self.evaluations if self.evaluations else 0.0
+
+    @property
+    def rolling_average_time(self) -> float:
+        return self.samples_total / len(self.samples) if self.samples else 0.0
+
+    def should_evaluate(self, event_id: Optional[int] = None) -> bool:
+        """Event ID is the ID of the message or user the event is about. Sampled rules are
+        evaluated on the events whose ID was created on 1 millisecond out of N, so which
+        ones doesn't depend on the order events come in"""
+        if self.throttle is None:
+            return True
+        if self.throttle == SUSPENDED:
+            return False
+        return event_id is None or (event_id >> DISCORD_EPOCH_SHIFT) % SAMPLE_RATE == 0
+
+    def check_throttle(self) -> bool:
+        """Throttles the rule if it has become too expensive. Returns True if it has just been throttled"""
+        if self.throttle is not None or not THROTTLE_THRESHOLD or len(self.samples) < THROTTLE_MIN_SAMPLES:
+            return False
+        if self.rolling_average_time * 1000 <= THROTTLE_THRESHOLD:
+            return False
+        self.throttle = SUSPENDED if THROTTLE_MODE == SUSPENDED else SAMPLED
+        return True
+
+    def suspend(self):
+        self.throttle = SUSPENDED
+
+    def resume(self):
+        self.throttle = None
+        self.samples.clear()
+        self.samples_total = 0.0
+
+    @property
+    def p95_time(self) -> float:
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[max(0, math.ceil(len(samples) * 0.95) - 1)]
+
+    def to_dict(self) -> dict:
+        return {
+            "evaluations": self.evaluations,
+            "passes": self.passes,
+            "actions": self.actions,
+            "failures": self.failures,
+            "total_time": self.total_time,
+            "max_time": self.max_time,
+            "last_fired": self.last_fired,
+            "throttle": self.throttle,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        stats = cls()
+        stats.evaluations = data.get("evaluations", 0)
+        stats.passes = data.get("passes", 0)
+        stats.actions = data.get("actions", 0)
+        stats.failures = data.get("failures", 0)
+        stats.total_time = data.get("total_time", 0.0)
+        stats.max_time = data.get("max_time", 0.0)
+        stats.last_fired = data.get("last_fired")
+        stats.throttle = data.get("throttle")
+        return stats
+
+
+class WardenStats:
+    def __init__(self):
+        self.guilds: Dict[int, Dict[str, RuleStats]] = defaultdict(dict)
+        self.dirty: Set[int] = set()
+
+    def get(self, guild_id: int, rule_name: str) -> RuleStats:
+        self.dirty.add(guild_id)
+        stats = self.guilds[guild_id].get(rule_name)
+        if stats is None:
+            stats = self.guilds[guild_id][rule_name] = RuleStats()
+        return stats
+
+    def load(self, guild_id: int, data: dict):
+        self.guilds[guild_id] = {name: RuleStats.from_dict(d) for name, d in data.items()}
+
+    def discard(self, guild_id: int, rule_name: Optional[str] = None):
+        self.dirty.add(guild_id)
+        if rule_name is None:
+            self.guilds.pop(guild_id, None)
+        else:
+            self.guilds[guild_id].pop(rule_name, None)
+
+    def export_dirty(self) -> Dict[int, dict]:
+        """Returns the stats that changed since the last export, ready to be saved"""
+        dirty, self.dirty = self.dirty, set()
+        return {
+            guild_id: {name: stats.to_dict() for name, stats in self.guilds.get(guild_id, {}).items()}
+            for guild_id in dirty
+        }
+
+
+async def save_rule_stats(cog, guild: discord.Guild, rule_name: str, stats: RuleStats):
+    """Saves the stats of a rule right away, such as when it's throttled or resumed, rather
+    than at the next periodic save, so that its state survives a restart"""
+    await cog.config.guild(guild).wd_rule_stats.set_raw(rule_name, value=stats.to_dict())
+
+
+async def notify_throttled_rule(cog, guild: discord.Guild, rule_name: str, stats: RuleStats, *, reason: str):
+    if stats.throttle == SUSPENDED:
+        outcome = "It has been suspended and won't be evaluated anymore"
+    else:
+        outcome = f"From now on it will only be evaluated on 1 event out of {SAMPLE_RATE}"
+    await cog.send_notification(
+        guild,
+        f"The Warden rule `{rule_name}` {reason}. {outcome}. The rule itself has not been modified: "
+        "once it has been made lighter, re-add it or resume it with `[p]def warden resume`.",
+        title="👮 • Warden",
+    )
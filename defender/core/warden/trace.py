@@ -0,0 +1,169 @@
+"""
+Defender - Protects your community with automod features and
+           empowers the staff and users you trust with
+           advanced moderation tools
+Copyright (C) 2020-present  Twentysix (https://github.com/Twentysix26/)
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from .enums import Action, Condition, ConditionBlock
+from itertools import islice
+from time import perf_counter_ns
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+import random
+
+if TYPE_CHECKING:
+    from .rule import WardenRule, WDStatement
+
+"""
+A trace records what an evaluation of a rule went through: each statement it got to, how
+deep in the rule it is, its result and how long it took. Entries are plain tuples stored in a
+buffer allocated beforehand, and are only turned into text when someone asks to see them.
+Traces are used by the debug command, and on a sampled fraction of the evaluations of the
+rules the staff is profiling: those are added up per statement, for as long as the rule is
+loaded, to find out which of its statements are the expensive ones.
+"""
+
+TRACE_SIZE = 256  # Statements recorded per evaluation, any past that are only counted
+DEFAULT_PROFILE_RATE = 5  # Percent of the evaluations of a rule that are traced when profiling it
+
+# (depth, statement, result, duration in ns). The result and duration of a statement that
+# has been interrupted, such as by a failed action, are None
+TraceEntry = Tuple[int, "WDStatement", Optional[bool], Optional[int]]
+
+
+def format_ns(ns: int) -> str:
+    return f"{ns / 1_000_000:.3f}ms"
+
+
+class Trace:
+    __slots__ = ("entries", "starts", "size", "dropped")
+
+    def __init__(self):
+        self.entries: List[Optional[TraceEntry]] = [None] * TRACE_SIZE
+        self.starts = [0] * TRACE_SIZE
+        self.size = 0
+        self.dropped = 0
+
+    def enter(self, depth: int, statement: WDStatement) -> int:
+        i = self.size
+        if i == TRACE_SIZE:
+            self.dropped += 1
+            return -1
+        self.entries[i] = (depth, statement, None, None)
+        self.size = i + 1
+        self.starts[i] = perf_counter_ns()
+        return i
+
+    def exit(self, i: int, result: Optional[bool]):
+        if i < 0:
+            return
+        duration = perf_counter_ns() - self.starts[i]
+        self.entries[i] = (self.entries[i][0], self.entries[i][1], result, duration)
+
+    def __iter__(self) -> Iterator[TraceEntry]:
+        return islice(self.entries, self.size)
+
+    def __len__(self):
+        return self.size
+
+    def render(self, *, timings=False) -> List[str]:
+        lines = []
+        open_blocks: List[TraceEntry] = []
+
+        def close_block(entry: TraceEntry):
+            depth, statement, result, duration = entry
+            if duration is None:
+                return
+            line = f"{' ' * (depth + 1)}[<] {statement.enum.value} block"
+            if isinstance(statement.enum, ConditionBlock):
+                line += f" ({result})"
+            if timings:
+                line += f" {format_ns(duration)}"
+            lines.append(line)
+
+        for entry in self:
+            depth, statement, result, duration = entry
+            while open_blocks and open_blocks[-1][0] >= depth:
+                close_block(open_blocks.pop())
+            indent = " " * (depth + 1)
+            if isinstance(statement.enum, (Condition, Action)):
+                line = f"{indent}[=] {statement.enum.value}"
+                if duration is not None:
+                    line += " (Done)" if isinstance(statement.enum, Action) else f" ({result})"
+                    if timings:
+                        line += f" {format_ns(duration)}"
+                lines.append(line)
+            else:
+                lines.append(f"{indent}[>] {statement.enum.value} block")
+                open_blocks.append(entry)
+        while open_blocks:
+            close_block(open_blocks.pop())
+
+        if self.dropped:
+            lines.append(f"({self.dropped} more statements not recorded)")
+        return lines
+
+
+class RuleProfile:
+    """Timings of the statements of a rule, added up from a sample of its evaluations"""
+
+    __slots__ = ("rate", "samples", "timings")
+
+    def __init__(self, rate: float):
+        self.rate = rate  # Fraction of the evaluations that are traced
+        self.samples = 0
+        self.timings: Dict[WDStatement, List[int]] = {}  # Statement -> [count, total ns, max ns]
+
+    def sample(self) -> Optional[Trace]:
+        """A trace for the evaluation if it's one of those sampled"""
+        return Trace() if random.random() < self.rate else None
+
+    def add(self, trace: Trace):
+        self.samples += 1
+        timings = self.timings
+        for _, statement, _, duration in trace:
+            if duration is None:
+                continue
+            timing = timings.get(statement)
+            if timing is None:
+                timings[statement] = [1, duration, duration]
+            else:
+                timing[0] += 1
+                timing[1] += duration
+                if duration > timing[2]:
+                    timing[2] = duration
+
+    def render(self, rule: WardenRule) -> List[str]:
+        lines = []
+        for section, tree in (("if:", rule.cond_tree), ("do:", rule.action_tree)):
+            lines.append(section)
+            for depth, statement in _walk(tree):
+                label = statement.enum.value
+                if not isinstance(statement.enum, (Condition, Action)):
+                    label += " block"
+                timing = self.timings.get(statement)
+                if timing is None:
+                    stats = "never reached"
+                else:
+                    count, total, longest = timing
+                    stats = f"{count}x, {format_ns(total // count)} avg, {format_ns(longest)} max"
+                lines.append(f"{' ' * (depth + 1)}{label}: {stats}")
+        return lines
+
+
+def _walk(tree: dict, depth=0) -> Iterator[Tuple[int, WDStatement]]:
+    for statement, value in tree.items():
+        yield depth, statement
+        if isinstance(value, dict):
+            yield from _walk(value, depth + 1)
@@ -1,72 +1,442 @@
 from rapidfuzz import fuzz, process
-from redbot.core.utils import AsyncIter
-import emoji
 import regex as re
 import discord
 import logging
 import functools
+import fnmatch
 import asyncio
-import multiprocessing
+import yaml
+from string import Template
+from pydantic import BaseModel
+from typing import Optional
+from .sandbox import RegexTimeout
+from . import stats as rule_stats
+from .estimate import estimate_affected, find_affected, rule_predicate
 
-EMOJI_RE = re.compile(r"<a?:[a-zA-Z0-9\_]+:([0-9]+)>")
-REMOVE_C_EMOJIS_RE = re.compile(r"<a?:[a-zA-Z0-9\_]+:[0-9]+>")
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+GLOB_SPECIAL_CHARS = ("*", "?", "[")
+REGEX_CACHE_SIZE = 1024
+TEMPLATE_CACHE_SIZE = 4096
+INLINE_REGEX_TIMEOUT = 0.5
+REPEAT_OPS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, getattr(sre_constants, "POSSESSIVE_REPEAT", None))
+LINEAR_OPS = (
+    sre_constants.LITERAL,
+    sre_constants.NOT_LITERAL,
+    sre_constants.ANY,
+    sre_constants.IN,
+    sre_constants.AT,
+)
+CATEGORY_PATTERNS = {
+    sre_constants.CATEGORY_DIGIT: re.compile(r"\d"),
+    sre_constants.CATEGORY_WORD: re.compile(r"\w"),
+    sre_constants.CATEGORY_SPACE: re.compile(r"\s"),
+}
+NEGATED_CATEGORIES = {
+    sre_constants.CATEGORY_NOT_DIGIT: sre_constants.CATEGORY_DIGIT,
+    sre_constants.CATEGORY_NOT_WORD: sre_constants.CATEGORY_WORD,
+    sre_constants.CATEGORY_NOT_SPACE: sre_constants.CATEGORY_SPACE,
+}
+MAX_SEARCH_WIDTH = 1000  # Characters an unanchored pattern can go through before it can fail
+ENUMERABLE_RANGE = 512  # Character ranges up to this size are compared character by character
+# A set of characters is (negated, elements): the elements are characters, (low, high) ranges
+# of code points and categories. Everything is a negated empty set
+ALL_CHARS = (True, frozenset())
+NO_CHARS = (False, frozenset())
+
+# In memory copies of the owner settings, kept in sync by their commands
+REGEX_ALLOWED = False
+REGEX_SAFETY_CHECKS = True
 
 log = logging.getLogger("red.x26cogs.defender")
 
-# Based on d.py's EmojiConverter
-# https://github.com/Rapptz/discord.py/blob/master/discord/ext/commands/converter.py
 
+class GlobMatcher:
+    """
+    Matches text against a list of case insensitive glob patterns in a single pass
+    Patterns without wildcards are plain equality checks and end up in a set, the others are
+    translated by fnmatch and joined into one regex, so the semantics are the same of
+    calling fnmatch.fnmatch(text.lower(), pattern.lower()) for each pattern
+    """
+
+    __slots__ = ("literals", "regex")
+
+    def __init__(self, patterns):
+        literals = set()
+        globs = []
+        for pattern in patterns:
+            pattern = str(pattern).lower()
+            if any(c in pattern for c in GLOB_SPECIAL_CHARS):
+                globs.append(fnmatch.translate(pattern))
+            else:
+                literals.add(pattern)
+        self.literals = frozenset(literals)
+        self.regex = re.compile("|".join(globs)) if globs else None
+
+    def match(self, text: str) -> bool:
+        return self.match_lowered(text.lower())
+
+    def match_lowered(self, text: str) -> bool:
+        if text in self.literals:
+            return True
+        if self.regex is not None:
+            return self.regex.match(text) is not None
+        return False
+
+    def match_word(self, text: str) -> bool:
+        """Whether any of the whitespace separated words in the text matches"""
+        return self.match_any_word(set(text.lower().split()))
+
+    def match_any_word(self, words) -> bool:
+        """Words must be lowercase"""
+        if not self.literals.isdisjoint(words):
+            return True
+        if self.regex is not None:
+            for word in words:
+                if self.regex.match(word) is not None:
+                    return True
+        return False
+
+
+@functools.lru_cache(maxsize=REGEX_CACHE_SIZE)
+def compile_user_regex(regex: str):
+    """Compiled user regex are shared across rules and guilds"""
+    return re.compile(regex)
+
+
+class CompiledTemplate:
+    """
+    A string parameter of a rule, ready to have the context variables substituted in
+    Strings without a $ are constants and are returned as they are
+    """
+
+    __slots__ = ("string", "template", "identifiers")
+
+    def __init__(self, string: str):
+        self.string = string
+        if "$" in string:
+            self.template = Template(string)
+            identifiers = []
+            for match in self.template.pattern.finditer(string):
+                name = match.group("named") or match.group("braced")
+                if name is not None and name not in identifiers:
+                    identifiers.append(name)
+            self.identifiers = tuple(identifiers)
+        else:
+            self.template = None
+            self.identifiers = ()
+
+    @property
+    def constant(self) -> bool:
+        return self.template is None
+
+    def substitute(self, state: dict) -> str:
+        if self.template is None:
+            return self.string
+        return self.template.safe_substitute(state)
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(string: str) -> CompiledTemplate:
+    """Compiled templates are shared across rules and guilds"""
+    return CompiledTemplate(string)
+
+
+def precompile_templates(value) -> set:
+    """Compiles the templates of every string in a statement's parameters.
+    Returns the context variables they reference"""
+    identifiers = set()
+    if isinstance(value, str):
+        identifiers.update(compile_template(value).identifiers)
+    elif isinstance(value, BaseModel):
+        for name in type(value).model_fields:
+            identifiers |= precompile_templates(getattr(value, name))
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            identifiers |= precompile_templates(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            identifiers |= precompile_templates(v)
+    return identifiers
+
+
+def is_regex_linear(pattern: str) -> bool:
+    """Static check for patterns that can be searched for in linear time: no nested
+    quantifiers, no ambiguous alternations under repetition, no quantifiers that can
+    match the same characters one after the other and no backreferences. As a search
+    tries the pattern at every position, it also has to be anchored or fail within a
+    bounded number of characters, see _is_search_linear.
+    Anything we can't parse or reason about is considered unsafe"""
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return False
+    ignorecase = bool(parsed.state.flags & sre_constants.SRE_FLAG_IGNORECASE)
+    if not _is_subpattern_linear(parsed, repeated=False, ignorecase=ignorecase):
+        return False
+    if _scan_sequence(parsed, [], ignorecase) is None:
+        return False
+    return _is_search_linear(parsed, multiline=bool(parsed.state.flags & sre_constants.SRE_FLAG_MULTILINE))
+
+
+def _is_search_linear(subpattern, *, multiline: bool) -> bool:
+    r"""A pattern that's linear at a given position can still take quadratic time to search for:
+    \w+\s+\w+ goes through the rest of a long word at every position before failing. Unless
+    the pattern is anchored to the start, everything but its last item must have a bounded
+    length. So must the last item, or what it repeats: once it has matched nothing can fail"""
+    items = list(subpattern)
+    if not items:
+        return True
+    op, av = items[0]
+    if op is sre_constants.AT:
+        if av is sre_constants.AT_BEGINNING_STRING or (av is sre_constants.AT_BEGINNING and not multiline):
+            return True
+    if len(items) == 1 and op is sre_constants.BRANCH:
+        return all(_is_search_linear(branch, multiline=multiline) for branch in av[1])
+    if len(items) == 1 and op is sre_constants.SUBPATTERN:
+        return _is_search_linear(av[-1], multiline=multiline)
+
+    def bounded(data) -> bool:
+        return sre_parse.SubPattern(subpattern.state, list(data)).getwidth()[1] <= MAX_SEARCH_WIDTH
+
+    if not bounded(items[:-1]):
+        return False
+    op, av = items[-1]
+    return bounded(items[-1:]) or (op in REPEAT_OPS and bounded(av[2]))
+
+
+def _is_subpattern_linear(subpattern, *, repeated: bool, ignorecase: bool) -> bool:
+    for op, av in subpattern:
+        if op in REPEAT_OPS:
+            _min, _max, item = av
+            if _min == _max:  # Fixed counts can't be ambiguous
+                inner_repeated = repeated
+            elif repeated:
+                return False  # Nested quantifiers
+            else:
+                inner_repeated = _max > 1
+            if not _is_subpattern_linear(item, repeated=inner_repeated, ignorecase=ignorecase):
+                return False
+        elif op is sre_constants.BRANCH:
+            branches = av[1]
+            if repeated:
+                first_chars = set()
+                for branch in branches:
+                    if not branch or branch[0][0] is not sre_constants.LITERAL:
+                        return False
+                    char = chr(branch[0][1])
+                    first_chars.add(char.lower() if ignorecase else char)
+                if len(first_chars) != len(branches):
+                    return False  # Ambiguous alternation
+            for branch in branches:
+                if not _is_subpattern_linear(branch, repeated=repeated, ignorecase=ignorecase):
+                    return False
+        elif op is sre_constants.SUBPATTERN:
+            if not _is_subpattern_linear(av[-1], repeated=repeated, ignorecase=ignorecase):
+                return False
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if not _is_subpattern_linear(av[1], repeated=repeated, ignorecase=ignorecase):
+                return False
+        elif op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return False
+        elif op not in LINEAR_OPS:
+            return False
+
+    return True
+
+
+def _scan_sequence(subpattern, open_sets: list, ignorecase: bool) -> Optional[list]:
+    r"""Goes through a sequence keeping the characters of the quantifiers that could still be
+    matching, as in a \w+ before a \d: a quantifier that can match any of those makes the
+    pattern polynomial, as in \w+\d\w+. A required character that none of them can match
+    ends them. Returns what's still open at the end, or None if the sequence is ambiguous"""
+    for op, av in subpattern:
+        if op is sre_constants.AT:
+            continue
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if _scan_sequence(av[1], [], ignorecase) is None:
+                return None
+        elif op is sre_constants.SUBPATTERN:
+            open_sets = _scan_sequence(av[-1], open_sets, ignorecase)
+            if open_sets is None:
+                return None
+        elif op is sre_constants.BRANCH:
+            merged = []
+            for branch in av[1]:
+                branch_sets = _scan_sequence(branch, open_sets, ignorecase)
+                if branch_sets is None:
+                    return None
+                merged.extend(branch_sets)
+            open_sets = merged
+        elif op in REPEAT_OPS:
+            _min, _max, item = av
+            if _min == _max:  # The same as writing the item that many times, twice is enough to tell
+                for _ in range(min(_min, 2)):
+                    open_sets = _scan_sequence(item, open_sets, ignorecase)
+                    if open_sets is None:
+                        return None
+                continue
+            chars = _item_chars(item, ignorecase)
+            if any(_chars_overlap(s, chars) for s in open_sets):
+                return None
+            if _scan_sequence(item, [], ignorecase) is None:
+                return None
+            # At least one of its characters is required: the others can't be matching anymore
+            open_sets = [chars] if _min >= 1 else open_sets + [chars]
+        else:
+            chars = _char_set(op, av, ignorecase)
+            open_sets = [s for s in open_sets if _chars_overlap(s, chars)]
+    return open_sets
+
+
+def _literal_chars(code: int, ignorecase: bool) -> set:
+    char = chr(code)
+    if not ignorecase:
+        return {char}
+    return {char, char.lower(), char.upper(), char.swapcase()}
+
+
+def _char_set(op, av, ignorecase: bool) -> tuple:
+    """The characters a single character item can match"""
+    if op is sre_constants.LITERAL:
+        return False, frozenset(_literal_chars(av, ignorecase))
+    if op is sre_constants.NOT_LITERAL:
+        return True, frozenset(_literal_chars(av, ignorecase))
+    if op is not sre_constants.IN:
+        return ALL_CHARS
+    if len(av) == 1 and av[0][0] is sre_constants.CATEGORY and av[0][1] in NEGATED_CATEGORIES:
+        return True, frozenset((NEGATED_CATEGORIES[av[0][1]],))  # \D, \W or \S
+    negated = False
+    elements = set()
+    for item_op, item_av in av:
+        if item_op is sre_constants.NEGATE:
+            negated = True
+        elif item_op is sre_constants.LITERAL:
+            elements |= _literal_chars(item_av, ignorecase)
+        elif item_op is sre_constants.RANGE:
+            low, high = item_av
+            if ignorecase and high >= 128:
+                return ALL_CHARS
+            elements.add((low, high))
+            if ignorecase:  # The other case of the ASCII letters in the range
+                if max(low, 97) <= min(high, 122):
+                    elements.add((max(low, 97) - 32, min(high, 122) - 32))
+                if max(low, 65) <= min(high, 90):
+                    elements.add((max(low, 65) + 32, min(high, 90) + 32))
+        elif item_op is sre_constants.CATEGORY and item_av in CATEGORY_PATTERNS:
+            elements.add(item_av)
+        else:
+            return ALL_CHARS
+    return negated, frozenset(elements)
+
+
+def _item_chars(subpattern, ignorecase: bool) -> tuple:
+    """Every character a subpattern could match"""
+    chars = NO_CHARS
+    for op, av in subpattern:
+        if op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            continue
+        if op is sre_constants.SUBPATTERN:
+            item_chars = _item_chars(av[-1], ignorecase)
+        elif op is sre_constants.BRANCH:
+            item_chars = NO_CHARS
+            for branch in av[1]:
+                item_chars = _union_chars(item_chars, _item_chars(branch, ignorecase))
+        elif op in REPEAT_OPS:
+            item_chars = _item_chars(av[2], ignorecase)
+        else:
+            item_chars = _char_set(op, av, ignorecase)
+        chars = _union_chars(chars, item_chars)
+    return chars
+
+
+def _union_chars(a: tuple, b: tuple) -> tuple:
+    if a == NO_CHARS or b == NO_CHARS:
+        return b if a == NO_CHARS else a
+    if a[0] or b[0]:
+        return ALL_CHARS  # Not worth being precise about
+    return False, a[1] | b[1]
+
+
+def _chars_overlap(a: tuple, b: tuple) -> bool:
+    if a[0] and b[0]:
+        return True
+    if a[0]:
+        a, b = b, a
+    if b[0]:  # Unless all of a is excluded by b
+        return not all(_element_excluded(element, b[1]) for element in a[1])
+    return any(_elements_overlap(x, y) for x in a[1] for y in b[1])
 
-def has_x_or_more_emojis(bot: discord.Client, guild: discord.Guild, text: str, limit: int):
-    n = emoji.emoji_count(text)
 
-    if n >= limit:
+def _elements_overlap(x, y) -> bool:
+    if isinstance(y, str) or (isinstance(y, tuple) and not isinstance(x, str)):
+        x, y = y, x
+    if isinstance(x, str):
+        if isinstance(y, str):
+            return x == y
+        if isinstance(y, tuple):
+            return y[0] <= ord(x) <= y[1]
+        return CATEGORY_PATTERNS[y].match(x) is not None
+    if isinstance(x, tuple):
+        if isinstance(y, tuple):
+            return x[0] <= y[1] and y[0] <= x[1]
+        if x[1] - x[0] < ENUMERABLE_RANGE:
+            return any(CATEGORY_PATTERNS[y].match(chr(c)) for c in range(x[0], x[1] + 1))
         return True
+    # Two categories: digits are word characters, whitespace is neither
+    return x == y or {x, y} == {sre_constants.CATEGORY_DIGIT, sre_constants.CATEGORY_WORD}
 
-    if "<" in text:  # No need to run a regex if no custom emoji can be present
-        n += len(list(re.finditer(EMOJI_RE, text)))
 
-    return n >= limit
+def _element_excluded(element, excluded: frozenset) -> bool:
+    if isinstance(element, str):
+        return any(_elements_overlap(element, e) for e in excluded)
+    if isinstance(element, tuple):
+        low, high = element
+        if any(isinstance(e, tuple) and e[0] <= low and high <= e[1] for e in excluded):
+            return True
+        if high - low < ENUMERABLE_RANGE:
+            return all(_element_excluded(chr(c), excluded) for c in range(low, high + 1))
+        return False
+    if element == sre_constants.CATEGORY_DIGIT and sre_constants.CATEGORY_WORD in excluded:
+        return True
+    return element in excluded
 
 
-async def run_user_regex(*, rule_obj, cog, guild: discord.Guild, regex: str, text: str):
+async def run_user_regex(*, rule_obj, cog, guild: discord.Guild, regex, text: str, inline=False):
     # This implementation is similar to what reTrigger does for safe-ish user regex. Thanks Trusty!
     # https://github.com/TrustyJAID/Trusty-cogs/blob/4d690f6ce51c1c5ebf98a2e05ff504ea26eac30b/retrigger/triggerhandler.py
-    allowed = await cog.config.wd_regex_allowed()
-    safety_checks_enabled = await cog.config.wd_regex_safety_checks()
+    if not REGEX_ALLOWED:
+        return False
 
-    if not allowed:
+    if regex is None:
+        log.error(f"Warden - Rule {rule_obj.name} contains a regex that failed to compile.\nGuild: {guild.id}")
         return False
 
     # TODO This section might benefit from locks in case of faulty rules?
 
-    if safety_checks_enabled:
+    if REGEX_SAFETY_CHECKS:
         try:
-            regex_obj = re.compile(regex)  # type: ignore
-            process = cog.wd_pool.apply_async(regex_obj.findall, (text,))
-            task = functools.partial(process.get, timeout=3)
-            new_task = cog.bot.loop.run_in_executor(None, task)
-            result = await asyncio.wait_for(new_task, timeout=5)
-        except (multiprocessing.TimeoutError, asyncio.TimeoutError):
+            if inline:
+                # Linear time regex don't need the sandbox, the timeout is just a backstop
+                result = regex.search(text, timeout=INLINE_REGEX_TIMEOUT)
+            else:
+                result = await cog.wd_regex.findall(regex.pattern, text)
+        except (RegexTimeout, TimeoutError):
             log.warning(
-                f"Warden - User defined regex timed out. This rule has been disabled."
-                f"\nGuild: {guild.id}\nRegex: {regex}"
+                f"Warden - User defined regex timed out. This rule has been suspended."
+                f"\nGuild: {guild.id}\nRegex: {regex.pattern}"
             )
-            cog.active_warden_rules[guild.id].pop(rule_obj.name, None)
-            cog.invalid_warden_rules[guild.id][rule_obj.name] = rule_obj
-            async with cog.config.guild(guild).wd_rules() as warden_rules:
-                # There's no way to disable rules for now. So, let's just break it :D
-                rule_obj.raw_rule = (
-                    ":!!! Regex in this rule perform poorly. Fix the issue and remove this line !!!:\n"
-                    + rule_obj.raw_rule
+            stats = cog.wd_stats.get(guild.id, rule_obj.name)
+            if stats.throttle != rule_stats.SUSPENDED:
+                stats.suspend()
+                await rule_stats.save_rule_stats(cog, guild, rule_obj.name, stats)
+                await rule_stats.notify_throttled_rule(
+                    cog, guild, rule_obj.name, stats, reason="contains a regex that has timed out"
                 )
-                warden_rules[rule_obj.name] = rule_obj.raw_rule
-            await cog.send_notification(
-                guild,
-                f"The Warden rule `{rule_obj.name}` has been disabled for poor regex performances. "
-                f"Please fix it to prevent this from happening again in the future.",
-                title="👮 • Warden",
-            )
             return False
         except Exception as e:
             log.error("Warden - Unexpected error while running user defined regex", exc_info=e)
@@ -75,12 +445,24 @@ async def run_user_regex(*, rule_obj, cog, guild: discord.Guild, regex: str, tex
             return bool(result)
     else:
         try:
-            return bool(re.search(regex, text))
+            return bool(regex.search(text))
         except Exception as e:
             log.error(f"Warden - Unexpected error while running user defined regex with no safety checks", exc_info=e)
             return False
 
 
+def load_yaml_batch(raw_rules: list) -> list:
+    """Runs in a worker. Rules that fail to load are returned as None: the regular
+    parse will go through them again and report the error"""
+    results = []
+    for raw_rule in raw_rules:
+        try:
+            results.append(yaml.safe_load(raw_rule))
+        except Exception:
+            results.append(None)
+    return results
+
+
 def make_fuzzy_suggestion(term, _list):
     result = process.extract(term, _list, limit=1, scorer=fuzz.QRatio)
     result = [r for r in result if r[1] > 10]
@@ -99,9 +481,12 @@ async def delete_message_after(message: discord.Message, sleep_for: int):
 
 
 async def rule_add_periodic_prompt(*, cog, message: discord.Message, new_rule):
+    # The prefilter depends on the rule module, which depends on this one
+    from .prefilter import MemberSnapshot, prefilter_members
+
     confirm_emoji = "✅"
+    count_emoji = "🔢"
     guild = message.guild
-    affected = 0
     channel = message.channel
     async with channel.typing():
         msg: discord.Message = await channel.send(
@@ -109,35 +494,56 @@ async def rule_add_periodic_prompt(*, cog, message: discord.Message, new_rule):
         )
 
         def confirm(r, user):
-            return user == message.author and str(r.emoji) == confirm_emoji and r.message.id == msg.id
+            return user == message.author and str(r.emoji) in (confirm_emoji, count_emoji) and r.message.id == msg.id
 
-        async for m in AsyncIter(guild.members, steps=2):
-            if m.bot:
-                continue
-            if m.joined_at is None:
-                continue
-            rank = await cog.rank_user(m)
-            if await new_rule.satisfies_conditions(rank=rank, user=m, guild=guild, cog=cog):
-                affected += 1
+        members = await prefilter_members(new_rule, MemberSnapshot(guild))
+        predicate = rule_predicate(cog, new_rule, guild)
+        estimate = await estimate_affected(members, predicate)
 
-    if affected >= 10 or affected >= len(guild.members) / 2:
-        await msg.edit(
-            content=f"You're adding a periodic rule. At the first run {affected} users will be affected. "
+    if estimate.high >= 10 or estimate.high >= len(guild.members) / 2:
+        content = (
+            f"You're adding a periodic rule. At the first run {estimate.describe()} will be affected. "
             "Are you sure you want to continue?"
         )
+        if not estimate.exact:
+            content += f" React with {count_emoji} to have the exact number counted while you decide."
+        await msg.edit(content=content)
         await msg.add_reaction(confirm_emoji)
-        try:
-            await cog.bot.wait_for("reaction_add", check=confirm, timeout=15)
-        except asyncio.TimeoutError:
-            await channel.send("Not adding the rule.")
-            return False
-        else:
-            return True
+        if not estimate.exact:
+            await msg.add_reaction(count_emoji)
+
+        count_task = None
+        counted = False
+        while True:
+            try:
+                r, _ = await cog.bot.wait_for("reaction_add", check=confirm, timeout=15)
+            except asyncio.TimeoutError:
+                if count_task is not None and not counted:
+                    # The decision waits for the count, and for a while after it's out
+                    counted = count_task.done()
+                    continue
+                await channel.send("Not adding the rule.")
+                return False
+            if str(r.emoji) == confirm_emoji:
+                return True
+            if count_task is None and not estimate.exact:
+                # Keeps going in the background if the rule is added in the meantime
+                count_task = asyncio.create_task(count_affected_job(channel, members, predicate))
     else:
         await msg.edit(content="Safety checks passed.")
         return True
 
 
+async def count_affected_job(channel, members, predicate):
+    msg = await channel.send(f"Counting the affected users... 0/{len(members)}")
+
+    async def progress(evaluated, total):
+        await msg.edit(content=f"Counting the affected users... {evaluated}/{total}")
+
+    affected = await find_affected(members, predicate, progress=progress)
+    await msg.edit(content=f"At the first run **{len(affected)} users** will be affected.")
+
+
 async def rule_add_overwrite_prompt(*, cog, message: discord.Message):
     save_emoji = "💾"
     channel = message.channel
@@ -16,6 +16,8 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from .enums import Action, Condition, Event
+from .utils import GlobMatcher, compile_user_regex, is_regex_linear
+from .names import find_role
 from typing import List, Union, Optional, Dict, ClassVar, Tuple
 from redbot.core.commands.converter import parse_timedelta, BadArgument
 from pydantic_core import PydanticCustomError, CoreSchema, core_schema
@@ -28,6 +30,7 @@ from pydantic import (
 from pydantic import conint, conlist, ValidationError, GetCoreSchemaHandler
 from pydantic_core import InitErrorDetails
 from functools import partial
+from collections import OrderedDict
 from typing_extensions import Any
 from datetime import timedelta, datetime
 from ...exceptions import InvalidRule
@@ -421,9 +424,7 @@ class RolesList(NonEmptyList):
         is_server_owner = author.id == guild.owner_id
 
         for role_id_or_name in self.value:
-            role = guild.get_role(role_id_or_name)
-            if role is None:
-                role = discord.utils.get(guild.roles, name=role_id_or_name)
+            role = find_role(guild, role_id_or_name)
             if role is None:
                 raise InvalidRule(f"`{action_or_cond.value}`: Role `{role_id_or_name}` doesn't seem to exist.")
             roles.append(role)
@@ -447,6 +448,13 @@ class NonEmptyListStr(BaseModel):
     value: conlist(str, min_length=1)
 
 
+class GlobList(NonEmptyListStr):
+    _matcher: Optional[GlobMatcher] = None
+
+    def model_post_init(self, __context):
+        self._matcher = GlobMatcher(self.value)
+
+
 class StatusList(NonEmptyListStr):
     async def _runtime_check(self, *, cog, author: discord.Member, action_or_cond: Union[Action, Condition]):
         for status in self.value:
@@ -465,6 +473,17 @@ class IsStr(BaseModel):
 
 
 class IsRegex(IsStr):
+    _compiled: Optional[Any] = None
+    _inline: bool = False  # Provably linear, no need for the sandbox
+
+    def model_post_init(self, __context):
+        try:
+            self._compiled = compile_user_regex(self.value)
+        except Exception:
+            pass  # Rules being added are rejected by the runtime check, the others will log at evaluation
+        else:
+            self._inline = is_regex_linear(self.value)
+
     async def _runtime_check(self, *, cog, author: discord.Member, action_or_cond: Union[Action, Condition]):
         enabled: bool = await cog.config.wd_regex_allowed()
         if not enabled:
@@ -472,6 +491,8 @@ class IsRegex(IsStr):
                 f"`{action_or_cond.value}` Regex use is globally disabled. The bot owner must use "
                 "`[p]dset warden regexallowed` to activate it."
             )
+        if self._compiled is None:
+            raise InvalidRule(f"`{action_or_cond.value}` The regex is not valid.")
 
 
 #
@@ -538,18 +559,18 @@ class IsRank(BaseModel):
 # The accepted types of each condition for basic sanity checking
 CONDITIONS_VALIDATORS = {
     Condition.UserIdMatchesAny: NonEmptyListInt,
-    Condition.UsernameMatchesAny: NonEmptyListStr,
+    Condition.UsernameMatchesAny: GlobList,
     Condition.UsernameMatchesRegex: IsRegex,
-    Condition.NicknameMatchesAny: NonEmptyListStr,
+    Condition.NicknameMatchesAny: GlobList,
     Condition.NicknameMatchesRegex: IsRegex,
-    Condition.DisplayNameMatchesAny: NonEmptyListStr,
+    Condition.DisplayNameMatchesAny: GlobList,
     Condition.DisplayNameMatchesRegex: IsRegex,
-    Condition.MessageMatchesAny: NonEmptyListStr,
+    Condition.MessageMatchesAny: GlobList,
     Condition.MessageMatchesRegex: IsRegex,
-    Condition.MessageContainsWord: NonEmptyListStr,
+    Condition.MessageContainsWord: GlobList,
     Condition.UserCreatedLessThan: UserJoinedCreated,
     Condition.UserJoinedLessThan: UserJoinedCreated,
-    Condition.UserActivityMatchesAny: NonEmptyListStr,
+    Condition.UserActivityMatchesAny: GlobList,
     Condition.UserStatusMatchesAny: StatusList,
     Condition.UserHasDefaultAvatar: IsBool,
     Condition.ChannelMatchesAny: NonEmptyList,
@@ -795,6 +816,26 @@ ALLOWED_DEBUG_ACTIONS = [
 
 DEPRECATED = []
 
+# Short form follows the order the attributes are declared in, unless the model says otherwise
+for _validator in (*ACTIONS_VALIDATORS.values(), *CONDITIONS_VALIDATORS.values()):
+    if not _validator._short_form:
+        _validator._short_form = tuple(_validator.model_fields)
+del _validator
+
+INTERNED_MODELS_SIZE = 4096
+# Immutable models of identical statements are shared, across rules and guilds
+_interned_models: "OrderedDict[tuple, BaseModel]" = OrderedDict()
+
+
+def _freeze(value):
+    """A hashable copy of a statement's parameter. Types are kept apart: 1, "1" and true differ"""
+    if isinstance(value, dict):
+        return (dict, tuple(sorted(((_freeze(k), _freeze(v)) for k, v in value.items()), key=repr)))
+    if isinstance(value, (list, tuple)):
+        return (list, tuple(_freeze(v) for v in value))
+    hash(value)  # Raises TypeError if it's not hashable
+    return (type(value), value)
+
 
 def model_validator(
     action_or_cond: Union[Action, Condition], parameter: Union[list, dict, str, int, bool]
@@ -814,14 +855,32 @@ def model_validator(
     except KeyError:
         validator = CONDITIONS_VALIDATORS[action_or_cond]  # type: ignore
 
+    if not validator.model_config.get("frozen"):
+        return _build_model(validator, parameter)
+
+    try:
+        key = (action_or_cond, _freeze(parameter))
+    except TypeError:
+        return _build_model(validator, parameter)
+
+    model = _interned_models.get(key)
+    if model is not None:
+        _interned_models.move_to_end(key)
+        return model
+
+    model = _build_model(validator, parameter)
+    _interned_models[key] = model
+    if len(_interned_models) > INTERNED_MODELS_SIZE:
+        _interned_models.popitem(last=False)
+    return model
+
+
+def _build_model(validator, parameter):
     # Long form
     if not validator._single_value and isinstance(parameter, dict):
         return validator(**parameter)
 
     # Short form
-    if not validator._short_form:
-        validator._short_form = [k for k in validator.model_json_schema()["properties"]]
-
     args = {}
     if validator._single_value is False:
         if isinstance(parameter, list):
@@ -21,6 +21,7 @@ from collections import Counter, defaultdict
 from redbot.core.utils.chat_formatting import pagify
 from redbot.core.utils import AsyncIter
 from redbot.core import modlog
+from redbot.core.data_manager import cog_data_path
 from .abc import CompositeMetaClass
 from .core.automodules import AutoModules
 from .commands import Commands
@@ -29,13 +30,23 @@ from .enums import Rank, Action, EmergencyModules, PerspectiveAttributes
 from .exceptions import InvalidRule
 from .core.warden.rule import WardenRule
 from .core.warden.enums import Event as WardenEvent
-from .core.warden import heat, api as WardenAPI
+from .core.warden import heat, api as WardenAPI, utils as wd_utils, stats as rule_stats
+from .core.warden.sandbox import RegexSandbox
+from .core.warden.executor import ActionExecutor
+from .core.warden.scheduler import FairScheduler
+from .core.warden.stats import WardenStats
+from .core.warden.rule_cache import RuleCache, RULE_CACHE_FILENAME
+from .core.warden.ruleset import GuildRuleset, GuildRulesets
+from .core.warden.periodic import PeriodicScheduler
+from .core.warden.prefilter import prefilter_members, get_snapshot, discard_snapshots
+from .core.warden.incremental import DirtyMembers, get_changed_members
+from .core.warden.names import discard_names
 from .core.announcements import get_announcements_text
 from .core.cache import CacheUser
 from .core.utils import utcnow, timestamp
 from .core import cache as df_cache
-from multiprocessing.pool import Pool
 from zlib import crc32
+from concurrent.futures import ProcessPoolExecutor
 from string import Template
 from discord import ui
 import datetime
@@ -45,6 +56,10 @@ import logging
 
 log = logging.getLogger("red.x26cogs.defender")
 
+WD_LOAD_BATCH_SIZE = 50  # Rules per YAML loading job at startup
+WD_LOAD_POOL_THRESHOLD = 500  # Rules to parse at startup above which processes are used instead of threads
+WD_CONCURRENT_EVAL_LIMIT = 8  # Max Warden rules of a guild having their conditions evaluated at the same time
+
 default_guild_settings = {
     "enabled": False,  # Defender system toggle
     "notify_channel": 0,  # Staff channel where notifications are sent. Supposed to be private.
@@ -78,7 +93,10 @@ default_guild_settings = {
     "join_monitor_susp_subs": [],  # Staff members subscribed to suspicious join notifications
     "join_monitor_wdchecks": "",
     "warden_enabled": True,
+    "warden_concurrent_eval": False,  # Evaluate the conditions of all the rules of an event at once
     "wd_rules": {},  # Warden rules | I have to break the naming convention here due to config.py#L798
+    "wd_rule_stats": {},  # Execution stats of the Warden rules, by rule name
+    "wd_periodic_rescan_hours": 24,  # Hours between full runs of the incremental periodic rules
     "ca_enabled": False,  # Comment analysis
     "ca_token": None,  # CA token
     "ca_attributes": [PerspectiveAttributes.SevereToxicity.value],  # Attributes to query
@@ -115,6 +133,8 @@ default_owner_settings = {
     "wd_periodic_allowed": True,  # Allows the creation of periodic Warden rules
     "wd_upload_max_size": 3,  # Max size for Warden rule upload (in kilobytes)
     "wd_regex_safety_checks": True,  # Performance safety checks for user defined regex
+    "wd_throttle_threshold": 0,  # Avg evaluation time (ms) above which a Warden rule gets throttled. 0 = off
+    "wd_throttle_mode": "sampled",  # What happens to throttled rules: sampled / suspended
 }
 
 
@@ -139,16 +159,24 @@ class Defender(Commands, AutoModules, Events, commands.Cog, metaclass=CompositeM
         self.counter_task = self.loop.create_task(self.persist_counter())
         self.staff_activity = {}
         self.emergency_mode = {}
-        self.active_warden_rules = defaultdict(lambda: dict())
+        self.wd_periodic = PeriodicScheduler(self)
+        self.wd_dirty = DirtyMembers()
+        self.active_warden_rules = GuildRulesets(on_change=self.wd_periodic.ruleset_changed)
         self.invalid_warden_rules = defaultdict(lambda: dict())
         self.warden_checks = defaultdict(lambda: dict())
+        self.wd_eval_semaphores = defaultdict(lambda: asyncio.Semaphore(WD_CONCURRENT_EVAL_LIMIT))
         self.loop.create_task(self.load_warden_rules())
         self.loop.create_task(self.send_announcements())
         self.loop.create_task(self.load_cache_settings())
         self.mc_task = self.loop.create_task(self.message_cache_cleaner())
         self.wd_periodic_task = self.loop.create_task(self.wd_periodic_rules())
         self.monitor = defaultdict(lambda: Deque(maxlen=500))
-        self.wd_pool = Pool(maxtasksperchild=1000)
+        self.wd_regex = RegexSandbox(self.loop)
+        self.wd_executor = ActionExecutor(self)
+        self.wd_scheduler = FairScheduler(self)
+        self.wd_stats = WardenStats()
+        self.wd_rule_cache = RuleCache(cog_data_path(self) / RULE_CACHE_FILENAME, self.__version__)
+        self.wd_stats_task = self.loop.create_task(self.persist_wd_stats())
         self.quick_actions = defaultdict(lambda: dict())
 
     async def rank_user(self, member: discord.Member):
@@ -345,63 +373,87 @@ class Defender(Commands, AutoModules, Events, commands.Cog, metaclass=CompositeM
         except asyncio.CancelledError:
             pass
 
+    async def persist_wd_stats(self):
+        try:
+            while True:
+                await asyncio.sleep(60 * 10)
+                await self.save_wd_stats()
+        except asyncio.CancelledError:
+            pass
+
+    async def save_wd_stats(self):
+        unsaved = self.wd_stats.export_dirty()
+        try:
+            for guid in list(unsaved):
+                await self.config.guild_from_id(guid).wd_rule_stats.set(unsaved[guid])
+                del unsaved[guid]
+                await asyncio.sleep(0)
+        finally:
+            # If we're interrupted, what hasn't been saved yet will be next time
+            self.wd_stats.dirty.update(unsaved)
+
     async def wd_periodic_rules(self):
         try:
             await self.bot.wait_until_red_ready()
-            while True:
-                await asyncio.sleep(60)
-                if await self.config.wd_periodic_allowed():
-                    await self.spin_wd_periodic_rules()
+            await self.wd_periodic.run()
         except asyncio.CancelledError:
             pass
         except Exception as e:
             log.error(f"Defender's scheduler for Warden periodic rules errored: {e}")
 
-    async def spin_wd_periodic_rules(self):
-        all_guild_rules = self.active_warden_rules.copy()
-        tasks = []
-
-        for guid in all_guild_rules.keys():
-            guild = self.bot.get_guild(guid)
-            if guild is None:
-                continue
-            if await self.bot.cog_disabled_in_guild(self, guild):  # type: ignore
-                continue
+    async def run_wd_periodic_rule(self, guild_id: int, rule: WardenRule):
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            return
+        if not await self.config.wd_periodic_allowed():
+            return
+        if await self.bot.cog_disabled_in_guild(self, guild):  # type: ignore
+            return
+        if not await self.config.guild(guild).enabled():
+            return
+        if not await self.config.guild(guild).warden_enabled():
+            return
 
-            rules = self.get_warden_rules_by_event(guild, WardenEvent.Periodic)
+        snapshot = get_snapshot(guild)
+        since = None
+        if rule.incremental:
+            rescan_hours = await self.config.guild(guild).wd_periodic_rescan_hours()
+            since = self.wd_dirty.begin_scan(guild.id, rule, rescan_interval=rescan_hours * 3600)
 
-            if not rules:
-                continue
+        if since is None:
+            # Cheap conditions are applied to all the members at once, only the survivors go through the rule
+            members = await prefilter_members(rule, snapshot)
+        else:
+            # Members also change rank as they stop being new to the server
+            rank3_days = await self.config.guild(guild).rank3_joined_days()
+            members = await get_changed_members(
+                rule,
+                snapshot,
+                self.wd_dirty,
+                since,
+                extra_thresholds=[("joined_at", datetime.timedelta(days=rank3_days))],
+            )
 
-            if not await self.config.guild(guild).enabled():
-                continue
+        # Periodic runs aren't throttled, but a rule the staff has to resume doesn't run
+        if self.wd_stats.get(guild.id, rule.name).throttle == rule_stats.SUSPENDED:
+            return
 
-            if not await self.config.guild(guild).warden_enabled():
+        async for member in AsyncIter(members, steps=2):
+            rank = await self.rank_user(member)
+            if not rule.admits(WardenEvent.Periodic, rank, user_id=member.id):
                 continue
+            if await self.evaluate_warden_rule(rule, rank=rank, guild=member.guild, user=member, throttle=False):
+                stats = self.wd_stats.get(guild.id, rule.name)
+                try:
+                    await rule.do_actions(cog=self, guild=member.guild, user=member)
+                    stats.record_actions(utcnow().timestamp(), failed=False)
+                except Exception as e:
+                    stats.record_actions(utcnow().timestamp(), failed=True)
+                    self.send_to_monitor(guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}")
 
-            tasks.append(self.exec_wd_period_rules(guild, rules))
-
-        if tasks:
-            await asyncio.gather(*tasks)
-
-    async def exec_wd_period_rules(self, guild, rules):
-        for rule in rules:
-            if not rule.next_run <= utcnow() or rule.run_every is None:
-                continue
-            async for member in AsyncIter(guild.members, steps=2):
-                if member.bot:
-                    continue
-                if member.joined_at is None:
-                    continue
-                rank = await self.rank_user(member)
-                if await rule.satisfies_conditions(cog=self, rank=rank, guild=member.guild, user=member):
-                    try:
-                        await rule.do_actions(cog=self, guild=member.guild, user=member)
-                    except Exception as e:
-                        self.send_to_monitor(
-                            guild, f"[Warden] Rule {rule.name} " f"({rule.last_action.value}) - {str(e)}"
-                        )
-            rule.next_run = utcnow() + rule.run_every
+        if rule.incremental:
+            self.wd_dirty.finish_scan(guild.id, rule, started=snapshot.timestamp, full=since is None)
+            self.wd_dirty.prune(guild.id, lambda r: self.wd_periodic.is_active(guild.id, r))
 
     async def load_warden_rules(self):
         rules_to_load = defaultdict()
@@ -411,31 +463,98 @@ class Defender(Commands, AutoModules, Events, commands.Cog, metaclass=CompositeM
                 if "wd_rules" in guild_data:
                     if guild_data["wd_rules"]:
                         rules_to_load[guid] = guild_data["wd_rules"].copy()
+                if guild_data.get("wd_rule_stats"):
+                    self.wd_stats.load(int(guid), guild_data["wd_rule_stats"])
+        # Rules can be added, edited or removed while we're loading: those changes are applied on top
+        start_versions = {guid: self._get_ruleset_version(int(guid)) for guid in rules_to_load}
+
+        rule_cache = self.wd_rule_cache
+        await self.loop.run_in_executor(None, rule_cache.load)
+
+        # The biggest communities get protected first
+        def priority(guid):
+            guild = self.bot.get_guild(int(guid))
+            return -(guild.member_count or 0) if guild else 0
 
-        for guid, rules in rules_to_load.items():
-            for rule in rules.values():
-                new_rule = WardenRule()
-                # If the rule ends up not even having a name some extreme level of fuckery is going on
-                # At that point we might as well pretend it doesn't exist at config level
+        guild_order = sorted(rules_to_load.keys(), key=priority)
+
+        # The YAML of the rules that aren't cached is loaded in parallel batches, in the same order
+        # the guilds will be processed in, so that the first guilds don't wait on the others
+        to_parse = {
+            guid: [r for r in rules_to_load[guid].values() if not rule_cache.has("rule", r)] for guid in guild_order
+        }
+        n_to_parse = sum(len(r) for r in to_parse.values())
+        executor = ProcessPoolExecutor() if n_to_parse >= WD_LOAD_POOL_THRESHOLD else None
+        try:
+            yaml_data = {}
+            for guid, raw_rules in to_parse.items():
+                batches = [
+                    self.loop.run_in_executor(executor, wd_utils.load_yaml_batch, raw_rules[i : i + WD_LOAD_BATCH_SIZE])
+                    for i in range(0, len(raw_rules), WD_LOAD_BATCH_SIZE)
+                ]
+                yaml_data[guid] = asyncio.gather(*batches)
+
+            for guid in guild_order:
+                loaded = [data for batch in await yaml_data[guid] for data in batch]
+                loaded = dict(zip(to_parse[guid], loaded))
+                ruleset = GuildRuleset()
+                await self.load_guild_warden_rules(int(guid), rules_to_load[guid].values(), ruleset, loaded)
+                # Rules may have been added, edited or removed while we were busy loading
+                current = self.active_warden_rules.get(int(guid))
+                if current is not None:
+                    ruleset.merge_changes(current, start_versions[guid])
+                # Warden goes live in this guild as soon as its rules are ready
+                self.active_warden_rules[int(guid)] = ruleset
+                await asyncio.sleep(0)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+        await WardenAPI.load_modules_checks()
+        await self.loop.run_in_executor(None, rule_cache.save)
+
+    def _get_ruleset_version(self, guild_id: int) -> int:
+        ruleset = self.active_warden_rules.get(guild_id)
+        return ruleset.version if ruleset is not None else 0
+
+    async def load_guild_warden_rules(self, guild_id: int, raw_rules, ruleset: GuildRuleset, loaded: dict):
+        rule_cache = self.wd_rule_cache
+        for rule in raw_rules:
+            cached_rule = rule_cache.get("rule", rule)
+            if cached_rule is not None:
                 try:
-                    await new_rule.parse(rule, self)
-                except InvalidRule as e:
-                    if new_rule.name is not None:
-                        self.invalid_warden_rules[int(guid)][new_rule.name] = new_rule  # type: ignore
-                    else:
-                        log.error("Warden - rule did not reach name " "parsing during cog load", exc_info=e)
-                except Exception as e:
-                    if new_rule.name is not None:
-                        self.invalid_warden_rules[int(guid)][new_rule.name] = new_rule  # type: ignore
-                    log.error("Warden - unexpected error during cog load rule parsing", exc_info=e)
+                    await cached_rule.restore(self)
+                except InvalidRule:
+                    pass  # Let the full parse handle it
                 else:
-                    self.active_warden_rules[int(guid)][new_rule.name] = new_rule
+                    ruleset[cached_rule.name] = cached_rule
+                    continue
 
-        await WardenAPI.load_modules_checks()
+            new_rule = WardenRule()
+            # If the rule ends up not even having a name some extreme level of fuckery is going on
+            # At that point we might as well pretend it doesn't exist at config level
+            try:
+                await new_rule.parse(rule, self, data=loaded.get(rule))
+            except InvalidRule as e:
+                if new_rule.name is not None:
+                    self.invalid_warden_rules[guild_id][new_rule.name] = new_rule  # type: ignore
+                else:
+                    log.error("Warden - rule did not reach name " "parsing during cog load", exc_info=e)
+            except Exception as e:
+                if new_rule.name is not None:
+                    self.invalid_warden_rules[guild_id][new_rule.name] = new_rule  # type: ignore
+                log.error("Warden - unexpected error during cog load rule parsing", exc_info=e)
+            else:
+                ruleset[new_rule.name] = new_rule
+                rule_cache.put("rule", new_rule)
 
     async def load_cache_settings(self):
         df_cache.MSG_STORE_CAP = await self.config.cache_cap()
         df_cache.MSG_EXPIRATION_TIME = await self.config.cache_expiration()
+        wd_utils.REGEX_ALLOWED = await self.config.wd_regex_allowed()
+        wd_utils.REGEX_SAFETY_CHECKS = await self.config.wd_regex_safety_checks()
+        rule_stats.THROTTLE_THRESHOLD = await self.config.wd_throttle_threshold()
+        rule_stats.THROTTLE_MODE = await self.config.wd_throttle_mode()
 
     async def send_announcements(self):
         new_announcements = get_announcements_text(only_recent=True)
@@ -477,12 +596,20 @@ class Defender(Commands, AutoModules, Events, commands.Cog, metaclass=CompositeM
 
             await asyncio.sleep(0.5)
 
-    def cog_unload(self):
+    async def cog_unload(self):
         self.counter_task.cancel()
         self.wd_periodic_task.cancel()
+        self.wd_periodic.close()
+        discard_snapshots()
+        discard_names()
         self.mc_task.cancel()
-        self.wd_pool.close()
-        self.bot.loop.run_in_executor(None, self.wd_pool.join)
+        self.wd_regex.close()
+        self.wd_executor.close()
+        self.wd_scheduler.close()
+        # The stats that changed since the last periodic save, including any it was in the middle
+        # of saving, would be lost otherwise
+        self.wd_stats_task.cancel()
+        await self.save_wd_stats()
 
     async def callout_if_fake_admin(self, ctx):
         if ctx.invoked_subcommand is None:
@@ -506,6 +633,11 @@ class Defender(Commands, AutoModules, Events, commands.Cog, metaclass=CompositeM
 
     async def inc_message_count(self, member):
         self.message_counter[member.guild.id][member.id] += 1
+        if self.wd_dirty.is_tracked(member.guild.id):
+            # Reaching the minimum amount of messages turns rank 4 users into rank 3
+            min_messages = await self.config.guild(member.guild).rank3_min_messages()
+            if await self.get_total_recorded_messages(member) == min_messages:
+                self.wd_dirty.mark(member)
 
     async def is_helper(self, member: discord.Member):
         helper_roles = await self.config.guild(member.guild).helper_roles()
@@ -618,9 +750,10 @@ class Defender(Commands, AutoModules, Events, commands.Cog, metaclass=CompositeM
             return False
 
     def get_warden_rules_by_event(self, guild: discord.Guild, event: WardenEvent) -> List[WardenRule]:
-        rules = self.active_warden_rules.get(guild.id, {}).values()
-        rules = [r for r in rules if event in r.events]
-        return sorted(rules, key=lambda k: k.priority)
+        ruleset = self.active_warden_rules.get(guild.id)
+        if ruleset is None:
+            return []
+        return ruleset.by_event(event)
 
     async def format_punish_message(self, member: discord.Member):
         text = await self.config.guild(member.guild).punish_message()
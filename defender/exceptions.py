@@ -38,3 +38,7 @@ class ExecutionError(WardenException):
 
 class StopExecution(WardenException):
     pass
+
+
+class EventDropped(WardenException):
+    pass
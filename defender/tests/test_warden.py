@@ -1,16 +1,41 @@
-from ..core.warden.enums import Action, Condition, ChecksKeys
+from ..core.warden.enums import Action, Condition, ChecksKeys, ConditionBlock, Event
 from ..enums import Rank
-from ..core.warden.validation import CONDITIONS_VALIDATORS, ACTIONS_VALIDATORS
+from ..core.warden.validation import CONDITIONS_VALIDATORS, ACTIONS_VALIDATORS, IsRegex
 from ..core.warden.validation import CONDITIONS_ANY_CONTEXT, CONDITIONS_USER_CONTEXT, CONDITIONS_MESSAGE_CONTEXT
 from ..core.warden.validation import ACTIONS_ANY_CONTEXT, ACTIONS_USER_CONTEXT, ACTIONS_MESSAGE_CONTEXT, BaseModel
-from ..core.warden.rule import WardenRule, WardenCheck
+from ..core.warden.validation import model_validator
+from ..core.warden.rule import WardenRule, WardenCheck, ConditionMemo
 from ..core.warden import heat
+from ..core.warden.sandbox import RegexSandbox, RegexTimeout
+from ..core.warden.ruleset import GuildRuleset, GuildRulesets
+from ..core.warden import periodic
+from ..core.warden.prefilter import MemberSnapshot, get_prefilters, prefilter_members
+from ..core.warden.incremental import DirtyMembers, get_changed_members
+from ..core.warden.estimate import estimate_affected, find_affected
+from ..core.warden import names as wd_names
+from ..core.warden.trace import Trace, RuleProfile, TRACE_SIZE
+from ..core.warden.executor import ActionExecutor
+from ..core.warden.scheduler import FairScheduler, DEMOTION_STRIKES, running_time
+from ..core.warden.stats import WardenStats
+from ..core.warden import stats as rule_stats
+from ..core.warden.rule_cache import RuleCache
+from ..core.warden.utils import GlobMatcher, compile_user_regex, is_regex_linear, load_yaml_batch, compile_template
 from ..core.warden.rule import WardenRule
 from ..core.utils import utcnow
-from ..exceptions import InvalidRule
+from ..core.events import Events
+from ..core.features import get_features, count_unicode_emojis
+from ..exceptions import InvalidRule, EventDropped
 from . import wd_sample_rules as rl
+from collections import defaultdict
 from datetime import timedelta
+from functools import partial
 from discord import Activity
+import asyncio
+import emoji
+import fnmatch
+import heapq
+import random
+import time
 import pytest
 
 
@@ -27,6 +52,9 @@ class FakeRole:
         self.id = _id
         self.name = name
 
+    def is_default(self):
+        return self.id == FakeGuild.id
+
 
 class FakeGuild:
     id = 852_499_907_842_801_727
@@ -74,6 +102,10 @@ class FakeUser:
     roles = {}
     activities = [Activity(name="fake activity"), Activity(name="spam")]
 
+    @property
+    def _roles(self):
+        return [r.id for r in self.roles]
+
 
 FAKE_USER = FakeUser()
 
@@ -523,7 +555,7 @@ async def test_conditions():
     FAKE_MESSAGE.role_mentions = ["<@26262626262626>", "<@26262626262626>"]
     await eval_cond(Condition.MessageContainsMTRolePings, 1, True)
 
-    FAKE_MESSAGE.clean_content = "2626"
+    FAKE_MESSAGE.content = FAKE_MESSAGE.clean_content = "2626"  # Clean content derives from the content
     await eval_cond(Condition.MessageHasMTCharacters, 3, True)
     await eval_cond(Condition.MessageHasMTCharacters, 4, False)
 
@@ -593,6 +625,45 @@ async def test_conditions():
         await eval_cond(Condition.MessageHasAttachment, {"value": True}, True)
 
 
+def test_glob_matcher():
+    patterns = (
+        ["*spider*"],
+        ["c?ts", "DOGS"],
+        ["[!a]b", "[a-c]*", "x[", "[]]x", "\\x"],
+        ["hello", "*.png", "h*o w*d", "*"],
+        ["12345", "?", "[0-9][0-9]"],
+    )
+    texts = (
+        "",
+        "spider",
+        "Big SPIDER here",
+        "cats",
+        "cts",
+        "dogs",
+        "bb",
+        "ab",
+        "x[",
+        "]x",
+        "\\x",
+        "hello",
+        "image.PNG",
+        "hello world",
+        "hello\nworld",
+        "12345",
+        "7",
+        "42",
+        "a-b",
+    )
+
+    for pattern_list in patterns:
+        matcher = GlobMatcher(pattern_list)
+        for text in texts:
+            expected = any(fnmatch.fnmatch(text.lower(), p.lower()) for p in pattern_list)
+            assert matcher.match(text) is expected, (pattern_list, text)
+            expected = any(fnmatch.fnmatch(w, p.lower()) for w in text.lower().split() for p in pattern_list)
+            assert matcher.match_word(text) is expected, (pattern_list, text)
+
+
 @pytest.mark.asyncio
 async def test_warden_checks():
     wd_check = WardenCheck()
@@ -616,3 +687,1040 @@ async def test_warden_checks():
 
     with pytest.raises(InvalidRule, match=r".*checks should be a list of conditions*"):
         await wd_check.parse(rl.TEST_MATH, cog=None, author=None, module=ChecksKeys.CommentAnalysis)
+
+
+def test_regex_precompile():
+    first = IsRegex(value="h[e3]llo")
+    second = IsRegex(value="h[e3]llo")
+    assert first._compiled is not None
+    assert first._compiled is second._compiled
+    assert first._compiled is compile_user_regex("h[e3]llo")
+    assert first._compiled.search("say h3llo")
+
+    assert IsRegex(value="[unclosed")._compiled is None
+
+
+@pytest.mark.asyncio
+async def test_regex_sandbox():
+    sandbox = RegexSandbox(asyncio.get_running_loop(), timeout=0.5)
+    try:
+        results = await asyncio.gather(
+            sandbox.findall(r"h[e3]llo", "hello h3llo"),
+            sandbox.findall(r"(x+x+)+y", "x" * 5000),
+            sandbox.findall(r"\d+", "no digits"),
+            return_exceptions=True,
+        )
+        assert results[0] == ["hello", "h3llo"]
+        assert isinstance(results[1], RegexTimeout)
+        assert results[2] == []
+    finally:
+        sandbox.close()
+
+
+def test_regex_linear_analysis():
+    linear = (
+        r"foo|bar",
+        r"^hello\s+world$",
+        r"(?:foo|bar)+",
+        r"\d{3}-\d{4}",
+        r"(\d{3}-)+",
+        r"^[a-z]+@[a-z]+\.com",
+        r"^\w+\s+\w+",
+        r"\A[^@]+@[^@]+",
+        r"^\S+\s+\S+",
+        r"(?:https?://)?discord\.gg/\w+",
+    )
+    unsafe = (
+        r"(a+)+",
+        r"(a|a)*",
+        r"(x+x+)+y",
+        r"(\w)\1",
+        r"(a+){2,5}",
+        r"(?:ab|a)*c",
+        r"[unclosed",
+        # Adjacent quantifiers that can match the same characters backtrack polynomially
+        r"\w*\w*\w*x",
+        r"\d+\w+",
+        r"\w+\d\w+",
+        r"\w*-?\w*",
+        r"(\w*){3}",
+        r"a*(?:b|a)+",
+        r"(?i)[a-z]+A+",
+        # Linear at each position, but unanchored searches retry every position
+        r"\w+\s+\w+",
+        r"[a-z]+@[a-z]+\.com",
+        r"(?m)^\w+\s+\w+",
+        r"\w+$",
+    )
+
+    for pattern in linear:
+        assert is_regex_linear(pattern) is True, pattern
+        assert IsRegex(value=pattern)._inline is True
+    for pattern in unsafe:
+        assert is_regex_linear(pattern) is False, pattern
+        assert IsRegex(value=pattern)._inline is False
+
+
+@pytest.mark.asyncio
+async def test_rule_cost_reordering():
+    rule = WardenRule()
+    await rule.parse(rl.COST_REORDER_RULE, cog=None)
+
+    order = [statement.enum for statement in rule.cond_tree]
+    # Compare and the block containing message-contains-invite are barriers
+    assert order == [
+        Condition.MessageMatchesAny,
+        Condition.IsStaff,
+        Condition.Compare,
+        ConditionBlock.IfAny,
+        Condition.MessageHasAttachment,
+        Condition.UserIdMatchesAny,
+    ]
+    if_any = next(value for statement, value in rule.cond_tree.items() if statement.enum is ConditionBlock.IfAny)
+    assert [statement.enum for statement in if_any] == [Condition.MessageContainsInvite, Condition.UserIdMatchesAny]
+
+    if_all = next(iter(rule.action_tree.values()))
+    assert [statement.enum for statement in if_all] == [Condition.UserIdMatchesAny, Condition.IsStaff]
+
+
+@pytest.mark.asyncio
+async def test_condition_memo():
+    rule1 = WardenRule()
+    await rule1.parse(rl.DISPLAY_NAME_MATCHES_ANY_OK, cog=None)
+    rule2 = WardenRule()
+    await rule2.parse(rl.DISPLAY_NAME_MATCHES_ANY_OK.replace("positive", "positive-2"), cog=None)
+    rule3 = WardenRule()
+    await rule3.parse(rl.DISPLAY_NAME_MATCHES_ANY_KO, cog=None)
+
+    memo = ConditionMemo()
+    hits, misses = ConditionMemo.hits, ConditionMemo.misses
+    for rule, expected in ((rule1, True), (rule2, True), (rule3, False)):
+        runtime = await rule.satisfies_conditions(
+            cog=None, rank=Rank.Rank1, guild=FAKE_GUILD, user=FAKE_USER, memo=memo
+        )
+        assert bool(runtime) is expected
+    assert ConditionMemo.hits == hits + 1
+    assert ConditionMemo.misses == misses + 2
+
+    # Heat changes while the rules are evaluated: never shared
+    rule = WardenRule()
+    await rule.parse(rl.COST_REORDER_RULE, cog=None)
+    for statement, _ in rule.iter_statements():
+        if statement.enum is Condition.Compare:
+            assert statement.memo_key is None
+        elif statement.enum is Condition.IsStaff:
+            assert statement.memo_key is not None
+
+
+@pytest.mark.asyncio
+async def test_guild_ruleset():
+    ruleset = GuildRuleset()
+    for raw_rule in (rl.INDEXED_USER_RULE, rl.INDEXED_CHANNEL_RULE, rl.INDEXED_CHANNEL_NAME_RULE, rl.UNINDEXED_RULE):
+        rule = WardenRule()
+        await rule.parse(raw_rule, cog=None)
+        ruleset[rule.name] = rule
+
+    def names(rules):
+        return [r.name for r in rules]
+
+    all_rules = ["indexed-channel-name", "indexed-channel", "indexed-user", "unindexed"]
+    assert names(ruleset.by_event(Event.OnMessage)) == all_rules
+    assert names(ruleset.by_event(Event.OnUserJoin)) == ["unindexed"]
+
+    candidates = ruleset.candidates(Event.OnMessage, rank=Rank.Rank4, user_id=1, channel_id=10)
+    assert names(candidates) == all_rules
+    candidates = ruleset.candidates(Event.OnMessage, rank=Rank.Rank3, user_id=3, channel_id=11)
+    assert names(candidates) == ["indexed-channel", "unindexed"]
+    candidates = ruleset.candidates(Event.OnMessage, rank=Rank.Rank3, user_id=3, channel_id=12)
+    assert names(candidates) == ["unindexed"]
+
+    version = ruleset.version
+    ruleset.pop("unindexed")
+    assert ruleset.version > version
+    assert names(ruleset.candidates(Event.OnMessage, rank=Rank.Rank3, user_id=3, channel_id=12)) == []
+
+    # The rules loaded from a snapshot of the config get the changes made after it was taken
+    loaded = GuildRuleset(ruleset)
+    live = GuildRuleset({"indexed-user": ruleset["indexed-user"]})
+    since = live.version
+    live.pop("indexed-channel", None)  # Removed during the load
+    live["unindexed"] = rule  # Added during the load
+    loaded.merge_changes(live, since)
+    assert sorted(loaded) == ["indexed-channel-name", "indexed-user", "unindexed"]
+    assert names(loaded.by_event(Event.OnMessage)) == ["indexed-channel-name", "indexed-user", "unindexed"]
+    live.clear()
+    loaded.merge_changes(live, since)
+    assert loaded == {}
+
+    ruleset.clear()
+    assert ruleset.by_event(Event.OnMessage) == []
+
+
+@pytest.mark.asyncio
+async def test_rule_admission():
+    rule = WardenRule()
+    await rule.parse(rl.INDEXED_USER_RULE, cog=None)
+    assert rule.user_scope == frozenset((1, 2))
+    assert rule.channel_scope == frozenset((10,))
+    assert rule.admits(Event.OnMessage, Rank.Rank1, user_id=1, channel_id=10) is True
+    assert rule.admits(Event.OnMessage, Rank.Rank1, user_id=3, channel_id=10) is False
+    assert rule.admits(Event.OnMessage, Rank.Rank1, user_id=1, channel_id=11) is False
+    assert rule.admits(Event.OnUserJoin, Rank.Rank1, user_id=1) is False
+
+    rule = WardenRule()
+    await rule.parse(rl.INDEXED_CHANNEL_NAME_RULE, cog=None)
+    assert rule.channel_scope is None
+    assert rule.rank_scope == frozenset((4,))
+    assert rule.admits(Event.OnMessage, Rank.Rank4, user_id=1, channel_id=12) is True
+    assert rule.admits(Event.OnMessage, Rank.Rank3, user_id=1, channel_id=12) is False
+
+    rule = WardenRule()
+    await rule.parse(rl.CHECK_RANK_SAFEGUARD, cog=None)
+    assert rule.admits(rule.events[0], Rank.Rank1) is False
+    assert rule.admits(rule.events[0], Rank.Rank3) is True
+
+
+@pytest.mark.asyncio
+async def test_action_executor():
+    class FakeCog:
+        def __init__(self):
+            self.monitor = []
+
+        def send_to_monitor(self, guild, entry):
+            self.monitor.append(entry)
+
+    class FakeMember:
+        id = 1
+        _roles = [3]
+        calls = []
+
+        async def add_roles(self, *roles, reason=None):
+            self.calls.append(("add", {r.id for r in roles}, reason))
+
+        async def remove_roles(self, *roles, reason=None):
+            self.calls.append(("remove", {r.id for r in roles}, reason))
+
+    cog = FakeCog()
+    executor = ActionExecutor(cog, queue_size=2)
+    member = FakeMember()
+    role1, role2, role3 = FakeRole(1, "a"), FakeRole(2, "b"), FakeRole(3, "c")
+    # Pending changes for the same member are merged into a single request
+    executor.change_roles(FakeGuild, member, "rule1", Action.AddRolesToUser, add=[role1, role2])
+    executor.change_roles(FakeGuild, member, "rule2", Action.RemoveRolesFromUser, remove=[role2, role3])
+    await asyncio.sleep(0)
+    assert member.calls == [
+        ("remove", {3}, "Unassigned by Warden rules 'rule1', 'rule2'"),
+        ("add", {1}, "Assigned by Warden rules 'rule1', 'rule2'"),
+    ]
+
+    # Changes are worked out against those still pending: adding then removing a role is a no-op
+    member.calls.clear()
+    role4 = FakeRole(4, "d")
+    executor.change_roles(FakeGuild, member, "rule1", Action.AddRolesToUser, add=[role4])
+    assert executor.role_ids(FakeGuild, member) == {3, 4}
+    executor.change_roles(FakeGuild, member, "rule2", Action.RemoveRolesFromUser, remove=[role4, role3])
+    assert executor.role_ids(FakeGuild, member) == set()
+    executor.change_roles(FakeGuild, member, "rule3", Action.AddRolesToUser, add=[role3])
+    assert executor.role_ids(FakeGuild, member) == {3}
+    await asyncio.sleep(0)
+    assert member.calls == []
+    assert not executor.pending_roles
+
+    ran = []
+
+    async def action(n):
+        ran.append(n)
+
+    results = [
+        executor.submit(("notify", FakeGuild.id), FakeGuild, "rule", Action.NotifyStaff, partial(action, i))
+        for i in range(4)
+    ]
+    assert results == [True, True, False, False]
+    for _ in range(3):
+        await asyncio.sleep(0)
+    assert ran == [0, 1]
+    assert cog.monitor == ["[Warden] 2 action(s) have been dropped: too many were queued at once."]
+    assert not executor.workers and not executor.queues
+
+
+@pytest.mark.asyncio
+async def test_fair_scheduler():
+    class FakeCog:
+        def __init__(self):
+            self.monitor = []
+
+        def send_to_monitor(self, guild, entry):
+            self.monitor.append(entry)
+
+    class Guild:
+        def __init__(self, _id):
+            self.id = _id
+
+    now = 0.0
+    cog = FakeCog()
+    scheduler = FairScheduler(cog, event_budget=0.1, second_budget=0.2, clock=lambda: now)
+    busy, small = Guild(1), Guild(2)
+
+    async def work(seconds, io=None):
+        nonlocal now
+        now += seconds
+        if io is not None:
+            await io
+
+    # Under budget, turns are granted right away. Only the time spent running is charged
+    turn = scheduler.turn(busy)
+    await turn.acquire()
+    assert turn.queued is False
+    io = asyncio.get_running_loop().create_future()
+    task = asyncio.create_task(turn.run(work(0.05, io)))
+    await asyncio.sleep(0)
+    now += 10  # Waiting on I/O, other tasks are running
+    io.set_result(None)
+    await task
+    assert turn.spent == pytest.approx(0.05)
+    assert not turn.exceeded()
+    await turn.run(work(0.25))
+    assert turn.exceeded()
+    turn.release()
+    assert scheduler.get_usage(busy).overrun is True
+
+    # Over budget: the busy guild is queued, the small one isn't held back by it
+    order = []
+
+    async def evaluate(guild):
+        async with scheduler.turn(guild) as turn:
+            await turn.run(work(0.01))
+            order.append(guild.id)
+
+    busy_tasks = [asyncio.create_task(evaluate(busy)) for _ in range(2)]
+    for _ in range(3):
+        await asyncio.sleep(0)
+    assert busy.id in scheduler.queues and order == []
+    await asyncio.gather(*(evaluate(small) for _ in range(20)))
+    assert order == [small.id] * 20 and small.id not in scheduler.queues
+    now += 1  # Its budget is renewed
+    await asyncio.gather(*busy_tasks)
+    assert order[20:] == [busy.id, busy.id]
+    assert not scheduler.queues
+
+    # Exceeding the budget for enough seconds in a row demotes the guild
+    for _ in range(DEMOTION_STRIKES):
+        async with scheduler.turn(busy) as turn:
+            await turn.run(work(0.3))
+        now += 1
+    usage = scheduler.get_usage(busy)
+    assert usage.demoted_until is not None
+    assert "deprioritized" in cog.monitor[0]
+    scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_fair_scheduler_round_robin():
+    class FakeCog:
+        def __init__(self):
+            self.monitor = []
+
+        def send_to_monitor(self, guild, entry):
+            self.monitor.append((guild.id, entry))
+
+    class Guild:
+        def __init__(self, _id):
+            self.id = _id
+
+    now = 0.0
+    cog = FakeCog()
+    scheduler = FairScheduler(cog, event_budget=0.1, second_budget=0.2, queue_size=8, clock=lambda: now)
+    busy, demoted = Guild(1), Guild(2)
+    order = []
+
+    async def work(seconds):
+        nonlocal now
+        now += seconds
+
+    async def evaluate(guild):
+        async with scheduler.turn(guild) as turn:
+            await turn.run(work(0.001))
+            order.append(guild.id)
+
+    # Both guilds are over budget, the demoted one gets fewer turns once their budget is renewed
+    scheduler.get_usage(demoted).demoted_until = 1000
+    for guild in (busy, demoted):
+        async with scheduler.turn(guild) as turn:
+            await turn.run(work(0.3))
+    tasks = [asyncio.create_task(evaluate(busy)) for _ in range(8)]
+    tasks += [asyncio.create_task(evaluate(demoted)) for _ in range(3)]
+    await asyncio.sleep(0)
+    assert list(scheduler.rotation) == [busy.id, demoted.id] and order == []
+    now += 1
+    await asyncio.gather(*tasks)
+    assert order == [busy.id] * 4 + [demoted.id] + [busy.id] * 4 + [demoted.id] * 2
+    assert not scheduler.queues and not scheduler.rotation
+
+    # A full queue drops the newest events, the staff is told once some of the queued ones go through
+    async with scheduler.turn(busy) as turn:
+        await turn.run(work(0.3))
+    order.clear()
+    tasks = [asyncio.create_task(evaluate(busy)) for _ in range(10)]
+    await asyncio.sleep(0)
+    now += 1
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    assert [type(r) for r in results[8:]] == [EventDropped, EventDropped]
+    assert order == [busy.id] * 8
+    assert cog.monitor == [(busy.id, "[Warden] 2 event(s) have not been evaluated: too many were queued at once.")]
+    scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_running_time():
+    async def evaluate():
+        time.sleep(0.02)
+        await asyncio.sleep(0.2)  # Waiting, other tasks are running
+        return True
+
+    result, spent = await running_time(evaluate())
+    assert result is True
+    assert 0.02 <= spent < 0.1
+
+
+def test_rule_stats():
+    wd_stats = WardenStats()
+    stats = wd_stats.get(1, "rule")
+    for i in range(1, 101):
+        stats.record_evaluation(i / 1000, passed=i % 4 == 0)
+    stats.record_actions(1_700_000_000.0, failed=False)
+    stats.record_actions(1_700_000_060.0, failed=True)
+    assert stats.evaluations == 100
+    assert stats.passes == 25
+    assert stats.actions == 2 and stats.failures == 1
+    assert stats.last_fired == 1_700_000_060.0
+    assert stats.p95_time == pytest.approx(0.095)
+    assert stats.average_time == pytest.approx(0.0505)
+    assert stats.max_time == pytest.approx(0.1)
+
+    exported = wd_stats.export_dirty()
+    assert list(exported) == [1]
+    assert "samples" not in exported[1]["rule"]  # The recent times aren't saved
+    assert wd_stats.export_dirty() == {}
+
+    wd_stats = WardenStats()
+    wd_stats.load(1, exported[1])
+    restored = wd_stats.guilds[1]["rule"]
+    assert restored.to_dict() == stats.to_dict()
+    assert not restored.samples and restored.p95_time == 0.0
+
+
+def test_rule_throttling(monkeypatch):
+    monkeypatch.setattr(rule_stats, "THROTTLE_THRESHOLD", 10)
+    monkeypatch.setattr(rule_stats, "THROTTLE_MODE", rule_stats.SAMPLED)
+    stats = WardenStats().get(1, "rule")
+    for _ in range(rule_stats.THROTTLE_MIN_SAMPLES - 1):
+        stats.record_evaluation(0.02, passed=False)
+        assert stats.check_throttle() is False
+    stats.record_evaluation(0.02, passed=False)
+    assert stats.check_throttle() is True
+    assert stats.throttle == rule_stats.SAMPLED
+    assert stats.check_throttle() is False  # Only reported once
+    # Which events are sampled depends on their ID alone, not on the order they come in
+    event_ids = [(ms << rule_stats.DISCORD_EPOCH_SHIFT) + 26 for ms in range(rule_stats.SAMPLE_RATE * 3)]
+    evaluated = [stats.should_evaluate(event_id) for event_id in event_ids]
+    assert evaluated.count(True) == 3
+    assert [stats.should_evaluate(event_id) for event_id in reversed(event_ids)] == evaluated[::-1]
+
+    stats.resume()
+    assert stats.throttle is None and stats.should_evaluate()
+    monkeypatch.setattr(rule_stats, "THROTTLE_MODE", rule_stats.SUSPENDED)
+    for _ in range(rule_stats.THROTTLE_MIN_SAMPLES):
+        stats.record_evaluation(0.005, passed=False)
+    assert stats.check_throttle() is False  # Under the threshold
+    for _ in range(rule_stats.STATS_SAMPLES):
+        stats.record_evaluation(0.05, passed=False)
+    assert stats.rolling_average_time == pytest.approx(0.05)
+    assert stats.check_throttle() is True
+    assert stats.should_evaluate() is False
+
+
+@pytest.mark.asyncio
+async def test_rule_cache(tmp_path):
+    path = tmp_path / "rules.cache"
+    cache = RuleCache(path, "1.0.0")
+    cache.load()
+    assert cache.get("rule", rl.COST_REORDER_RULE) is None
+    rule = WardenRule()
+    await rule.parse(rl.COST_REORDER_RULE, cog=None)
+    cache.put("rule", rule)
+    cache.save()
+
+    cache = RuleCache(path, "1.0.0")
+    cache.load()
+    assert cache.get("check:invite-filter", rl.COST_REORDER_RULE) is None
+    cached = cache.get("rule", rl.COST_REORDER_RULE)
+    await cached.restore(cog=None)
+    assert cached.name == rule.name and cached.events == rule.events and cached.rank == rule.rank
+    dump = lambda r: [(s.enum, m.model_dump() if hasattr(m, "model_dump") else None) for s, m in r.iter_statements()]
+    assert dump(cached) == dump(rule)
+    assert [s.cost for s in cached.cond_tree] == [s.cost for s in rule.cond_tree]
+
+    # Unused entries are dropped on save
+    cache.save()
+    assert RuleCache(path, "1.0.0").entries == {}
+
+    # A new Defender version invalidates everything
+    cache = RuleCache(path, "1.0.0")
+    cache.put("rule", rule)
+    cache.save()
+    cache = RuleCache(path, "1.0.1")
+    cache.load()
+    assert cache.get("rule", rl.COST_REORDER_RULE) is None
+
+
+@pytest.mark.asyncio
+async def test_preloaded_yaml():
+    data, broken = load_yaml_batch([rl.COST_REORDER_RULE, "name: [unclosed"])
+    assert broken is None
+    rule = WardenRule()
+    await rule.parse(rl.COST_REORDER_RULE, cog=None, data=data)
+    expected = WardenRule()
+    await expected.parse(rl.COST_REORDER_RULE, cog=None)
+    assert rule.name == expected.name and len(rule.cond_tree) == len(expected.cond_tree)
+    with pytest.raises(InvalidRule, match="Error parsing YAML"):
+        await WardenRule().parse("name: [unclosed", cog=None, data=broken)
+
+
+@pytest.mark.asyncio
+async def test_periodic_scheduler(monkeypatch):
+    monkeypatch.setattr(periodic, "MAX_JITTER", 0)
+
+    class FakeCog:
+        def __init__(self):
+            self.runs = []
+
+        async def run_wd_periodic_rule(self, guild_id, rule):
+            self.runs.append((guild_id, rule.name))
+
+    cog = FakeCog()
+    scheduler = periodic.PeriodicScheduler(cog)
+    cog.active_warden_rules = GuildRulesets(on_change=scheduler.ruleset_changed)
+    task = asyncio.create_task(scheduler.run())
+
+    rule = WardenRule()
+    await rule.parse(rl.PERIODIC_RULE, cog=None)
+    rule.next_run = utcnow() + timedelta(milliseconds=50)
+    cog.active_warden_rules[1][rule.name] = rule
+    assert len(scheduler.heap) == 1
+    await asyncio.sleep(0.2)
+    assert cog.runs == [(1, "periodic")]
+    # Rescheduled after running
+    assert len(scheduler.heap) == 1
+    assert scheduler.heap[0][0] >= (utcnow() + timedelta(minutes=4)).timestamp()
+
+    # Removed rules are discarded when they come up
+    replacement = WardenRule()
+    await replacement.parse(rl.PERIODIC_RULE, cog=None)
+    replacement.next_run = utcnow() + timedelta(milliseconds=50)
+    cog.active_warden_rules[2] = GuildRuleset({replacement.name: replacement})
+    cog.active_warden_rules[1].pop(rule.name)
+    # Make the stale entry due
+    scheduler.heap = [(0, *e[1:]) if e[3] is rule else e for e in scheduler.heap]
+    heapq.heapify(scheduler.heap)
+    scheduler.wake.set()
+    await asyncio.sleep(0.2)
+    assert cog.runs == [(1, "periodic"), (2, "periodic")]
+    assert all(entry[3] is replacement for entry in scheduler.heap)
+
+    # A rule edited while its previous version is running is retried later, not dropped
+    edited = WardenRule()
+    await edited.parse(rl.PERIODIC_RULE, cog=None)
+    edited.next_run = utcnow()
+    scheduler.running[(2, edited.name)] = replacement
+    cog.active_warden_rules[2][edited.name] = edited
+    await asyncio.sleep(0.1)
+    assert cog.runs == [(1, "periodic"), (2, "periodic")]
+    retries = [e for e in scheduler.heap if e[3] is edited]
+    assert len(retries) == 1 and retries[0][0] > time.time() + periodic.BUSY_RETRY_DELAY / 2
+    del scheduler.running[(2, edited.name)]
+    scheduler.heap = [(0, *e[1:]) if e[3] is edited else e for e in scheduler.heap]
+    heapq.heapify(scheduler.heap)
+    scheduler.wake.set()
+    await asyncio.sleep(0.1)
+    assert cog.runs[-1] == (2, "periodic") and len(cog.runs) == 3
+    task.cancel()
+    scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_periodic_prefilter():
+    class Member:
+        def __init__(self, name, joined_hours_ago, bot=False):
+            self.name = name
+            self.bot = bot
+            self.joined_at = utcnow() - timedelta(hours=joined_hours_ago)
+            self.created_at = utcnow() - timedelta(days=30)
+            self.avatar = FakeAsset()
+
+    class Guild:
+        id = 1
+        members = [
+            Member("spammer", 1),
+            Member("SPAM2", 1.5),
+            Member("spam3", 5),
+            Member("someone", 1),
+            Member("spambot", 1, bot=True),
+        ]
+
+    rule = WardenRule()
+    await rule.parse(rl.PREFILTER_PERIODIC_RULE, cog=None)
+    assert [c for c, _ in get_prefilters(rule)] == [Condition.UserJoinedLessThan, Condition.UsernameMatchesAny]
+    snapshot = MemberSnapshot(Guild)
+    survivors = await prefilter_members(rule, snapshot)
+    assert [m.name for m in survivors] == ["spammer", "SPAM2"]
+    # Only the columns that were needed have been built
+    assert set(snapshot.columns) == {"joined_at", "name"}
+
+
+@pytest.mark.asyncio
+async def test_incremental_periodic():
+    class Member:
+        def __init__(self, member_id, joined_hours_ago):
+            self.id = member_id
+            self.name = str(member_id)
+            self.bot = False
+            self.guild = Guild
+            self.joined_at = utcnow() - timedelta(hours=joined_hours_ago)
+            self.created_at = utcnow() - timedelta(days=30)
+
+    class Guild:
+        id = 1
+        members = []
+
+        @classmethod
+        def get_member(cls, member_id):
+            return next((m for m in cls.members if m.id == member_id), None)
+
+    with pytest.raises(InvalidRule, match="only allowed with periodic"):
+        await WardenRule().parse(rl.INVALID_INCREMENTAL_RULE, cog=None)
+
+    rule = WardenRule()
+    await rule.parse(rl.INCREMENTAL_PERIODIC_RULE, cog=None)
+    assert rule.incremental is True
+
+    # Just crossed the 2 hours threshold, will cross it in an hour, long past it
+    Guild.members = [Member(1, 2.01), Member(2, 1), Member(3, 100)]
+    dirty = DirtyMembers()
+    dirty.mark(Guild.members[2])  # Not tracked yet
+    assert not dirty.is_tracked(1)
+    # The first run is a full one
+    assert dirty.begin_scan(1, rule, rescan_interval=3600) is None
+    assert dirty.is_tracked(1)
+    dirty.finish_scan(1, rule, started=time.time() - 60, full=True)
+    since = dirty.begin_scan(1, rule, rescan_interval=3600)
+    assert since is not None
+
+    dirty.mark(Guild.members[2])
+    snapshot = MemberSnapshot(Guild)
+    changed = await get_changed_members(rule, snapshot, dirty, since)
+    assert sorted(m.id for m in changed) == [1, 3]
+
+    # Changes seen by every rule are forgotten
+    dirty.finish_scan(1, rule, started=time.time() + 1, full=False)
+    dirty.prune(1, lambda r: r is rule)
+    assert dirty.guilds[1] == {}
+    # Rules that are gone stop the tracking
+    dirty.prune(1, lambda r: False)
+    assert not dirty.is_tracked(1)
+
+    # Full scans happen at the rescan interval, and when the rule is replaced
+    dirty.finish_scan(1, rule, started=time.time() - 120, full=True)
+    assert dirty.begin_scan(1, rule, rescan_interval=60) is None
+    assert dirty.begin_scan(1, rule, rescan_interval=3600) is not None
+    replacement = WardenRule()
+    await replacement.parse(rl.INCREMENTAL_PERIODIC_RULE, cog=None)
+    assert dirty.begin_scan(1, replacement, rescan_interval=3600) is None
+
+
+@pytest.mark.asyncio
+async def test_impact_estimate():
+    class Member:
+        def __init__(self, joined_hours_ago):
+            self.joined_at = utcnow() - timedelta(hours=joined_hours_ago)
+
+    # 300 recent joins the rule targets, among 3000 older members
+    members = [Member(0.5) for _ in range(300)] + [Member(24 * 100 + i) for i in range(3000)]
+
+    async def predicate(member):
+        return member.joined_at > utcnow() - timedelta(hours=1)
+
+    # Small enough to be evaluated in full
+    estimate = await estimate_affected(members, predicate, budget=60)
+    assert estimate.exact
+    assert estimate.affected == 300
+    assert estimate.describe() == "300 users"
+
+    ticks = iter(range(10**6))
+    # One evaluation per tick of the clock: 330 of 3300 members get evaluated
+    estimate = await estimate_affected(members, predicate, budget=330, clock=lambda: next(ticks))
+    assert not estimate.exact
+    assert estimate.evaluated == 330
+    # Proportional allocation: the recent joins get 1 member in 11 of the sample, and all pass
+    assert estimate.affected == 30
+    assert estimate.estimate == 300
+    assert estimate.low <= 300 <= estimate.high
+    assert estimate.high < 600
+
+    progress = []
+
+    async def report(evaluated, total):
+        progress.append((evaluated, total))
+
+    ticks = iter(range(10**6))
+    affected = await find_affected(members, predicate, progress=report, interval=1000, clock=lambda: next(ticks))
+    assert len(affected) == 300
+    assert progress and progress[0] == (1000, 3300)
+
+
+@pytest.mark.asyncio
+async def test_templates():
+    constant = compile_template("Constant")
+    assert constant.constant
+    assert constant.substitute({"user_name": "Twentysix"}) == "Constant"
+    # Shared across rules
+    assert compile_template("Constant") is constant
+
+    template = compile_template("Hello $user_name, see <#${notification_channel_id}>. It costs $$5")
+    assert not template.constant
+    assert template.identifiers == ("user_name", "notification_channel_id")
+    assert template.substitute({"user_name": "Twentysix"}) == (
+        "Hello Twentysix, see <#${notification_channel_id}>. It costs $5"
+    )
+
+    rule = WardenRule()
+    await rule.parse(rl.TEMPLATED_RULE, cog=None)
+    assert rule.template_identifiers == {"user_name", "notification_channel_id"}
+    rule = WardenRule()
+    await rule.parse(rl.PERIODIC_RULE, cog=None)
+    assert "notification_channel_id" not in rule.template_identifiers
+
+
+def test_model_interning():
+    for validator in (*ACTIONS_VALIDATORS.values(), *CONDITIONS_VALIDATORS.values()):
+        assert validator._short_form
+        if validator._short_form == tuple(validator.model_fields):
+            assert list(validator._short_form) == list(validator.model_json_schema()["properties"])
+
+    first = model_validator(Condition.UserHasDefaultAvatar, True)
+    assert model_validator(Condition.UserHasDefaultAvatar, True) is first
+    assert model_validator(Action.DeleteUserMessage, None) is model_validator(Action.DeleteUserMessage, None)
+    # Same parameter, different statement or type
+    assert model_validator(Condition.IsStaff, True) is not first
+    assert model_validator(Condition.MessageMatchesAny, ["1"]) is not model_validator(Condition.MessageMatchesAny, [1])
+    # Mutable models are never shared
+    assert model_validator(Action.SendMessage, ["1", "hi"]) is not model_validator(Action.SendMessage, ["1", "hi"])
+
+
+def test_message_features():
+    class Message:
+        id = 26
+        content = clean_content = "hi <:red:262626> 😀 https://WWW.Example.com/a.png discord.gg/abc Hi"
+        raw_mentions = mentions = role_mentions = []
+
+    message = Message()
+    features = get_features(message)
+    # Shared by everyone looking at the same message
+    assert get_features(message) is features
+    assert features.invites == [("discord.gg", "abc")]
+    assert features.urls == ["https://WWW.Example.com/a.png"]
+    assert features.domains == {"www.example.com"}
+    assert features.has_media
+    assert features.unicode_emoji_count == 1
+    assert features.custom_emoji_count == 1
+    assert features.has_x_or_more_emojis(2) and not features.has_x_or_more_emojis(3)
+    assert features.tokens >= {"hi", "discord.gg/abc"}
+    assert features.char_count == len(message.content) - len("<:red:262626>") + 1
+
+    # Edits start over
+    message.content = "hello"
+    edited = get_features(message)
+    assert edited is not features
+    assert edited.invites == [] and edited.urls == [] and not edited.has_media
+
+
+def test_count_unicode_emojis():
+    keys = list(emoji.EMOJI_DATA)
+    # Emojis, their parts and what's around them
+    pieces = keys + list("abc #*01 é漢") + ["\u200d", "\ufe0f", "\u20e3", "\U0001F3FB"]
+    rng = random.Random(26)
+    for _ in range(5000):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 8)))
+        expected = emoji.emoji_count(text)
+        assert count_unicode_emojis(text) == expected, text
+        assert count_unicode_emojis(text, 3) == min(expected, 3), text
+
+    assert count_unicode_emojis("just text, 2626 #1") == 0
+    assert count_unicode_emojis("😀" * 100, 5) == 5
+
+
+def test_guild_names():
+    class Guild:
+        id = 26
+        roles = [FakeRole(26, "@everyone"), FakeRole(1, "mod"), FakeRole(2, "mod"), FakeRole(3, "2626")]
+        text_channels = [FakeRole(10, "general"), FakeRole(11, "2626")]
+        categories = []
+
+        def get_role(self, _id):
+            return next((r for r in self.roles if r.id == _id), None)
+
+    guild = Guild()
+    names = wd_names.get_names(guild)
+    assert wd_names.get_names(guild) is names
+    # The first one by that name, as discord.utils.get would
+    assert names.resolve(wd_names.ROLES, ["mod", 999]) == {1, 999}
+    # IDs are only names for channels
+    assert names.resolve(wd_names.ROLES, [2626]) == {2626}
+    assert names.resolve(wd_names.TEXT_CHANNELS, [2626, "general"]) == {2626, 11, 10}
+    assert [r.id for r in wd_names.find_roles(guild, ["mod", 999])] == [1]
+    assert wd_names.find_role(guild, "2626").id == 3
+
+    # Stale until the events drop the index
+    guild.roles = guild.roles[:1] + guild.roles[2:]
+    assert names.resolve(wd_names.ROLES, ["mod"]) == {1}
+    wd_names.invalidate(guild, *wd_names.CHANNELS)
+    assert names.resolve(wd_names.ROLES, ["mod"]) == {1}
+    wd_names.invalidate(guild, wd_names.ROLES)
+    assert names.resolve(wd_names.ROLES, ["mod"]) == {2}
+    assert names.resolve(wd_names.TEXT_CHANNELS, ["general"]) == {10}
+
+    wd_names.discard_names(guild.id)
+    assert wd_names.get_names(guild) is not names
+
+
+@pytest.mark.asyncio
+async def test_trace():
+    rule = WardenRule()
+    await rule.parse(rl.TRACED_RULE, cog=None)
+    runtime = await rule.satisfies_conditions(
+        cog=None, rank=Rank.Rank1, guild=FAKE_GUILD, message=FAKE_MESSAGE, debug=True
+    )
+    assert runtime.tracer.render() == [
+        " [=] compare (True)",
+        " [>] if-any block",
+        "  [=] compare (False)",
+        "  [=] compare (True)",
+        " [<] if-any block (True)",
+    ]
+    assert all(isinstance(duration, int) for _, _, _, duration in runtime.tracer)
+    assert all(line.endswith("ms") for line in runtime.tracer.render(timings=True) if "(" in line)
+    # Nothing is traced outside of debug, unless the rule is being profiled
+    runtime = await rule.satisfies_conditions(cog=None, rank=Rank.Rank1, guild=FAKE_GUILD, message=FAKE_MESSAGE)
+    assert runtime.tracer is None
+
+    rule.profile = RuleProfile(1)
+    for _ in range(2):
+        await rule.satisfies_conditions(cog=None, rank=Rank.Rank1, guild=FAKE_GUILD, message=FAKE_MESSAGE)
+        await rule.do_actions(cog=None, guild=FAKE_GUILD, message=FAKE_MESSAGE)
+    assert rule.profile.samples == 4
+    report = rule.profile.render(rule)
+    assert report[0] == "if:" and report[1].startswith(" compare: 2x")
+    # Only the conditional action block that runs is traced
+    assert " if-true block: never reached" in report and report[-1].startswith("  no-op: 2x")
+
+    rule.profile = RuleProfile(0)
+    await rule.satisfies_conditions(cog=None, rank=Rank.Rank1, guild=FAKE_GUILD, message=FAKE_MESSAGE)
+    assert rule.profile.samples == 0
+
+    trace = Trace()
+    for _ in range(TRACE_SIZE + 2):
+        trace.exit(trace.enter(0, next(iter(rule.cond_tree))), True)
+    assert len(trace) == TRACE_SIZE and trace.render()[-1] == "(2 more statements not recorded)"
+
+
+@pytest.mark.asyncio
+async def test_deferred_actions():
+    events = []
+
+    class FakeCog:
+        def __init__(self):
+            self.wd_executor = ActionExecutor(self)
+
+        def send_to_monitor(self, guild, entry):
+            events.append(("monitor", entry))
+
+        def dispatch_event(self, *args):
+            pass
+
+    class FakeMember(FakeUser):
+        roles = []
+
+        async def send(self, content, **kwargs):
+            events.append(("dm", content))
+
+        async def add_roles(self, *roles, reason=None):
+            events.append(("add", [r.id for r in roles]))
+
+    member = FakeMember()
+
+    class Guild(FakeGuild):
+        members = [member]
+        roles = [FakeRole(123, "role")]
+
+        def get_member(self, _id):
+            return member if _id == member.id else None
+
+        async def ban(self, user, **kwargs):
+            events.append(("ban", user.id))
+
+    cog = FakeCog()
+    guild = Guild()
+
+    # The message to the user is sent before they're banned, not queued behind it
+    rule = WardenRule()
+    await rule.parse(rl.DM_AND_BAN_RULE, cog=None)
+    assert rule.defers_actions is False
+    await rule.do_actions(cog=cog, user=member, guild=guild)
+    assert events == [("dm", "Bye"), ("ban", member.id)]
+
+    rule = WardenRule()
+    await rule.parse(rl.ROLE_THEN_CHECK_RULE, cog=None)
+    assert rule.defers_actions is False
+
+    events.clear()
+    rule = WardenRule()
+    await rule.parse(rl.ROLE_RULE, cog=None)
+    assert rule.defers_actions is True
+    await rule.do_actions(cog=cog, user=member, guild=guild)
+    assert events == []
+    for _ in range(3):
+        await asyncio.sleep(0)
+    assert sorted(events) == [("add", [123]), ("dm", "Welcome")]
+
+
+class FakeEventCog:
+    """Runs Warden events the way the cog does, on the given rules"""
+
+    dispatch_warden_event = Events.dispatch_warden_event
+    evaluate_warden_rule = Events.evaluate_warden_rule
+    run_warden_actions = Events.run_warden_actions
+
+    def __init__(self, guild, rules, events, *, concurrent=False, eval_limit=4):
+        self.events = events
+        self.active_warden_rules = GuildRulesets()
+        self.active_warden_rules[guild.id] = GuildRuleset({r.name: r for r in rules})
+        self.wd_eval_semaphores = defaultdict(lambda: asyncio.Semaphore(eval_limit))
+        self.wd_executor = ActionExecutor(self)
+        self.wd_scheduler = FairScheduler(self)
+        self.wd_stats = WardenStats()
+        self.concurrent = concurrent
+
+    @property
+    def config(self):
+        cog = self
+
+        class GuildConfig:
+            async def warden_concurrent_eval(self):
+                return cog.concurrent
+
+        class Config:
+            def guild(self, guild):
+                return GuildConfig()
+
+        return Config()
+
+    def send_to_monitor(self, guild, entry):
+        self.events.append(("monitor", entry))
+
+    def dispatch_event(self, *args):
+        pass
+
+
+def make_event_guild(events):
+    class FakeMember(FakeUser):
+        roles = []
+
+        async def send(self, content, **kwargs):
+            events.append(("dm", content))
+
+    member = FakeMember()
+
+    class Guild(FakeGuild):
+        members = [member]
+
+        def get_member(self, _id):
+            return member if _id == member.id else None
+
+        async def ban(self, user, **kwargs):
+            events.append(("ban", user.id))
+
+    return Guild(), member
+
+
+async def parse_rules(*raw_rules):
+    rules = []
+    for raw in raw_rules:
+        rule = WardenRule()
+        await rule.parse(raw, cog=None)
+        rules.append(rule)
+    return rules
+
+
+@pytest.mark.asyncio
+async def test_event_inline_when_expelled():
+    rules = await parse_rules(rl.GREET_RULE, rl.BAN_RULE)
+    greet, ban = rules
+    # Greeting alone could be queued, but not in an event where another rule bans the user
+    assert greet.defers_actions is True
+    assert ban.expels is True
+
+    for concurrent in (False, True):
+        events = []
+        guild, member = make_event_guild(events)
+        cog = FakeEventCog(guild, rules, events, concurrent=concurrent)
+        await cog.dispatch_warden_event(guild, Event.OnUserJoin, rank=Rank.Rank1, user=member)
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert events == [("dm", "Hi"), ("ban", member.id)]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_eval():
+    rules = await parse_rules(rl.GREET_RULE, rl.WARN_RULE, rl.LATE_RULE)
+    running = 0
+    max_running = 0
+
+    def delayed(delay):
+        async def satisfies_conditions(**kwargs):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(delay)
+            running -= 1
+            return True
+
+        return satisfies_conditions
+
+    # The rule with the highest priority is the last one to be evaluated
+    for rule, delay in zip(rules, (0.03, 0.02, 0.01)):
+        rule.satisfies_conditions = delayed(delay)
+
+    for concurrent, eval_limit, expected_running in ((False, 4, 1), (True, 2, 2), (True, 4, 3)):
+        max_running = 0
+        events = []
+        guild, member = make_event_guild(events)
+        cog = FakeEventCog(guild, rules, events, concurrent=concurrent, eval_limit=eval_limit)
+        await cog.dispatch_warden_event(guild, Event.OnUserJoin, rank=Rank.Rank1, user=member)
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert max_running == expected_running
+        assert events == [("dm", "Hi"), ("dm", "Warned"), ("dm", "Late")]
+
+
+@pytest.mark.asyncio
+async def test_event_stops_when_expelled():
+    rules = await parse_rules(rl.GREET_RULE, rl.BAN_RULE, rl.LATE_RULE)
+
+    for concurrent in (False, True):
+        events = []
+        guild, member = make_event_guild(events)
+        cog = FakeEventCog(guild, rules, events, concurrent=concurrent)
+        expelled = await cog.dispatch_warden_event(guild, Event.OnUserJoin, rank=Rank.Rank1, user=member)
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert expelled is True
+        assert events == [("dm", "Hi"), ("ban", member.id)]
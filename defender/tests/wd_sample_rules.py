@@ -585,3 +585,228 @@ TEST_CHECK_MESSAGE = """
   - username-matches-any: [123]
   - message-matches-any: [123]
 """
+
+COST_REORDER_RULE = """
+    name: cost-reorder
+    rank: 1
+    event: on-message
+    if:
+    - is-staff: false
+    - message-matches-any: ["*spider*"]
+    - compare: [$message, "!=", "spider"]
+    - if-any:
+        - message-contains-invite: true
+        - user-id-matches-any: [1234]
+    - message-has-attachment: true
+    - user-id-matches-any: [1234]
+    do:
+    - if-all:
+        - is-staff: false
+        - user-id-matches-any: [1234]
+    - send-to-monitor: "Hi"
+"""
+
+INDEXED_USER_RULE = """
+    name: indexed-user
+    rank: 1
+    priority: 3
+    event: on-message
+    if:
+    - message-matches-any: ["*"]
+    - user-id-matches-any: [1, 2]
+    - channel-matches-any: [10]
+    do:
+    - no-op:
+"""
+
+INDEXED_CHANNEL_RULE = """
+    name: indexed-channel
+    rank: 1
+    priority: 2
+    event: on-message
+    if:
+    - channel-matches-any: [10, 11]
+    do:
+    - no-op:
+"""
+
+INDEXED_CHANNEL_NAME_RULE = """
+    name: indexed-channel-name
+    rank: 1
+    priority: 1
+    event: on-message
+    if:
+    - channel-matches-any: [10, "general"]
+    - user-is-rank: 4
+    do:
+    - no-op:
+"""
+
+UNINDEXED_RULE = """
+    name: unindexed
+    rank: 1
+    event: [on-message, on-user-join]
+    if:
+    - if-any:
+        - user-id-matches-any: [1]
+        - username-matches-any: ["*"]
+    do:
+    - no-op:
+"""
+
+PERIODIC_RULE = """
+    name: periodic
+    rank: 1
+    event: periodic
+    run-every: 5 minutes
+    if:
+        - username-matches-any: ["*"]
+    do:
+        - send-to-monitor: "Periodic rule"
+"""
+
+PREFILTER_PERIODIC_RULE = """
+    name: prefilter
+    rank: 1
+    event: periodic
+    run-every: 5 minutes
+    if:
+        - user-joined-less-than: 2
+        - username-matches-any: ["spam*"]
+        - if-any:
+            - user-has-default-avatar: true
+            - user-created-less-than: 0
+    do:
+        - send-to-monitor: "Prefiltered"
+"""
+
+INCREMENTAL_PERIODIC_RULE = """
+    name: incremental
+    rank: 1
+    event: periodic
+    run-every: 5 minutes
+    incremental: true
+    if:
+        - if-not:
+            - user-joined-less-than: 2
+    do:
+        - send-to-monitor: "Not new anymore"
+"""
+
+INVALID_INCREMENTAL_RULE = """
+    name: incremental
+    rank: 1
+    event: on-user-join
+    incremental: true
+    if:
+        - user-joined-less-than: 2
+    do:
+        - send-to-monitor: "Incremental"
+"""
+
+TEMPLATED_RULE = """
+    name: templated
+    rank: 1
+    event: on-message
+    if:
+        - message-matches-any: ["$user_name"]
+    do:
+        - send-to-monitor: "Hello $user_name, see <#${notification_channel_id}>. It costs $$5"
+        - send-to-monitor: "Constant"
+"""
+
+TRACED_RULE = """
+    name: traced
+    rank: 1
+    event: on-message
+    if:
+        - compare: [1, ==, 1]
+        - if-any:
+            - compare: [1, ==, 2]
+            - compare: [2, ==, 2]
+    do:
+        - compare: [1, ==, 2]
+        - if-true:
+            - no-op:
+        - if-false:
+            - no-op:
+"""
+
+DM_AND_BAN_RULE = """
+    name: dm-and-ban
+    rank: 1
+    event: on-user-join
+    if:
+        - compare: [1, ==, 1]
+    do:
+        - send-message: ["$user_id", "Bye"]
+        - ban-user-and-delete: 0
+"""
+
+ROLE_THEN_CHECK_RULE = """
+    name: role-then-check
+    rank: 1
+    event: on-user-join
+    if:
+        - compare: [1, ==, 1]
+    do:
+        - add-roles-to-user: [123]
+        - user-has-any-role-in: [123]
+        - if-true:
+            - send-to-monitor: "Done"
+"""
+
+ROLE_RULE = """
+    name: role
+    rank: 1
+    event: on-user-join
+    if:
+        - compare: [1, ==, 1]
+    do:
+        - add-roles-to-user: [123]
+        - send-message: ["$user_id", "Welcome"]
+"""
+
+GREET_RULE = """
+    name: greet
+    rank: 1
+    event: on-user-join
+    priority: 1
+    if:
+        - compare: [1, ==, 1]
+    do:
+        - send-message: ["$user_id", "Hi"]
+"""
+
+BAN_RULE = """
+    name: ban
+    rank: 1
+    event: on-user-join
+    priority: 2
+    if:
+        - compare: [1, ==, 1]
+    do:
+        - ban-user-and-delete: 0
+"""
+
+WARN_RULE = """
+    name: warn
+    rank: 1
+    event: on-user-join
+    priority: 2
+    if:
+        - compare: [1, ==, 1]
+    do:
+        - send-message: ["$user_id", "Warned"]
+"""
+
+LATE_RULE = """
+    name: late
+    rank: 1
+    event: on-user-join
+    priority: 3
+    if:
+        - compare: [1, ==, 1]
+    do:
+        - send-message: ["$user_id", "Late"]
+"""